@@ -5,6 +5,7 @@
 const MAX_WAIT_TIME = 120000; // 120 segundos (2 minutos)
 let startTime = Date.now();
 let processingComplete = false;
+let processingFinished = false;
 let processingStarted = false;
 let consecutiveWaitingCount = 0;
 
@@ -13,6 +14,7 @@ async function checkProcessingStatus() {
     try {
         // Si ha pasado el tiempo máximo de espera, mostrar un mensaje de error
         if (Date.now() - startTime > MAX_WAIT_TIME) {
+            cancelProcessing();
             showError("El procesamiento está tardando demasiado. Por favor, inténtalo de nuevo.");
             return;
         }
@@ -29,10 +31,12 @@ async function checkProcessingStatus() {
         if (data.status === 'complete') {
             // Si el procesamiento ha terminado, redirigir a la página de resultados
             processingComplete = true;
+            processingFinished = true;
             window.location.href = "/resultado";
             return;
-        } else if (data.status === 'error') {
-            // Si ha habido un error, mostrar el mensaje de error
+        } else if (data.status === 'error' || data.status === 'cancelled') {
+            // Si ha habido un error o se ha cancelado, mostrar el mensaje
+            processingFinished = true;
             showError(data.message);
             return;
         } else if (data.status === 'processing') {
@@ -45,6 +49,7 @@ async function checkProcessingStatus() {
             
             // Si hemos estado esperando demasiado tiempo (más de 10 segundos)
             if (consecutiveWaitingCount > 10) {
+                cancelProcessing();
                 showError("No se ha recibido la imagen. Por favor, vuelve e intenta capturar la foto de nuevo.");
                 return;
             }
@@ -59,6 +64,19 @@ async function checkProcessingStatus() {
     }
 }
 
+// Función para avisar al servidor de que ya no se espera el resultado,
+// para que deje de procesar la captura y atienda a otros visitantes
+function cancelProcessing() {
+    if (processingFinished) {
+        return;
+    }
+    processingFinished = true;
+    // sendBeacon se entrega aunque la página se esté cerrando
+    if (!navigator.sendBeacon || !navigator.sendBeacon('/cancel_processing')) {
+        fetch('/cancel_processing', { method: 'POST', keepalive: true }).catch(() => {});
+    }
+}
+
 // Función para actualizar el mensaje de carga
 function updateLoadingMessage(message) {
     const loadingText = document.querySelector('.loading-text');
@@ -103,4 +121,7 @@ document.addEventListener('DOMContentLoaded', () => {
     console.log("Página de carga iniciada");
     // Esperar un poco antes de empezar a comprobar
     setTimeout(checkProcessingStatus, 1000);
-});
\ No newline at end of file
+});
+
+// Si el visitante vuelve atrás o cierra la página antes del resultado, cancelar la captura
+window.addEventListener('pagehide', cancelProcessing);
\ No newline at end of file
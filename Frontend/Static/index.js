@@ -14,6 +14,21 @@ function stopWebcam() {
     }
 }
 
+// Id propio de este photocall, para que el servidor reparta sus turnos
+// de forma justa entre kioscos (se guarda en el navegador)
+function getKioskId() {
+    try {
+        let id = localStorage.getItem('celebriaKiosk');
+        if (!id) {
+            id = Math.random().toString(16).slice(2, 18);
+            localStorage.setItem('celebriaKiosk', id);
+        }
+        return id;
+    } catch (err) {
+        return null;
+    }
+}
+
 // Iniciar la transmisión de la webcam
 async function startWebcam() {
     try {
@@ -60,8 +75,8 @@ document.addEventListener('DOMContentLoaded', async () => {
     // Setup gender checkboxes to work like radio buttons
     setupGenderCheckboxes();
     
-    // Iniciar la webcam después de un pequeño retraso
-    setTimeout(startWebcam, 300);
+    // Iniciar la webcam (el servidor ya ha asignado un trabajo nuevo a este navegador)
+    startWebcam();
 });
 
 // Function to make checkboxes work like radio buttons
@@ -125,7 +140,8 @@ document.getElementById("capturar-btn").addEventListener("click", async () => {
             },
             body: JSON.stringify({ 
                 image: imageData,
-                gender: gender
+                gender: gender,
+                kiosk: getKioskId()
             }),
         })
         .then(response => response.json())
@@ -4,6 +4,22 @@ let imagen ; //arreglo para las imágenes
 
 // Script para mostrar los resultados en la página de resultados
 
+// Anchos que el servidor sabe generar (ANCHOS en miniaturas.py)
+const ANCHOS_IMAGEN = [150, 300, 450, 600, 900];
+
+// Famosos que se piden cada vez que se pulsa "VER MÁS" (el servidor guarda hasta 50 por cara)
+const PARECIDOS_POR_PAGINA = 6;
+
+// Famosos ya pedidos a /more_results y cursor de la página siguiente, por persona
+const masParecidos = {};
+
+// Asigna src y srcset para que el navegador pida la imagen del tamaño justo para la pantalla
+function asignarImagenAdaptada(img, ruta, sizes) {
+    img.src = `${ruta}?w=${ANCHOS_IMAGEN[1]}`;
+    img.srcset = ANCHOS_IMAGEN.map(ancho => `${ruta}?w=${ancho} ${ancho}w`).join(', ');
+    img.sizes = sizes;
+}
+
 document.addEventListener('DOMContentLoaded', async () => {
     try {
         console.log("Página de resultados cargada, obteniendo resultados...");
@@ -45,6 +61,9 @@ document.addEventListener('DOMContentLoaded', async () => {
         // Configurar el botón "Tomar otra foto"
         setupTakeAnotherPhotoButton();
         
+        // Configurar el botón "Ver más" para pedir más famosos parecidos
+        setupShowMoreButton();
+        
         // Forzar la visibilidad de las flechas de nuevo después de un tiempo
         if (results.length > 1) {
             setTimeout(() => {
@@ -95,7 +114,7 @@ function displayResults(results) {
         
         // Mostrar la imagen detectada de la cara en el cuadrado pequeño (cuadrado4)
         const personaImg = document.createElement('img');
-        personaImg.src = `/${currentResult.cara_detectada}`;
+        asignarImagenAdaptada(personaImg, `/${currentResult.cara_detectada}`, '(max-width: 1250px) 16vw, 200px');
         personaImg.alt = 'Tu foto';
         personaImg.className = 'cara-detectada';
         
@@ -136,7 +155,7 @@ function displayResults(results) {
                 
                 // Verificar que image_data existe
                 if (match.image_data) {
-                    famousImg.src = `/${match.image_data}`;
+                    asignarImagenAdaptada(famousImg, `/${match.image_data}`, '(max-width: 1250px) 24vw, 300px');
                 } else {
                     famousImg.src = '/Static/img/image-not-found.svg';
                 }
@@ -146,6 +165,7 @@ function displayResults(results) {
                 
                 // Añadir un manejador de errores para la imagen
                 famousImg.onerror = function() {
+                    this.removeAttribute('srcset');
                     this.src = '/Static/img/image-not-found.svg';
                     this.alt = 'Imagen no encontrada';
                 };
@@ -173,6 +193,9 @@ function displayResults(results) {
             cuadrado3.appendChild(noMatchesMessage.cloneNode(true));
         }
         
+        // Mostrar los famosos ya pedidos con "Ver más" para esta persona
+        displayMoreLookalikes(currentResult);
+        
         // Actualizar el contador de personas si hay más de una
         updatePersonCounter(results);
         
@@ -289,6 +312,81 @@ function setupNavigation(results) {
     }
 }
 
+// Función para mostrar los famosos pedidos con "Ver más" de la persona actual
+function displayMoreLookalikes(currentResult) {
+    const contenedor = document.querySelector('.mas-parecidos');
+    const showMoreButton = document.getElementById('show-more');
+    if (!contenedor || !showMoreButton) return;
+    
+    const estado = masParecidos[window.currentPersonIndex || 0] || { matches: [], cursor: null, agotado: false };
+    contenedor.innerHTML = '';
+    
+    for (const match of estado.matches) {
+        const item = document.createElement('div');
+        item.className = 'mas-parecido';
+        
+        const img = document.createElement('img');
+        asignarImagenAdaptada(img, `/${match.image_data}`, '(max-width: 1250px) 8vw, 100px');
+        img.alt = match.name || 'Celebridad';
+        img.onerror = function() {
+            this.removeAttribute('srcset');
+            this.src = '/Static/img/image-not-found.svg';
+        };
+        
+        const nombre = document.createElement('p');
+        nombre.textContent = match.name || 'Desconocido';
+        const similitud = document.createElement('p');
+        similitud.textContent = `${match.similarity || 0}%`;
+        
+        item.appendChild(img);
+        item.appendChild(nombre);
+        item.appendChild(similitud);
+        contenedor.appendChild(item);
+    }
+    
+    // Solo se ofrece "Ver más" si el servidor guardó más famosos de los que ya se ven
+    const mostrados = Math.min(3, (currentResult.matches || []).length) + estado.matches.length;
+    const hayMas = !estado.agotado && (currentResult.ranked_matches || 0) > mostrados;
+    showMoreButton.style.display = hayMas ? 'flex' : 'none';
+}
+
+// Función para configurar el botón "Ver más"
+function setupShowMoreButton() {
+    const showMoreButton = document.getElementById('show-more');
+    if (!showMoreButton) return;
+    
+    showMoreButton.addEventListener('click', async () => {
+        const indice = window.currentPersonIndex || 0;
+        const estado = masParecidos[indice] || (masParecidos[indice] = { matches: [], cursor: null, agotado: false });
+        
+        showMoreButton.disabled = true;
+        try {
+            // La primera página sigue tras los 3 famosos de los cuadrados; las demás, tras el cursor
+            const params = new URLSearchParams({ limit: PARECIDOS_POR_PAGINA });
+            if (estado.cursor) params.set('cursor', estado.cursor);
+            
+            const response = await fetch(`/more_results/${indice + 1}?${params}`);
+            const data = await response.json();
+            
+            if (!data.success) {
+                console.error('Error al pedir más parecidos:', data.error);
+                estado.agotado = true;
+            } else {
+                estado.matches.push(...data.matches);
+                estado.cursor = data.next_cursor;
+                estado.agotado = !data.next_cursor;
+            }
+        } catch (error) {
+            console.error('Error al pedir más parecidos:', error);
+        } finally {
+            showMoreButton.disabled = false;
+        }
+        
+        // Puede que el visitante haya cambiado de persona mientras llegaba la respuesta
+        displayMoreLookalikes(window.allResults[window.currentPersonIndex || 0]);
+    });
+}
+
 // Función para configurar el botón "Tomar otra foto"
 function setupTakeAnotherPhotoButton() {
     const takeAnotherButton = document.getElementById('take-another-photo');
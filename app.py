@@ -1,20 +1,55 @@
 #hola
-from flask import Flask, render_template, request, jsonify, redirect, url_for, send_from_directory
+from flask import Flask, render_template, request, jsonify, redirect, url_for, g
 import os
 import cv2
 import base64
 import numpy as np
-import json
-from deepface import DeepFace
 import pandas as pd
 from PIL import Image
 import shutil
 import time
+import logging
+
+import metricas
+from metricas import instalar_metricas
+from perfilador import instalar_perfilador
+from estaticos import instalar_estaticos
+from miniaturas import servir_imagen_adaptada
+from trabajos import MAX_CANDIDATOS, CapturaCancelada, instalar_trabajos, registro, trabajo_actual
+from detectores import detectar_caras
+from calidad import ControlCalidad
+from planificador import planificador
+
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__, 
             static_folder='Frontend/Static',
             template_folder='Frontend/Templates')
 
+# Per-stage latency metrics and the /metrics endpoint (enabled with CELEBRIA_METRICS=1)
+instalar_metricas(app)
+
+# Opt-in request profiling and the /admin/profiles endpoints (enabled with CELEBRIA_PROFILING=1)
+instalar_perfilador(app)
+
+# Fingerprinted, precompressed static assets and conditional GET for images
+instalar_estaticos(app)
+
+# One capture job per browser (cookie) with its own folder under personas/
+instalar_trabajos(app)
+
+# Embedding model used by DeepFace.find (DeepFace keeps a representations file per model in face-db/)
+MODELO = os.environ.get("CELEBRIA_MODEL", "VGG-Face")
+
+# Downscaled detection when a capture would not finish within its latency budget
+# (CELEBRIA_LATENCY_BUDGET_S, see calidad.py). DeepFace.find has no cheaper search setting.
+control_calidad = ControlCalidad()
+
+@app.before_request
+def _marcar_llegada():
+    """Stamp when the request reached Flask, so the latency budget counts from there and not from detection"""
+    g.llegada = time.monotonic()
+
 # Ensure the personas directory exists
 os.makedirs('personas', exist_ok=True)
 
@@ -39,201 +74,263 @@ def resultado():
 @app.route('/process_image', methods=['POST'])
 def process_image():
     """Process the captured image and find celebrity matches"""
-    try:
-        # Get the image data from the request
-        image_data = request.json.get('image')
-        
-        # Remove the data URL prefix
-        image_data = image_data.split(',')[1]
-        
-        # Decode the base64 image
-        image_bytes = base64.b64decode(image_data)
-        
-        # Convert to numpy array
-        nparr = np.frombuffer(image_bytes, np.uint8)
-        
-        # Decode the image
-        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        
-        # Save the original image
-        original_path = "personas/foto.jpg"
-        cv2.imwrite(original_path, image)
-        
-        # Process the image and wait for results
-        results = procesar_imagen(original_path)
-        
-        # Check if we have valid results
-        if not results or len(results) == 0:
-            return jsonify({"success": False, "error": "No faces detected"})
-        
-        # No longer reject if one face has no matches
-        # Just ensure we have at least one detected face
-        
-        return jsonify({
-            "success": True, 
-            "redirect": "/resultado",
-            "faces_detected": len(results)
-        })
-    
-    except Exception as e:
-        return jsonify({"success": False, "error": str(e)})
+    trabajo = trabajo_actual()
+    trabajo.nueva_captura()
+    return jsonify(procesar_peticion(request.json, trabajo, g.llegada))
+
+@app.route('/cancel_processing', methods=['POST'])
+def cancel_processing():
+    """Cancel the capture being processed, because the visitor left or gave up waiting"""
+    return jsonify(cancelar_procesamiento(trabajo_actual()))
 
 @app.route('/get_results')
 def get_results():
-    """Get the results from the JSON files"""
+    """Get the results of the current capture job"""
+    return jsonify(leer_resultados(trabajo_actual()))
+
+@app.route('/more_results/<int:n>')
+def more_results(n):
+    """Get the next page of ranked lookalikes for a detected face"""
     try:
-        results = []
-        # Read all JSON files in the personas directory
-        json_files = [file for file in os.listdir('personas') if file.startswith('json_persona') and file.endswith('.json')]
-        
-        # Log the number of JSON files found
-        print(f"Found {len(json_files)} JSON files: {json_files}")
-        
-        for file in json_files:
-            with open(os.path.join('personas', file), 'r') as f:
-                result_data = json.load(f)
-                # Log each result file content summary
-                print(f"File {file} contains data for persona: {result_data.get('cara_detectada')}")
-                results.append(result_data)
-        
-        # Return more diagnostic information
-        return jsonify({
-            "success": True,
-            "file_count": len(json_files),
-            "file_names": json_files,
-            "results": results
-        })
-    
-    except Exception as e:
-        print(f"Error in get_results: {str(e)}")
-        return jsonify({"error": str(e), "success": False})
+        pagina = mas_resultados(trabajo_actual(), n, request.args.get('cursor'),
+                                request.args.get('limit', 3, type=int))
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    if pagina is None:
+        return jsonify({"success": False, "error": "Result not found"}), 404
+    return jsonify(pagina)
 
 @app.route('/face-db/<path:filename>')
 def serve_image(filename):
-    """Serve images from the face-db directory"""
-    return send_from_directory('face-db', filename)
+    """Serve images from the face-db directory, resized and re-encoded on request"""
+    with metricas.etapa("image_serving"):
+        return servir_imagen_adaptada('face-db', filename)
 
 @app.route('/personas/<path:filename>')
 def serve_persona_image(filename):
-    """Serve images from the personas directory"""
-    return send_from_directory('personas', filename)
+    """Serve images from the personas directory, resized and re-encoded on request"""
+    with metricas.etapa("image_serving"):
+        return servir_imagen_adaptada('personas', filename)
 
 @app.route('/clear_data', methods=['POST'])
 def clear_data():
-    """Clear the data in the personas directory"""
-    try:
-        # Ensure the personas directory exists
-        os.makedirs('personas', exist_ok=True)
-        
-        # Delete all files in the personas directory
-        borrar_contenido_carpeta_flask("personas")
-        
-        # Add a small delay to ensure files are cleared
-        time.sleep(0.5)
-        
-        # Return success response
-        return jsonify({"success": True, "message": "Data cleared successfully", "timestamp": time.time()})
-    except Exception as e:
-        print(f"Error clearing data: {e}")
-        return jsonify({"success": False, "error": str(e)})
+    """Drop the current capture job and start a new one"""
+    respuesta, g.trabajo = limpiar_datos(trabajo_actual())
+    return jsonify(respuesta)
 
 @app.route('/process_status', methods=['GET'])
 def process_status():
     """Check the status of the image processing"""
+    return jsonify(estado_procesamiento(trabajo_actual()))
+
+# Request handlers shared by the Flask routes and the ASGI variant (asgi.py).
+# They take plain data and return dictionaries ready to be serialized as JSON.
+
+def procesar_peticion(datos, trabajo, llegada=None):
+    """
+    Decodifica la foto enviada por el navegador y ejecuta el pipeline completo.
+    
+    :param datos: Cuerpo JSON de /process_image (imagen en data URL y, opcionalmente, id del photocall).
+    :param trabajo: Trabajo del navegador que envía la foto.
+    :param llegada: time.monotonic() de cuando llegó la petición, si esperó en una cola (por defecto, ahora).
+    :return: Diccionario con el resultado para el navegador.
+    """
+    metricas.ajustar("processing_in_flight", 1)
     try:
-        # Check if the original image exists
-        if not os.path.exists('personas/foto.jpg'):
-            return jsonify({
-                "status": "waiting", 
-                "message": "Esperando imagen..."
-            })
+        trabajo.cambiar_estado("detectando")
         
-        # Check if there are any JSON files in the personas directory
-        json_files = [f for f in os.listdir('personas') if f.startswith('json_persona') and f.endswith('.json')]
+        # The visitor may have left while the capture waited for a worker
+        trabajo.comprobar_cancelacion("queue")
+        
+        with metricas.etapa("decode"):
+            # Get the image data from the request
+            image_data = datos.get('image')
+            
+            # Remove the data URL prefix
+            image_data = image_data.split(',')[1]
+            
+            # Decode the base64 image
+            image_bytes = base64.b64decode(image_data)
+            
+            # Convert to numpy array
+            nparr = np.frombuffer(image_bytes, np.uint8)
+            
+            # Decode the image
+            image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+            
+            # Save the original image in the job folder
+            original_path = trabajo.ruta("foto.jpg")
+            cv2.imwrite(original_path, image)
         
-        if not json_files:
-            # Check if face detection has started
-            face_files = [f for f in os.listdir('personas') if f.startswith('foto') and f.endswith('.jpg') and f != 'foto.jpg']
-            if face_files:
-                return jsonify({
-                    "status": "processing", 
-                    "message": "Buscando coincidencias con famosos..."
-                })
-            else:
-                return jsonify({
-                    "status": "processing", 
-                    "message": "Detectando rostros en la imagen..."
-                })
+        # Process the image and wait for results, with the settings that fit in the latency budget
+        with control_calidad.capturar(llegada) as medicion:
+            results, candidatos = procesar_imagen(original_path, trabajo, image, medicion.nivel,
+                                                  str(datos.get('kiosk') or trabajo.id)[:64])
+            medicion.caras = len(results or ())
         
-        # Read the first JSON file to check if it has matches
-        with open(os.path.join('personas', json_files[0]), 'r') as f:
-            data = json.load(f)
+        # Check if we have valid results
+        if not results or len(results) == 0:
+            trabajo.cambiar_estado("error", "No se detectaron rostros en la imagen")
+            return {"success": False, "error": "No faces detected"}
         
-        if not data.get('matches') or len(data.get('matches', [])) == 0:
-            return jsonify({
-                "status": "error", 
-                "message": "No se encontraron coincidencias con famosos"
-            })
+        if not results[0].get('matches'):
+            trabajo.cambiar_estado("error", "No se encontraron coincidencias con famosos")
+        else:
+            with metricas.etapa("serialization"):
+                trabajo.cambiar_estado("completo", resultados=results, candidatos=candidatos)
         
-        return jsonify({
-            "status": "complete", 
-            "message": "¡Coincidencias encontradas! Redirigiendo..."
-        })
+        # No longer reject if one face has no matches
+        # Just ensure we have at least one detected face
+        
+        return {
+            "success": True, 
+            "redirect": "/resultado",
+            "faces_detected": len(results)
+        }
+    
+    except CapturaCancelada as e:
+        print(f"Job {trabajo.id}: {e}")
+        trabajo.cambiar_estado("cancelado")
+        return {"success": False, "cancelled": True, "error": "Processing cancelled"}
     
     except Exception as e:
-        return jsonify({
-            "status": "error", 
-            "message": f"Error en el procesamiento: {str(e)}"
-        })
+        trabajo.cambiar_estado("error", f"Error en el procesamiento: {str(e)}")
+        return {"success": False, "error": str(e)}
+    finally:
+        metricas.ajustar("processing_in_flight", -1)
+
+def leer_resultados(trabajo):
+    """
+    Devuelve los resultados de cada cara detectada en la captura del trabajo.
+    
+    :param trabajo: Trabajo del navegador.
+    :return: Diccionario con los resultados e información de diagnóstico.
+    """
+    results = trabajo.resultados
+    logger.debug(f"Job {trabajo.id} has results for {len(results)} faces")
+    return {
+        "success": True,
+        "job": trabajo.id,
+        "face_count": len(results),
+        "results": results
+    }
+
+def mas_resultados(trabajo, n, cursor=None, limite=3):
+    """
+    Devuelve la siguiente página de caras parecidas de face-db, de la lista que guardó la búsqueda.
+    
+    :param trabajo: Trabajo del navegador.
+    :param n: Número de la cara detectada, empezando en 1.
+    :param cursor: Cursor de la página anterior (next_cursor), o None para seguir tras los 3 primeros.
+    :param limite: Caras por página.
+    :return: Diccionario con la página, o None si no hay lista para esa cara.
+    :raises ValueError: Si el cursor no es válido o es de otra captura.
+    """
+    pagina = trabajo.pagina_candidatos(n, cursor, limite)
+    if pagina is None:
+        return None
+    rutas = [candidato["source"] for candidato in pagina["candidatos"]]
+    matches = [{"name": nombre, "similarity": candidato["similarity"], "image_data": ruta}
+               for nombre, candidato, ruta in zip(sacar_nombre_ruta(rutas), pagina["candidatos"], rutas)]
+    return {
+        "success": True,
+        "face": n,
+        "matches": matches,
+        "next_cursor": pagina["next_cursor"],
+        "total": pagina["total"]
+    }
+
+def limpiar_datos(trabajo):
+    """
+    Descarta la captura anterior del navegador y le asigna un trabajo nuevo.
+    
+    La carpeta del trabajo anterior se borra en segundo plano (trabajos.py).
+    
+    :param trabajo: Trabajo actual del navegador.
+    :return: Tupla (respuesta, trabajo nuevo para el navegador).
+    """
+    try:
+        nuevo = registro.reemplazar(trabajo)
+        return {"success": True, "message": "Data cleared successfully", "timestamp": time.time()}, nuevo
+    except Exception as e:
+        print(f"Error clearing data: {e}")
+        return {"success": False, "error": str(e)}, trabajo
+
+def estado_procesamiento(trabajo):
+    """
+    Comprueba en qué punto está el procesamiento de la captura actual.
+    
+    Cada consulta cuenta como señal de que el visitante sigue esperando (ver trabajos.py).
+    
+    :param trabajo: Trabajo del navegador.
+    :return: Diccionario con el estado (waiting, processing, complete, error o cancelled) y un mensaje.
+    """
+    trabajo.latido()
+    return trabajo.estado_publico()
+
+def cancelar_procesamiento(trabajo):
+    """
+    Cancela la captura en curso del trabajo; el pipeline se detiene en su siguiente punto de cancelación.
+    
+    :param trabajo: Trabajo del navegador.
+    :return: Diccionario que indica si había una captura que cancelar.
+    """
+    return {"success": True, "cancelled": trabajo.cancelar()}
 
 # Backend functions adapted from proyecto_paellas_def.py
 
-def detectar_personas(ruta_front):
+def detectar_personas(ruta_front, trabajo, imagen=None):
     """
     Detecta las caras en una imagen y guarda cada cara detectada como una imagen separada.
     
     :param ruta_front: Ruta de la imagen donde se detectarán las caras.
+    :param trabajo: Trabajo en cuya carpeta se guardan las caras.
+    :param imagen: Imagen ya decodificada (BGR) en la que buscar las caras, o None para leer ruta_front.
     :return: Lista de rutas de las imágenes de las caras detectadas.
     """
     try:
-        # Intentar extraer caras de la imagen
-        faces = DeepFace.extract_faces(ruta_front, enforce_detection=False)
+        # Extraer las caras con la cascada de detectores (CELEBRIA_DETECTORS, ver detectores.py)
+        with metricas.etapa("detection"):
+            faces = detectar_caras(ruta_front if imagen is None else imagen)
         lista_rutas = []
         
         if not faces or len(faces) == 0:
             print("No faces detected, using original image")
-            # Si no se detectan caras, usar la imagen original
-            shutil.copy(ruta_front, "personas/foto0.jpg")
-            lista_rutas.append("personas/foto0.jpg")
+            # Si ningún detector de la cascada encuentra caras, usar la imagen original
+            shutil.copy(ruta_front, trabajo.ruta("foto0.jpg"))
+            lista_rutas.append(trabajo.ruta("foto0.jpg"))
         else:
-            # Procesar cada cara detectada
-            for i in range(len(faces)):
-                face_array = faces[i]['face']  # Obtener el array de la cara detectada
-                face_array = (face_array * 255).astype(np.uint8)  # Convertir a formato de imagen
-                face_image = Image.fromarray(face_array)  # Convertir el array en una imagen PIL
-                face_image.save(f"personas/foto{i}.jpg")  # Guardar la imagen
-                lista_rutas.append(f"personas/foto{i}.jpg")  # Añadir la ruta a la lista
+            # Procesar cada cara alineada: normalizar el recorte y guardarlo
+            with metricas.etapa("alignment"):
+                for i in range(len(faces)):
+                    face_array = faces[i]['face']  # Obtener el array de la cara detectada
+                    face_array = (face_array * 255).astype(np.uint8)  # Convertir a formato de imagen
+                    face_image = Image.fromarray(face_array)  # Convertir el array en una imagen PIL
+                    face_image.save(trabajo.ruta(f"foto{i}.jpg"))  # Guardar la imagen
+                    lista_rutas.append(trabajo.ruta(f"foto{i}.jpg"))  # Añadir la ruta a la lista
     
     except Exception as e:
         print(f"Error detecting faces: {e}")
         # En caso de error, usar la imagen original
-        shutil.copy(ruta_front, "personas/foto0.jpg")
-        lista_rutas = ["personas/foto0.jpg"]
+        shutil.copy(ruta_front, trabajo.ruta("foto0.jpg"))
+        lista_rutas = [trabajo.ruta("foto0.jpg")]
     
     return lista_rutas
 
-def hacer_json(lista_personas, n, lista_ruta_famosos, lista_nombre_famosos, lista_parecidos):
+def hacer_json(trabajo, lista_personas, n, lista_ruta_famosos, lista_nombre_famosos, lista_parecidos):
     """
-    Crea un archivo JSON con la información de las personas detectadas y sus coincidencias.
+    Crea el resultado (serializable a JSON) de una persona detectada y sus coincidencias.
     
+    :param trabajo: Trabajo al que pertenece la captura.
     :param lista_personas: Lista de rutas de las imágenes de las personas detectadas.
     :param n: Índice de la persona actual en la lista.
     :param lista_ruta_famosos: Lista de rutas de las imágenes de los famosos parecidos.
     :param lista_nombre_famosos: Lista de nombres de los famosos parecidos.
     :param lista_parecidos: Lista de porcentajes de similitud con los famosos.
+    :return: Diccionario con la persona y sus coincidencias.
     """
     # Siempre usar la imagen original para mostrar en el cuadrado pequeño
-    original_image = "personas/foto.jpg"
+    original_image = trabajo.ruta("foto.jpg")
     
     if len(lista_personas) > 1:
         data = {
@@ -256,12 +353,7 @@ def hacer_json(lista_personas, n, lista_ruta_famosos, lista_nombre_famosos, list
                 "image_data": lista_ruta_famosos[i]  # Ruta de la imagen del famoso
             })
 
-    # Convertir el diccionario a formato JSON
-    json_data = json.dumps(data, indent=4)
-
-    # Escribir el JSON en un archivo
-    with open(f"personas/json_persona{n+1}.json", "w") as json_file:
-        json_file.write(json_data)
+    return data
 
 def sacar_nombre_ruta(lista_nombres):
     """
@@ -280,28 +372,47 @@ def sacar_nombre_ruta(lista_nombres):
         nombres.append(nombre)
     return nombres
 
+# Listado de face-db en memoria; solo se vuelve a leer si cambia la fecha de la carpeta
+_face_db = {"version": None, "imagenes": []}
+
+def imagenes_face_db():
+    """
+    Devuelve las rutas de las imágenes de face-db sin listar la carpeta en cada búsqueda.
+    
+    :return: Lista de rutas de las imágenes de la base de datos de caras.
+    """
+    version = os.stat('face-db').st_mtime_ns
+    if _face_db["version"] != version:
+        _face_db["imagenes"] = [os.path.join('face-db', f) for f in sorted(os.listdir('face-db'))
+                                if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
+        _face_db["version"] = version
+    return _face_db["imagenes"]
+
 def encontrar_3_mas_parecidos(ruta):
     """
     Encuentra las 3 imágenes más parecidas en la base de datos de caras.
     
     :param ruta: Ruta de la imagen de la persona a comparar.
-    :return: Lista de rutas de las imágenes más parecidas y sus porcentajes de similitud.
+    :return: Lista de rutas de las imágenes más parecidas, sus porcentajes de similitud y la lista
+             ordenada de coincidencias reales (sin repetir) para mostrar más.
     """
-    start_time = time.time()
-    print(f"Searching {ruta} in {len(os.listdir('face-db'))} length datastore")
+    # Obtener todas las imágenes disponibles en face-db
+    all_images = imagenes_face_db()
+    logger.debug(f"Searching {ruta} in {len(all_images)} length datastore")
     
     # Verificar que la base de datos tenga al menos 3 imágenes
-    if len([f for f in os.listdir('face-db') if f.lower().endswith(('.jpg', '.jpeg', '.png'))]) < 3:
+    if len(all_images) < 3:
         print("face-db has less than 3 images, adding sample images")
-        add_sample_images_to_db()
-    
-    # Obtener todas las imágenes disponibles en face-db
-    all_images = [os.path.join('face-db', f) for f in os.listdir('face-db') 
-                 if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
+        add_sample_images_to_db(ruta)
+        all_images = imagenes_face_db()
     
+    candidatos = []
     try:
-        # Intentar encontrar coincidencias
-        search = DeepFace.find(img_path=ruta, db_path="face-db/", model_name="VGG-Face", enforce_detection=False)
+        # Intentar encontrar coincidencias (DeepFace.find calcula el embedding y busca en la misma llamada)
+        # DeepFace (TensorFlow) se importa en el primer uso para que el servidor arranque sin cargarlo
+        from deepface import DeepFace
+        with metricas.etapa("search"):
+            search = DeepFace.find(img_path=ruta, db_path="face-db/", model_name=MODELO, enforce_detection=False)
         df = pd.concat(search, ignore_index=True) if search else pd.DataFrame()
         
         if df.empty:
@@ -320,6 +431,13 @@ def encontrar_3_mas_parecidos(ruta):
             # Calcular porcentajes de similitud para todas las rutas disponibles
             available_similarities = list(round(((1 - df_sorted['distance']) * 100), 2))
             
+            # Lista ordenada que guarda el trabajo para "ver más", sin los repetidos de relleno
+            vistas = set()
+            for path, similarity in zip(available_paths, available_similarities):
+                if path not in vistas and len(candidatos) < MAX_CANDIDATOS:
+                    vistas.add(path)
+                    candidatos.append({"similarity": float(similarity), "source": path})
+            
             # Si hay menos de 3 coincidencias reales, completar con las que tenemos
             if len(available_paths) < 3:
                 # Asegurarse de que tenemos suficientes imágenes para mostrar
@@ -347,8 +465,7 @@ def encontrar_3_mas_parecidos(ruta):
         rutas_imagen = rutas_imagen[:3]  # Truncar a 3 si hay más
         porcentage_parecidos = porcentage_parecidos[:3]
         
-    print(f"find function duration {time.time() - start_time} seconds")
-    print(f"Returning {len(rutas_imagen)} images with similarities: {porcentage_parecidos}")
+    logger.debug(f"Returning {len(rutas_imagen)} images with similarities: {porcentage_parecidos}")
     
     # Aunque es improbable que lleguemos aquí con menos de 3, verificamos por seguridad
     while len(rutas_imagen) < 3:
@@ -358,11 +475,13 @@ def encontrar_3_mas_parecidos(ruta):
                 rutas_imagen.append(img)
                 porcentage_parecidos.append(max(10.0, min(porcentage_parecidos) * 0.9 if porcentage_parecidos else 20.0))
     
-    return rutas_imagen, porcentage_parecidos
+    return rutas_imagen, porcentage_parecidos, candidatos
 
-def add_sample_images_to_db():
+def add_sample_images_to_db(ruta_consulta):
     """
     Añade imágenes de muestra a la base de datos si está vacía
+    
+    :param ruta_consulta: Imagen con la que DeepFace construye la representación de la base.
     """
     # crear imagen 2
 
@@ -391,9 +510,10 @@ def add_sample_images_to_db():
         
     # Crear una representación de la base de datos para DeepFace
     print("Creating DeepFace database representation...")
+    from deepface import DeepFace
     try:
-        DeepFace.build_model("VGG-Face")
-        representations = DeepFace.find(img_path="personas/foto.jpg", db_path="face-db/", model_name="VGG-Face", enforce_detection=False)
+        DeepFace.build_model(MODELO)
+        representations = DeepFace.find(img_path=ruta_consulta, db_path="face-db/", model_name=MODELO, enforce_detection=False)
         print("DeepFace database representation created successfully")
     except Exception as e:
         print(f"Error creating DeepFace database representation: {e}")
@@ -402,57 +522,43 @@ def add_sample_images_to_db():
             for file in os.listdir('face-db'):
                 if file.endswith('.jpg'):
                     img_path = os.path.join('face-db', file)
-                    DeepFace.represent(img_path=img_path, model_name="VGG-Face", enforce_detection=False)
+                    DeepFace.represent(img_path=img_path, model_name=MODELO, enforce_detection=False)
             print("DeepFace database representation created using alternative method")
         except Exception as e2:
             print(f"Error creating DeepFace database using alternative method: {e2}")
 
-def procesar_imagen(original_path):
-    """Process the image and return the results"""
-    lista_personas = detectar_personas(original_path)
+def procesar_imagen(original_path, trabajo, imagen=None, nivel=None, origen=None):
+    """Process the image and return the results and the ranked candidates of each detected face"""
+    # Source (kiosk) whose turns of the fair scheduler this capture uses (planificador.py)
+    origen = origen or trabajo.id
+    # Quality tier chosen for the latency budget (calidad.py): detection on a downscaled photo
+    nivel = nivel or control_calidad.niveles[0]
+    if nivel.lado_deteccion is not None:
+        imagen = nivel.imagen_deteccion(imagen if imagen is not None else cv2.imread(original_path))
+    trabajo.comprobar_cancelacion("detection")
+    with planificador.turno(origen, al_esperar=lambda: trabajo.comprobar_cancelacion("detection")):
+        lista_personas = detectar_personas(original_path, trabajo, imagen)
+    trabajo.cambiar_estado("buscando")
     results = []
+    candidatos = []
     for i in range(len(lista_personas)):
-        lista_ruta_famosos, lista_parecidos = encontrar_3_mas_parecidos(lista_personas[i])
+        # Stop before the next DeepFace.find if the visitor left
+        trabajo.comprobar_cancelacion("search", len(lista_personas) - i)
+        # One turn per face, so other captures can be served between the faces of a group photo
+        with planificador.turno(origen, al_esperar=lambda: trabajo.comprobar_cancelacion("search",
+                                                                                         len(lista_personas) - i)):
+            lista_ruta_famosos, lista_parecidos, ranking = encontrar_3_mas_parecidos(lista_personas[i])
         lista_nombre_famosos = sacar_nombre_ruta(lista_ruta_famosos)
-        hacer_json(lista_personas, i, lista_ruta_famosos, lista_nombre_famosos, lista_parecidos)
-        
-        # Create a result object for this person
-        person_result = {
-            "persona": original_path,  # Ruta de la imagen original
-            "cara_detectada": lista_personas[i],  # Ruta de la cara detectada
-            "matches": []
-        }
-        
-        for j in range(len(lista_nombre_famosos)):
-            person_result["matches"].append({
-                "name": lista_nombre_famosos[j],
-                "similarity": lista_parecidos[j],
-                "image_data": lista_ruta_famosos[j]
-            })
-        
-        results.append(person_result)
+        resultado = hacer_json(trabajo, lista_personas, i, lista_ruta_famosos, lista_nombre_famosos, lista_parecidos)
+        resultado["ranked_matches"] = len(ranking)
+        resultado["qos_tier"] = nivel.nombre
+        results.append(resultado)
+        candidatos.append(ranking)
     
-    return results
-
-def borrar_contenido_carpeta_flask(carpeta):
-    """
-    Borra el contenido de una carpeta (versión para Flask)
-    
-    :param carpeta: Ruta de la carpeta a borrar
-    """
-    if os.path.exists(carpeta) and os.path.isdir(carpeta):
-        for archivo in os.listdir(carpeta):
-            archivo_path = os.path.join(carpeta, archivo)
-            try:
-                if os.path.isdir(archivo_path):
-                    shutil.rmtree(archivo_path)  # Borrar subcarpeta
-                else:
-                    os.remove(archivo_path)  # Borrar archivo
-            except Exception as e:
-                print(f"No se pudo borrar {archivo_path}: {e}")
-        print(f"Contenido de la carpeta '{carpeta}' ha sido borrado.")
-    else:
-        print(f"La carpeta {carpeta} no existe o no es una carpeta válida.")
+    return results, candidatos
 
 if __name__ == '__main__':
-    app.run(debug=True) 
+    # Development server only (production: gunicorn -c gunicorn.conf.py wsgi:app).
+    # The reloader runs a second process that loads everything again, so it is opt-in.
+    app.run(debug=True, use_reloader=os.environ.get("CELEBRIA_RELOAD", "0") == "1")
+
@@ -0,0 +1,335 @@
+"""
+Variante asíncrona (ASGI) de la API web, con Quart.
+
+    hypercorn asgi:app --bind 0.0.0.0:5000
+
+Sirve las mismas rutas y plantillas (Frontend/Templates) que el backend
+seleccionado con CELEBRIA_BACKEND ("imdb" por defecto, o "app"), pero separa
+el trabajo por tipo:
+
+- Las rutas de E/S (/get_results, /more_results, /process_status, /face-db,
+  /personas y las páginas) se atienden en el bucle de eventos. Sus lecturas de disco van a un
+  pool de E/S propio, limitado a CELEBRIA_IO_WORKERS operaciones a la vez.
+- /process_image ejecuta la inferencia en un pool de hilos dedicado. Como
+  mucho se admiten CELEBRIA_INFERENCE_QUEUE capturas (en curso o esperando); a
+  partir de ahí se responde 503 en lugar de acumular trabajo que el visitante
+  no va a esperar.
+  Las capturas admitidas no esperan por orden de llegada: todas entran en el
+  pool y el planificador (planificador.py) deja trabajar a
+  CELEBRIA_INFERENCE_WORKERS unidades a la vez (detección o una cara), por
+  turnos justos entre photocalls. Una foto de grupo ya no retrasa todas sus
+  caras a las capturas de una sola cara que llegan detrás. Una captura
+  cancelada (/cancel_processing, ver trabajos.py) mientras espera turno sale de
+  la cola sin procesar nada.
+
+Así una ráfaga de capturas no deja sin servir las imágenes de la página de
+resultados de otros visitantes. El perfilado por petición (perfilador.py) y los
+endpoints /admin/index solo están disponibles en la variante WSGI; la recarga
+del índice con CELEBRIA_INDEX_WATCH (indices.py) funciona en las dos.
+
+Variables de entorno:
+- CELEBRIA_INFERENCE_WORKERS: unidades de inferencia a la vez (1 por defecto);
+  CELEBRIA_SCHEDULER_SLOTS, si se define, manda sobre este valor. Con
+  CELEBRIA_BATCH_WINDOW_MS (lotes.py) las caras no piden turno y las de todas
+  las capturas admitidas pueden compartir lote.
+- CELEBRIA_INFERENCE_QUEUE: capturas admitidas a la vez (4 por defecto).
+- CELEBRIA_IO_WORKERS: operaciones de disco simultáneas (16 por defecto).
+- CELEBRIA_SIMULATED_MODEL=1: usar modelo_simulado.py en lugar de DeepFace.
+"""
+import asyncio
+import mimetypes
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+if os.environ.get("CELEBRIA_SIMULATED_MODEL", "0") == "1":
+    from modelo_simulado import instalar_desde_entorno
+    instalar_desde_entorno(ocupar_cpu=True)
+
+from quart import Quart, Response, abort, g, jsonify, render_template, request, send_file
+
+import metricas
+from backends import cargar_backend
+from estaticos import (aplicar_cache_estatico, aplicar_cache_imagen, elegir_variante, etag_archivo,
+                       precomprimir, registrar_huellas, resolver_ruta)
+from miniaturas import obtener_miniatura, variante_pedida
+from planificador import PLAZAS, planificador
+from trabajos import COOKIE, registro
+
+BACKEND = os.environ.get("CELEBRIA_BACKEND", "imdb")
+HILOS_INFERENCIA = int(os.environ.get("CELEBRIA_INFERENCE_WORKERS", "1"))
+COLA_INFERENCIA = int(os.environ.get("CELEBRIA_INFERENCE_QUEUE", "4"))
+HILOS_ES = int(os.environ.get("CELEBRIA_IO_WORKERS", "16"))
+
+# Importar el backend carga el índice de famosos y crea las carpetas de trabajo
+backend = cargar_backend(BACKEND)
+
+app = Quart(__name__,
+            static_folder='Frontend/Static',
+            template_folder='Frontend/Templates')
+
+# Every admitted capture gets a thread; the scheduler decides which ones run (see planificador.py)
+if PLAZAS <= 0:
+    planificador.configurar(HILOS_INFERENCIA)
+_pool_inferencia = ThreadPoolExecutor(max_workers=max(HILOS_INFERENCIA, COLA_INFERENCIA),
+                                      thread_name_prefix="inferencia")
+_pool_es = ThreadPoolExecutor(max_workers=HILOS_ES, thread_name_prefix="es")
+_limite_es = asyncio.Semaphore(HILOS_ES)
+_capturas_admitidas = 0
+
+# Fingerprinted, precompressed static assets (see estaticos.py)
+precomprimir(app.static_folder)
+registrar_huellas(app)
+
+
+async def en_inferencia(funcion, *args):
+    """
+    Ejecuta una función de inferencia en el pool dedicado sin bloquear el bucle de eventos.
+
+    :param funcion: Función síncrona del backend.
+    :return: Lo que devuelva la función.
+    """
+    return await asyncio.get_running_loop().run_in_executor(_pool_inferencia, funcion, *args)
+
+
+async def en_es(funcion, *args):
+    """
+    Ejecuta una operación de disco en el pool de E/S, respetando su límite de concurrencia.
+
+    :param funcion: Función síncrona que lee o escribe archivos.
+    :return: Lo que devuelva la función.
+    """
+    async with _limite_es:
+        return await asyncio.get_running_loop().run_in_executor(_pool_es, funcion, *args)
+
+
+async def enviar_archivo(ruta, enviada=None):
+    """
+    Envía un archivo respondiendo 304 si el navegador ya tiene la misma versión.
+
+    :param ruta: Ruta del archivo original (determina el tipo MIME).
+    :param enviada: Ruta de la variante a enviar (por ejemplo, la precomprimida).
+    :return: Respuesta de Quart.
+    """
+    enviada = enviada or ruta
+    etag = await en_es(etag_archivo, enviada)
+    if request.if_none_match.contains(etag):
+        response = Response(b"", status=304)
+    else:
+        async with _limite_es:
+            response = await send_file(enviada, mimetype=mimetypes.guess_type(ruta)[0])
+    response.set_etag(etag)
+    return response
+
+
+async def enviar_imagen(carpeta, filename):
+    """
+    Envía una imagen de face-db o personas, reducida o recodificada si el navegador lo pide.
+
+    :param carpeta: 'face-db' o 'personas'.
+    :param filename: Ruta relativa de la imagen.
+    :return: Respuesta de Quart.
+    """
+    ruta = resolver_ruta(carpeta, filename)
+    if ruta is None:
+        abort(404)
+    variante = variante_pedida(request.args, request.accept_mimetypes)
+    datos = None
+    if variante is not None:
+        try:
+            datos, tipo, clave = await en_es(obtener_miniatura, ruta, *variante)
+        except ValueError:
+            # OpenCV can't decode the file (damaged or half-written): send the original instead of a 500
+            datos = None
+    if datos is None:
+        response = await enviar_archivo(ruta)
+    else:
+        if request.if_none_match.contains(clave):
+            response = Response(b"", status=304)
+        else:
+            response = Response(datos, mimetype=tipo)
+        response.set_etag(clave)
+    response.vary.add("Accept")
+    return aplicar_cache_imagen(response, carpeta)
+
+
+async def trabajo_actual():
+    """
+    Devuelve el trabajo del navegador que hace la petición, creándolo si no tiene.
+
+    Buscarlo lee su estado del disco y crearlo lo escribe, así que se hace en el pool de E/S.
+
+    :return: Trabajo (ver trabajos.py).
+    """
+    if 'trabajo' not in g:
+        g.trabajo = await en_es(registro.obtener_o_crear, request.cookies.get(COOKIE))
+    return g.trabajo
+
+
+@app.before_serving
+async def _calentar_modelos():
+    # The first capture (and the first one that degrades to CELEBRIA_QOS_MODEL) shouldn't pay the model load
+    calentar = getattr(backend, "calentar_modelos", None)
+    if calentar is not None:
+        await en_inferencia(calentar)
+
+
+@app.after_request
+async def _enviar_cookie_trabajo(response):
+    trabajo = g.get('trabajo')
+    if trabajo is not None and request.cookies.get(COOKIE) != trabajo.id:
+        response.set_cookie(COOKIE, trabajo.id, httponly=True, samesite='Lax')
+    return response
+
+
+@app.before_request
+async def _iniciar_medicion():
+    g.metricas_inicio = time.perf_counter()
+
+
+@app.after_request
+async def _registrar_peticion(response):
+    if not metricas.ACTIVADAS:
+        return response
+    inicio = g.pop('metricas_inicio', None)
+    endpoint = request.endpoint or "unknown"
+    if inicio is not None and endpoint != "metrics":
+        metricas.observar(f"http_{endpoint}", time.perf_counter() - inicio)
+    metricas.incrementar("http_requests_total", endpoint=endpoint, status=response.status_code)
+    return response
+
+
+@app.route('/')
+async def index():
+    """Render the main page with webcam capture"""
+    return await render_template('index.html')
+
+
+@app.route('/carga')
+async def carga():
+    """Render the loading page"""
+    return await render_template('carga.html')
+
+
+@app.route('/resultado')
+async def resultado():
+    """Render the results page"""
+    return await render_template('resultado.html')
+
+
+@app.route('/process_image', methods=['POST'])
+async def process_image():
+    """Process the captured image in the inference pool and find celebrity matches"""
+    global _capturas_admitidas
+    if _capturas_admitidas >= COLA_INFERENCIA:
+        metricas.incrementar("inference_rejected_total")
+        return jsonify({"success": False, "error": "Server busy, please try again"}), 503, {"Retry-After": "5"}
+
+    _capturas_admitidas += 1
+    try:
+        # The latency budget (calidad.py) includes the wait for an inference thread
+        llegada = time.monotonic()
+        datos = await request.get_json()
+        # Before queueing, so a visitor who leaves while waiting for a thread frees it at once (trabajos.py)
+        trabajo = await trabajo_actual()
+        trabajo.nueva_captura()
+        return jsonify(await en_inferencia(backend.procesar_peticion, datos, trabajo, llegada))
+    finally:
+        _capturas_admitidas -= 1
+
+
+@app.route('/get_results')
+async def get_results():
+    """Get the results of the current capture job"""
+    return jsonify(await en_es(backend.leer_resultados, await trabajo_actual()))
+
+
+@app.route('/process_status', methods=['GET'])
+async def process_status():
+    """Check the status of the image processing"""
+    # Reads the job from disk and touches its heartbeat file (trabajos.py)
+    return jsonify(await en_es(backend.estado_procesamiento, await trabajo_actual()))
+
+
+@app.route('/cancel_processing', methods=['POST'])
+async def cancel_processing():
+    """Cancel the capture being processed, because the visitor left or gave up waiting"""
+    return jsonify(await en_es(backend.cancelar_procesamiento, await trabajo_actual()))
+
+
+@app.route('/clear_data', methods=['POST'])
+async def clear_data():
+    """Drop the current capture job and start a new one"""
+    respuesta, g.trabajo = await en_es(backend.limpiar_datos, await trabajo_actual())
+    return jsonify(respuesta)
+
+
+async def static(filename):
+    """Serve static assets with fingerprint caching and precompressed variants"""
+    ruta = resolver_ruta(app.static_folder, filename)
+    if ruta is None:
+        abort(404)
+    enviada, codificacion = elegir_variante(ruta, request.accept_encodings)
+    response = await enviar_archivo(ruta, enviada)
+    return aplicar_cache_estatico(response, ruta, codificacion, request.args.get('v'))
+
+
+app.view_functions['static'] = static
+
+
+@app.route('/face-db/<path:filename>')
+async def serve_image(filename):
+    """Serve images from the face-db directory, resized and re-encoded on request"""
+    with metricas.etapa("image_serving"):
+        return await enviar_imagen('face-db', filename)
+
+
+@app.route('/personas/<path:filename>')
+async def serve_persona_image(filename):
+    """Serve images from the personas directory, resized and re-encoded on request"""
+    with metricas.etapa("image_serving"):
+        return await enviar_imagen('personas', filename)
+
+
+if hasattr(backend, "generar_tarjeta"):
+    @app.route('/result_card/<int:n>')
+    async def result_card(n):
+        """Render the shareable result card for a detected face"""
+        try:
+            card = await en_es(backend.generar_tarjeta, await trabajo_actual(), n)
+            if card is None:
+                return jsonify({"success": False, "error": "Result not found"}), 404
+            return Response(card, mimetype='image/jpeg')
+        except Exception as e:
+            print(f"Error in result_card: {str(e)}")
+            return jsonify({"success": False, "error": str(e)}), 500
+
+
+if hasattr(backend, "mas_resultados"):
+    @app.route('/more_results/<int:n>')
+    async def more_results(n):
+        """Get the next page of ranked lookalikes for a detected face"""
+        trabajo = await trabajo_actual()
+        try:
+            pagina = await en_es(backend.mas_resultados, trabajo, n, request.args.get('cursor'),
+                                 request.args.get('limit', 3, type=int))
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+        if pagina is None:
+            return jsonify({"success": False, "error": "Result not found"}), 404
+        return jsonify(pagina)
+
+
+@app.route('/metrics')
+async def metrics():
+    """Expose the collected metrics in Prometheus format"""
+    if not metricas.ACTIVADAS:
+        texto = "# Metrics are disabled. Set CELEBRIA_METRICS=1 to enable them.\n"
+    else:
+        metricas.fijar("inference_admitted", _capturas_admitidas)
+        texto = metricas.exportar_prometheus()
+    return Response(texto, mimetype='text/plain; version=0.0.4')
+
+
+if __name__ == "__main__":
+    app.run(debug=True, use_reloader=False)
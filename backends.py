@@ -0,0 +1,39 @@
+"""
+Carga de los backends Flask por nombre.
+
+El backend IMDB vive en un archivo con guiones (imdb-experimental-backend.py),
+que no se puede importar con una sentencia import normal.
+"""
+import importlib.util
+import os
+import sys
+
+DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+
+BACKENDS = {
+    "app": "app.py",
+    "imdb": "imdb-experimental-backend.py",
+}
+
+
+def cargar_backend(nombre):
+    """
+    Importa un backend y devuelve su módulo (la aplicación Flask está en modulo.app).
+
+    :param nombre: Nombre del backend ("app" o "imdb").
+    :return: Módulo del backend ya importado.
+    """
+    if nombre not in BACKENDS:
+        raise ValueError(f"Unknown backend '{nombre}'. Choose one of: {', '.join(BACKENDS)}")
+
+    nombre_modulo = f"celebria_backend_{nombre}"
+    if nombre_modulo in sys.modules:
+        return sys.modules[nombre_modulo]
+
+    if DIRECTORIO not in sys.path:
+        sys.path.insert(0, DIRECTORIO)
+    spec = importlib.util.spec_from_file_location(nombre_modulo, os.path.join(DIRECTORIO, BACKENDS[nombre]))
+    modulo = importlib.util.module_from_spec(spec)
+    sys.modules[nombre_modulo] = modulo
+    spec.loader.exec_module(modulo)
+    return modulo
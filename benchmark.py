@@ -0,0 +1,1012 @@
+"""
+Benchmarks de las rutas críticas de búsqueda y del pipeline completo.
+
+Genera bases de datos sintéticas de embeddings con el mismo formato que
+representations.pkl y caras sintéticas, y mide tiempos de carga, latencia de
+búsqueda por consulta y por lotes, memoria y el rendimiento de /process_image a
+través del cliente de pruebas de Flask con un modelo simulado. Los resultados se
+guardan en JSON para poder comparar ejecuciones.
+
+Ejemplos:
+    python benchmark.py search --sizes 10000,100000 --dims 128,2622
+    python benchmark.py mmap --rows 1000000 --dim 128 --chunk_mb 64 --threads 1,4
+    python benchmark.py shards --rows 200000 --shards 4
+    python benchmark.py reduction --dims 64,128,256 --candidates 256,1024
+    python benchmark.py prototypes --methods mean,medoids --refine 0,8
+    python benchmark.py pipeline --backend imdb --requests 50
+    python benchmark.py reload --requests 200 --reloads 5
+    python benchmark.py detectors --images fotos_prueba --cascades haar+retinaface,haar+mtcnn
+    python benchmark.py models --models VGG-Face,Facenet,ArcFace --photos fotos_prueba
+"""
+import argparse
+import base64
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+import pandas as pd
+
+DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(DIRECTORIO, 'imdb-wiki'))
+
+from modelo_simulado import instalar_modelo_simulado, generar_cara_sintetica
+
+
+def _rss_mb():
+    """
+    Memoria residente actual del proceso en MB.
+
+    :return: RSS en MB (0 si no se puede leer en esta plataforma).
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for linea in f:
+                if linea.startswith('VmRSS:'):
+                    return int(linea.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+def _pico_rss_mb():
+    """
+    Pico de memoria residente del proceso en MB (VmHWM), desde que arrancó o desde _reiniciar_pico_rss().
+
+    :return: Pico de RSS en MB.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for linea in f:
+                if linea.startswith('VmHWM:'):
+                    return int(linea.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss está en KB en Linux y en bytes en macOS
+    return pico / 2**20 if sys.platform == 'darwin' else pico / 1024
+
+
+def _reiniciar_pico_rss():
+    """
+    Baja el pico de memoria residente al RSS actual, para medir solo lo que viene después.
+
+    Solo en Linux (/proc/self/clear_refs); en otras plataformas el pico sigue contando desde el arranque.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _percentiles(tiempos):
+    """
+    Resume una lista de duraciones en segundos.
+
+    :param tiempos: Lista de duraciones.
+    :return: Diccionario con media y p50/p95/p99 en milisegundos.
+    """
+    if not tiempos:
+        return {}
+    ms = np.array(tiempos) * 1000
+    return {
+        "mean_ms": round(float(ms.mean()), 3),
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p95_ms": round(float(np.percentile(ms, 95)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+    }
+
+
+@contextmanager
+def _directorio_trabajo():
+    """Crea un directorio temporal, entra en él y vuelve al original al salir."""
+    anterior = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="celebria-bench-") as tmp:
+        os.chdir(tmp)
+        try:
+            yield tmp
+        finally:
+            os.chdir(anterior)
+
+
+def generar_embeddings(n, dim, semilla=0, bloque=100000):
+    """
+    Genera una matriz de embeddings sintéticos agrupados por identidad.
+
+    :param n: Número de filas (imágenes de famosos).
+    :param dim: Dimensión de cada embedding.
+    :param semilla: Semilla aleatoria.
+    :param bloque: Filas generadas por iteración para limitar la memoria temporal.
+    :return: Matriz float32 de forma (n, dim) e identidad de cada fila.
+    """
+    rng = np.random.default_rng(semilla)
+    n_identidades = max(1, n // 8)
+    centros = rng.standard_normal((n_identidades, dim)).astype(np.float32)
+    identidades = rng.integers(0, n_identidades, n)
+    matriz = np.empty((n, dim), dtype=np.float32)
+    for inicio in range(0, n, bloque):
+        fin = min(n, inicio + bloque)
+        ruido = rng.standard_normal((fin - inicio, dim)).astype(np.float32) * 0.5
+        matriz[inicio:fin] = centros[identidades[inicio:fin]] + ruido
+    return matriz, identidades
+
+
+def generar_dataframe(matriz, identidades, semilla=0):
+    """
+    Construye un DataFrame con el mismo esquema que representations.pkl.
+
+    :param matriz: Embeddings sintéticos.
+    :param identidades: Identidad de cada fila.
+    :param semilla: Semilla para el género de cada identidad.
+    :return: DataFrame con celebrity_name, gender, full_path y face_vector_raw.
+    """
+    rng = np.random.default_rng(semilla)
+    generos = rng.integers(0, 2, identidades.max() + 1).astype(float)
+    return pd.DataFrame({
+        "celebrity_name": [f"Celebrity {i}" for i in identidades],
+        "gender": generos[identidades],
+        "full_path": [np.array([f"{i % 100:02d}/celebrity_{i}_{fila}.jpg"]) for fila, i in enumerate(identidades)],
+        "face_vector_raw": [[{"embedding": fila.tolist()}] for fila in matriz],
+    })
+
+
+def escribir_imagenes_sinteticas(df, imdb_path):
+    """
+    Escribe una cara sintética por cada ruta de df para que los backends puedan copiarlas.
+
+    :param df: DataFrame con la columna full_path.
+    :param imdb_path: Directorio raíz de las imágenes.
+    """
+    for i, full_path in enumerate(df['full_path']):
+        ruta = os.path.join(imdb_path, full_path[0])
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        cv2.imwrite(ruta, generar_cara_sintetica(i, 128))
+
+
+def busqueda_matricial(matriz_normalizada, consultas, top_n=3):
+    """
+    Búsqueda exacta de referencia con un producto de matrices.
+
+    :param matriz_normalizada: Embeddings de la base con norma 1.
+    :param consultas: Matriz (q, dim) de consultas.
+    :param top_n: Número de resultados por consulta.
+    :return: Índices de los top_n más parecidos para cada consulta.
+    """
+    consultas = consultas / np.linalg.norm(consultas, axis=1, keepdims=True)
+    similitudes = consultas @ matriz_normalizada.T
+    candidatos = np.argpartition(-similitudes, top_n, axis=1)[:, :top_n]
+    return np.take_along_axis(candidatos, np.argsort(-np.take_along_axis(similitudes, candidatos, axis=1), axis=1), axis=1)
+
+
+def benchmark_busqueda(n, dim, consultas, lote, max_filas_legacy):
+    """
+    Mide carga, latencia y memoria de las implementaciones de búsqueda para un tamaño de base.
+
+    :param n: Número de embeddings de la base.
+    :param dim: Dimensión de los embeddings.
+    :param consultas: Número de consultas individuales a medir.
+    :param lote: Tamaño del lote para la búsqueda por lotes.
+    :param max_filas_legacy: Límite de filas para las implementaciones basadas en listas de Python.
+    :return: Diccionario con los resultados.
+    """
+    resultado = {"benchmark": "search", "rows": n, "dim": dim}
+    _reiniciar_pico_rss()
+    rss_inicial = _rss_mb()
+    matriz, identidades = generar_embeddings(n, dim)
+    rng = np.random.default_rng(1)
+    vectores_consulta = matriz[rng.integers(0, n, max(consultas, lote))] + rng.standard_normal((max(consultas, lote), dim)).astype(np.float32) * 0.3
+
+    with _directorio_trabajo():
+        # Matriz NumPy de referencia (.npy)
+        np.save("embeddings.npy", matriz)
+        inicio = time.perf_counter()
+        cargada = np.load("embeddings.npy")
+        resultado["npy_load_s"] = round(time.perf_counter() - inicio, 4)
+        normalizada = cargada / np.linalg.norm(cargada, axis=1, keepdims=True)
+        resultado["matrix_bytes_mb"] = round(normalizada.nbytes / 2**20, 2)
+
+        tiempos = []
+        for q in vectores_consulta[:consultas]:
+            inicio = time.perf_counter()
+            busqueda_matricial(normalizada, q[None, :])
+            tiempos.append(time.perf_counter() - inicio)
+        resultado["matrix_query"] = _percentiles(tiempos)
+
+        inicio = time.perf_counter()
+        busqueda_matricial(normalizada, vectores_consulta[:lote])
+        duracion = time.perf_counter() - inicio
+        resultado["matrix_batch"] = {"batch_size": lote, "total_ms": round(duracion * 1000, 3),
+                                     "per_query_ms": round(duracion * 1000 / lote, 3)}
+        del cargada, normalizada
+
+        if n > max_filas_legacy:
+            resultado["legacy"] = f"skipped (rows > {max_filas_legacy})"
+            resultado["peak_rss_growth_mb"] = round(_pico_rss_mb() - rss_inicial, 2)
+            return resultado
+
+        # DataFrame con el formato de representations.pkl (celebrity2.find_similar_celebrities)
+        import celebrity2
+        df = generar_dataframe(matriz, identidades)
+        df.to_pickle("representations.pkl")
+        del df
+        rss_antes = _rss_mb()
+        inicio = time.perf_counter()
+        df = celebrity2.load_embeddings("representations.pkl")
+        resultado["pkl_load_s"] = round(time.perf_counter() - inicio, 4)
+        resultado["pkl_rss_mb"] = round(_rss_mb() - rss_antes, 2)
+
+        tiempos = []
+        for q in vectores_consulta[:consultas]:
+            inicio = time.perf_counter()
+            celebrity2.find_similar_celebrities([{"embedding": q.tolist()}], df, top_n=3)
+            tiempos.append(time.perf_counter() - inicio)
+        resultado["find_similar_celebrities"] = _percentiles(tiempos)
+
+        # Lista de diccionarios con el formato de embeddings_famosos.json (proyecto_paellas)
+        import proyecto_paellas
+        embeddings_final = [{"ruta": f"famoso_{i}.jpg", "embedding": fila.tolist()} for i, fila in enumerate(matriz)]
+        tiempos = []
+        for q in vectores_consulta[:consultas]:
+            inicio = time.perf_counter()
+            proyecto_paellas.encontrar_tres_mas_parecidos(q.tolist(), embeddings_final)
+            tiempos.append(time.perf_counter() - inicio)
+        resultado["encontrar_tres_mas_parecidos"] = _percentiles(tiempos)
+
+    resultado["peak_rss_growth_mb"] = round(_pico_rss_mb() - rss_inicial, 2)
+    return resultado
+
+
+def benchmark_mmap(n, dim, consultas, lote, chunk_mb, hilos, bloque=100000):
+    """
+    Mide la búsqueda exacta por bloques sobre un índice en disco (MmapCelebrityIndex).
+
+    La matriz sintética se escribe por bloques directamente en el formato de
+    build_mmap_index, así que la base puede ser mayor que la memoria. Mide la
+    latencia por consulta y por lotes, cuánto crece la memoria residente durante
+    las búsquedas y, si la matriz cabe en un solo bloque de 1 GB, compara los
+    resultados con los de recorrerla entera de una vez.
+
+    :param n: Número de embeddings de la base.
+    :param dim: Dimensión de los embeddings.
+    :param consultas: Número de consultas individuales a medir.
+    :param lote: Tamaño del lote para la búsqueda por lotes.
+    :param chunk_mb: MB de la matriz por bloque.
+    :param hilos: Hilos que recorren los bloques.
+    :param bloque: Filas generadas por iteración al escribir la base.
+    :return: Diccionario con los resultados.
+    """
+    from celebrity_index import CelebrityIndex
+    resultado = {"benchmark": "mmap", "rows": n, "dim": dim, "chunk_mb": chunk_mb, "threads": hilos,
+                 "matrix_mb": round(n * dim * 4 / 2**20, 2)}
+    rng = np.random.default_rng(0)
+    n_identidades = max(1, n // 8)
+    centros = rng.standard_normal((n_identidades, dim)).astype(np.float32)
+    identidades = rng.integers(0, n_identidades, n)
+
+    with _directorio_trabajo():
+        inicio = time.perf_counter()
+        with open("indice_mmap.f32", "wb") as f:
+            for desde in range(0, n, bloque):
+                hasta = min(n, desde + bloque)
+                filas = centros[identidades[desde:hasta]] + rng.standard_normal((hasta - desde, dim)).astype(np.float32) * 0.5
+                f.write((filas / np.linalg.norm(filas, axis=1, keepdims=True)).astype(np.float32).tobytes())
+        generos = rng.integers(0, 2, n_identidades).astype(float)
+        df = pd.DataFrame({
+            "celebrity_name": [f"Celebrity {i}" for i in identidades],
+            "gender": generos[identidades],
+            "full_path": [np.array([f"{i % 100:02d}/celebrity_{i}_{fila}.jpg"]) for fila, i in enumerate(identidades)],
+        })
+        df.attrs.update({"model_name": "VGG-Face", "dimension": dim, "matrix_file": "indice_mmap.f32"})
+        df.to_pickle("indice_mmap.pkl")
+        resultado["write_s"] = round(time.perf_counter() - inicio, 2)
+        vectores_consulta = centros[identidades[rng.integers(0, n, max(consultas, lote))]] + \
+            rng.standard_normal((max(consultas, lote), dim)).astype(np.float32) * 0.6
+        del df
+
+        rss_antes = _rss_mb()
+        inicio = time.perf_counter()
+        indice = CelebrityIndex.load("indice_mmap.pkl")
+        indice.chunk_rows = max(1, int(chunk_mb * 2**20) // (4 * dim))
+        indice.threads = hilos
+        resultado["load_s"] = round(time.perf_counter() - inicio, 4)
+        resultado["chunk_rows"] = indice.chunk_rows
+        # Nombres, géneros y rutas, que sí están en memoria
+        rss_cargado = _rss_mb()
+        resultado["metadata_rss_mb"] = round(rss_cargado - rss_antes, 2)
+
+        tiempos, rss_maximo, obtenidos = [], rss_cargado, []
+        for q in vectores_consulta[:consultas]:
+            inicio = time.perf_counter()
+            obtenidos.append(indice.search(q, top_n=3))
+            tiempos.append(time.perf_counter() - inicio)
+            rss_maximo = max(rss_maximo, _rss_mb())
+        resultado["query"] = _percentiles(tiempos)
+
+        inicio = time.perf_counter()
+        indice.search_batch(vectores_consulta[:lote], top_n=3)
+        duracion = time.perf_counter() - inicio
+        rss_maximo = max(rss_maximo, _rss_mb())
+        resultado["batch"] = {"batch_size": lote, "total_ms": round(duracion * 1000, 3),
+                              "per_query_ms": round(duracion * 1000 / lote, 3)}
+        resultado["search_rss_growth_mb"] = round(rss_maximo - rss_cargado, 2)
+
+        # Referencia: la matriz entera en un solo bloque, como la búsqueda en memoria
+        if resultado["matrix_mb"] <= 1024:
+            indice.chunk_rows, indice.threads = max(1, n), 1
+            tiempos, iguales = [], 0
+            for q, esperado in zip(vectores_consulta[:consultas], obtenidos):
+                inicio = time.perf_counter()
+                iguales += [e for e, _ in indice.search(q, top_n=3)] == [e for e, _ in esperado]
+                tiempos.append(time.perf_counter() - inicio)
+            resultado["single_chunk_query"] = _percentiles(tiempos)
+            resultado["top3_agreement"] = round(iguales / max(1, consultas), 4)
+        del indice
+    return resultado
+
+
+def benchmark_fragmentos(n, dim, consultas, fragmentos, tiempo_limite):
+    """
+    Compara la búsqueda en un solo índice con la búsqueda repartida en fragmentos (sharded_index.py).
+
+    Mide la latencia por consulta de las dos, comprueba que dan los mismos
+    resultados y, con un fragmento detenido (SIGSTOP), que las consultas
+    responden al cumplirse el tiempo límite con los demás fragmentos.
+
+    :param n: Número de embeddings de la base.
+    :param dim: Dimensión de los embeddings.
+    :param consultas: Número de consultas a medir.
+    :param fragmentos: Número de fragmentos.
+    :param tiempo_limite: Segundos que se espera a cada fragmento.
+    :return: Diccionario con los resultados.
+    """
+    import signal
+    from celebrity_index import CelebrityIndex
+    from sharded_index import split_index
+    resultado = {"benchmark": "shards", "rows": n, "dim": dim, "shards": fragmentos, "timeout_s": tiempo_limite}
+    matriz, identidades = generar_embeddings(n, dim)
+    rng = np.random.default_rng(1)
+    vectores_consulta = matriz[rng.integers(0, n, consultas)] + rng.standard_normal((consultas, dim)).astype(np.float32) * 0.3
+
+    with _directorio_trabajo():
+        generar_dataframe(matriz, identidades).to_pickle("representations.pkl")
+        del matriz
+        completo = CelebrityIndex.load("representations.pkl")
+        split_index("representations.pkl", fragmentos)
+        inicio = time.perf_counter()
+        repartido = CelebrityIndex.load("representations_sharded.pkl")
+        repartido.timeout = tiempo_limite
+        resultado["shards_start_s"] = round(time.perf_counter() - inicio, 3)
+
+        for nombre, indice in (("single", completo), ("sharded", repartido)):
+            tiempos, obtenidos = [], []
+            for q in vectores_consulta:
+                inicio = time.perf_counter()
+                obtenidos.append([etiqueta for etiqueta, _ in indice.search(q, top_n=3)])
+                tiempos.append(time.perf_counter() - inicio)
+            resultado[f"{nombre}_query"] = _percentiles(tiempos)
+            resultado[f"{nombre}_top3"] = obtenidos
+        resultado["top3_agreement"] = round(float(np.mean([a == b for a, b in zip(
+            resultado.pop("single_top3"), resultado.pop("sharded_top3"))])), 4)
+
+        # Un fragmento que deja de responder: la consulta espera el tiempo límite y sigue sin él
+        detenido = repartido._processes[0]
+        os.kill(detenido.pid, signal.SIGSTOP)
+        try:
+            tiempos = []
+            for q in vectores_consulta[:5]:
+                inicio = time.perf_counter()
+                repartido.search(q, top_n=3)
+                tiempos.append(time.perf_counter() - inicio)
+            resultado["one_shard_stopped_query"] = _percentiles(tiempos)
+            resultado["partial_searches"] = repartido.partial_searches
+        finally:
+            os.kill(detenido.pid, signal.SIGCONT)
+        del repartido
+    return resultado
+
+
+def benchmark_reduccion(n, dim, rango, consultas, dimensiones, candidatos, metodos, indice_real=None):
+    """
+    Mide la búsqueda en dos fases (matriz reducida y reordenación con los embeddings completos).
+
+    Para cada método de reducción, número de dimensiones y número de candidatos
+    calcula recall@3 respecto a la búsqueda exacta y la latencia por consulta de
+    las dos. Los embeddings sintéticos se generan en un subespacio de `rango`
+    dimensiones más ruido, como los de un modelo real, que no ocupan todas sus
+    dimensiones; con `indice_real` se usa un índice de verdad.
+
+    :param n: Número de embeddings de la base sintética.
+    :param dim: Dimensión de los embeddings sintéticos.
+    :param rango: Dimensión del subespacio de los famosos sintéticos.
+    :param consultas: Número de consultas.
+    :param dimensiones: Lista de dimensiones reducidas.
+    :param candidatos: Lista de números de candidatos de la primera fase.
+    :param metodos: Lista de métodos de reducción ("pca", "random").
+    :param indice_real: Ruta de un índice .pkl real, o None.
+    :return: Lista de diccionarios con los resultados.
+    """
+    from celebrity_index import CelebrityIndex, evaluate_approximate, fit_reduction, matrix_fingerprint, sample_queries
+    if indice_real:
+        indice = CelebrityIndex.from_dataframe(pd.read_pickle(indice_real), pkl_path=indice_real)
+    else:
+        rng = np.random.default_rng(0)
+        n_identidades = max(1, n // 8)
+        base = np.linalg.qr(rng.standard_normal((dim, rango)))[0].T.astype(np.float32)
+        centros = rng.standard_normal((n_identidades, rango)).astype(np.float32) @ base
+        identidades = rng.integers(0, n_identidades, n)
+        matriz = centros[identidades] + rng.standard_normal((n, rango)).astype(np.float32) @ base * 0.5 + \
+            rng.standard_normal((n, dim)).astype(np.float32) * 0.02
+        indice = CelebrityIndex(generar_dataframe(matriz, identidades))
+        del matriz
+    vectores_consulta = sample_queries(indice, consultas)
+
+    resultados = []
+    for metodo in metodos:
+        for k in dimensiones:
+            inicio = time.perf_counter()
+            media, componentes = fit_reduction(indice.matrix, k, metodo)
+            ajuste = time.perf_counter() - inicio
+            reduccion = {"components": componentes, "reduced": (indice.matrix - media) @ componentes.T,
+                         "method": metodo, "fingerprint": matrix_fingerprint(indice.matrix)}
+            for c in candidatos:
+                indice.reduction = dict(reduccion, candidates=c)
+                evaluacion = evaluate_approximate(indice, vectores_consulta)
+                resultado = {"benchmark": "reduction", "index": indice_real or "synthetic", "rows": len(indice),
+                             "dim": indice.dimension, "method": metodo, "reduced_dim": k, "candidates": c,
+                             "fit_s": round(ajuste, 2), "recall_at_3": round(evaluacion["recall"], 4),
+                             "reduced_query_ms": round(evaluacion["approximate_ms"], 3),
+                             "exact_query_ms": round(evaluacion["exact_ms"], 3)}
+                print(json.dumps(resultado))
+                resultados.append(resultado)
+    return resultados
+
+
+def benchmark_prototipos(n, dim, consultas, atipicas, metodos, por_famoso, refinados, descarte, indice_real=None):
+    """
+    Mide la búsqueda por prototipos de cada famoso frente a la búsqueda en todas las fotos.
+
+    Para cada método de prototipos y número de famosos refinados calcula cuántas
+    filas se recorren (prototipos frente a fotos), recall@3 respecto a la
+    búsqueda exacta y la latencia por consulta de las dos. La base sintética
+    tiene unas 8 fotos por famoso y una fracción `atipicas` de fotos que no se
+    parecen a su famoso, como las caras mal detectadas de IMDB-WIKI.
+
+    :param n: Número de embeddings de la base sintética.
+    :param dim: Dimensión de los embeddings sintéticos.
+    :param consultas: Número de consultas.
+    :param atipicas: Fracción de fotos sintéticas atípicas.
+    :param metodos: Lista de métodos ("mean", "medoids").
+    :param por_famoso: Prototipos por famoso con "medoids".
+    :param refinados: Lista de números de famosos cuyas fotos se vuelven a puntuar.
+    :param descarte: Desviaciones típicas para descartar fotos atípicas (0 para no descartar).
+    :param indice_real: Ruta de un índice .pkl real, o None.
+    :return: Lista de diccionarios con los resultados.
+    """
+    from celebrity_index import CelebrityIndex, build_prototypes, evaluate_approximate, prototypes_path, sample_queries
+    resultados = []
+    with _directorio_trabajo():
+        if indice_real:
+            ruta = os.path.abspath(os.path.join(DIRECTORIO, indice_real)) if not os.path.isabs(indice_real) else indice_real
+            pd.read_pickle(ruta).to_pickle("representations.pkl")
+        else:
+            matriz, identidades = generar_embeddings(n, dim)
+            rng = np.random.default_rng(2)
+            filas = rng.random(n) < atipicas
+            matriz[filas] = rng.standard_normal((filas.sum(), dim)).astype(np.float32) * np.linalg.norm(matriz[0])
+            generar_dataframe(matriz, identidades).to_pickle("representations.pkl")
+            del matriz
+        for metodo in metodos:
+            build_prototypes("representations.pkl", metodo, por_famoso, descarte)
+            indice = CelebrityIndex.load("representations.pkl")
+            vectores_consulta = sample_queries(indice, consultas)
+            for refinar in refinados:
+                indice.prototypes['refine'] = refinar
+                evaluacion = evaluate_approximate(indice, vectores_consulta)
+                resultado = {"benchmark": "prototypes", "index": indice_real or "synthetic", "rows": len(indice),
+                             "dim": indice.dimension, "method": metodo, "prototypes": len(indice.prototypes['rows']),
+                             "pruned": int(len(indice) - indice.prototypes['kept'].sum()), "refine": refinar,
+                             "recall_at_3": round(evaluacion["recall"], 4),
+                             "prototype_query_ms": round(evaluacion["approximate_ms"], 3),
+                             "exact_query_ms": round(evaluacion["exact_ms"], 3)}
+                print(json.dumps(resultado))
+                resultados.append(resultado)
+            os.remove(prototypes_path("representations.pkl"))
+    return resultados
+
+
+def _imagen_data_url(semilla):
+    img = generar_cara_sintetica(semilla, 480)
+    return "data:image/jpeg;base64," + base64.b64encode(cv2.imencode('.jpg', img)[1].tobytes()).decode()
+
+
+def benchmark_pipeline(backend, peticiones, filas, dim, latencia):
+    """
+    Mide el rendimiento de /process_image de extremo a extremo con un modelo simulado.
+
+    :param backend: Backend a medir ("app" o "imdb").
+    :param peticiones: Número de capturas enviadas.
+    :param filas: Tamaño de la base sintética de famosos (backend imdb).
+    :param dim: Dimensión de los embeddings simulados.
+    :param latencia: Segundos de inferencia simulada por llamada al modelo.
+    :return: Diccionario con los resultados.
+    """
+    resultado = {"benchmark": "pipeline", "backend": backend, "requests": peticiones,
+                 "rows": filas, "dim": dim, "simulated_inference_s": latencia}
+    instalar_modelo_simulado(dim=dim, latencia=latencia)
+
+    with _directorio_trabajo():
+        if backend == "imdb":
+            matriz, identidades = generar_embeddings(filas, dim)
+            df = generar_dataframe(matriz, identidades)
+            df.to_pickle("representations.pkl")
+            escribir_imagenes_sinteticas(df, "imdb_data_set")
+
+        from backends import cargar_backend
+        inicio = time.perf_counter()
+        modulo = cargar_backend(backend)
+        resultado["startup_s"] = round(time.perf_counter() - inicio, 4)
+        cliente = modulo.app.test_client()
+
+        imagenes = [_imagen_data_url(i) for i in range(peticiones)]
+        tiempos, errores = [], 0
+        inicio_total = time.perf_counter()
+        for imagen in imagenes:
+            cliente.post('/clear_data')
+            inicio = time.perf_counter()
+            respuesta = cliente.post('/process_image', json={"image": imagen, "gender": None})
+            tiempos.append(time.perf_counter() - inicio)
+            if not respuesta.get_json().get("success"):
+                errores += 1
+        total = time.perf_counter() - inicio_total
+
+    resultado["process_image"] = _percentiles(tiempos)
+    resultado["throughput_rps"] = round(peticiones / total, 3)
+    resultado["errors"] = errores
+    resultado["peak_rss_mb"] = round(_pico_rss_mb(), 2)
+    return resultado
+
+
+def benchmark_recarga(peticiones, filas, dim, recargas, visitantes):
+    """
+    Mide /process_image del backend imdb mientras se recarga el índice de famosos en caliente.
+
+    Varios visitantes envían capturas a la vez mientras el índice se reescribe y se
+    recarga con /admin/index/reload. Compara la latencia de las capturas que
+    coinciden con una recarga con la del resto y comprueba que ninguna captura
+    mezcla caras buscadas en generaciones distintas del índice.
+
+    :param peticiones: Número total de capturas.
+    :param filas: Tamaño de la base sintética de famosos.
+    :param dim: Dimensión de los embeddings simulados.
+    :param recargas: Número de recargas del índice durante la prueba.
+    :param visitantes: Hilos que envían capturas a la vez.
+    :return: Diccionario con los resultados.
+    """
+    resultado = {"benchmark": "reload", "requests": peticiones, "rows": filas, "dim": dim,
+                 "reloads": recargas, "visitors": visitantes}
+    instalar_modelo_simulado(dim=dim)
+
+    with _directorio_trabajo():
+        matriz, identidades = generar_embeddings(filas, dim)
+        generar_dataframe(matriz, identidades).to_pickle("representations.pkl")
+
+        from backends import cargar_backend
+        modulo = cargar_backend("imdb")
+        imagenes = [_imagen_data_url(i) for i in range(8)]
+        capturas, lock = [], threading.Lock()
+
+        # Los índices nuevos se generan antes para que las recargas lleguen durante las capturas
+        for semilla in range(1, recargas + 1):
+            matriz, identidades = generar_embeddings(filas, dim, semilla=semilla)
+            generar_dataframe(matriz, identidades, semilla).to_pickle(f"nuevo_{semilla}.pkl", compression=None)
+
+        def visitante(n):
+            cliente = modulo.app.test_client()
+            for i in range(n, peticiones, visitantes):
+                inicio = time.perf_counter()
+                datos = cliente.post('/process_image', json={"image": imagenes[i % len(imagenes)]}).get_json()
+                fin = time.perf_counter()
+                generaciones = set()
+                if datos.get("success"):
+                    generaciones = {r.get("index_generation") for r in cliente.get('/get_results').get_json()["results"]}
+                with lock:
+                    capturas.append((inicio, fin, datos.get("success", False), generaciones))
+
+        hilos = [threading.Thread(target=visitante, args=(n,)) for n in range(visitantes)]
+        for hilo in hilos:
+            hilo.start()
+
+        # Publicar cada índice nuevo como lo hace celebrity_index.py: renombrándolo encima del anterior
+        admin = modulo.app.test_client()
+        ventanas, fallidas = [], 0
+        for semilla in range(1, recargas + 1):
+            time.sleep(0.2)
+            if not any(hilo.is_alive() for hilo in hilos):
+                break
+            os.replace(f"nuevo_{semilla}.pkl", "representations.pkl")
+            inicio = time.perf_counter()
+            if not admin.post('/admin/index/reload').get_json().get("success"):
+                fallidas += 1
+            ventanas.append((inicio, time.perf_counter()))
+        for hilo in hilos:
+            hilo.join()
+
+    def coincide(inicio, fin):
+        return any(inicio < hasta and fin > desde for desde, hasta in ventanas)
+
+    durante = [fin - inicio for inicio, fin, _, _ in capturas if coincide(inicio, fin)]
+    fuera = [fin - inicio for inicio, fin, _, _ in capturas if not coincide(inicio, fin)]
+    resultado["reloads_done"] = len(ventanas)
+    resultado["reloads_failed"] = fallidas
+    resultado["reload"] = _percentiles([hasta - desde for desde, hasta in ventanas])
+    resultado["process_image_during_reload"] = _percentiles(durante)
+    resultado["process_image_otherwise"] = _percentiles(fuera)
+    resultado["errors"] = sum(1 for _, _, exito, _ in capturas if not exito)
+    resultado["generations_seen"] = sorted({g for _, _, _, generaciones in capturas for g in generaciones})
+    resultado["mixed_generation_captures"] = sum(1 for _, _, _, generaciones in capturas if len(generaciones) > 1)
+    return resultado
+
+
+def benchmark_detectores(carpeta, configuraciones, etiquetas=None):
+    """
+    Mide latencia y recall de detectores y cascadas sobre un conjunto de fotos local.
+
+    Todas las fotos deben contener al menos una cara. Con `etiquetas` (nombre de
+    archivo -> número de caras) se mide además el recall por cara.
+
+    :param carpeta: Carpeta con las fotos de prueba (.jpg/.jpeg/.png).
+    :param configuraciones: Lista de detectores o cascadas ("haar", "haar+retinaface"...).
+    :param etiquetas: Diccionario opcional con el número de caras de cada foto.
+    :return: Lista de diccionarios con los resultados de cada configuración.
+    """
+    from detectores import crear_cascada
+
+    archivos = sorted(f for f in os.listdir(carpeta) if f.lower().endswith(('.jpg', '.jpeg', '.png')))
+    imagenes = [(f, cv2.imread(os.path.join(carpeta, f))) for f in archivos]
+    imagenes = [(f, img) for f, img in imagenes if img is not None]
+    if not imagenes:
+        raise ValueError(f"No images found in {carpeta}")
+
+    resultados = []
+    for configuracion in configuraciones:
+        resultado = {"benchmark": "detectors", "detectors": configuracion, "images": len(imagenes)}
+        try:
+            cascada = crear_cascada(configuracion)
+            # La primera llamada carga los pesos del detector; se mide aparte
+            inicio = time.perf_counter()
+            cascada.detectar(imagenes[0][1])
+            resultado["warmup_s"] = round(time.perf_counter() - inicio, 4)
+
+            tiempos, con_cara, encontradas, esperadas = [], 0, 0, 0
+            origenes = {}
+            for archivo, img in imagenes:
+                inicio = time.perf_counter()
+                caras, origen = cascada.detectar_con_origen(img)
+                tiempos.append(time.perf_counter() - inicio)
+                con_cara += bool(caras)
+                origenes[origen or "none"] = origenes.get(origen or "none", 0) + 1
+                if etiquetas and archivo in etiquetas:
+                    encontradas += min(len(caras), etiquetas[archivo])
+                    esperadas += etiquetas[archivo]
+        except Exception as e:
+            resultado["error"] = f"{type(e).__name__}: {e}"
+            resultados.append(resultado)
+            continue
+
+        resultado["latency"] = _percentiles(tiempos)
+        resultado["image_recall"] = round(con_cara / len(imagenes), 4)
+        if esperadas:
+            resultado["face_recall"] = round(encontradas / esperadas, 4)
+        # Qué detector de la cascada resolvió cada foto (muestra cuánto se usa el de respaldo)
+        resultado["resolved_by"] = origenes
+        resultados.append(resultado)
+    return resultados
+
+
+def benchmark_modelos(modelos, referencia, fotos=None, directorio_indices=".", filas=2000, consultas=20):
+    """
+    Compara modelos de embeddings: latencia, memoria del índice y coincidencia del top 3 con un modelo de referencia.
+
+    Con `fotos` se usan los índices reales de cada modelo (representations_<modelo>.pkl
+    en `directorio_indices`) y el backend de CELEBRIA_EMBEDDING_BACKEND. Sin fotos se
+    construyen los índices de una base sintética con el modelo simulado.
+
+    :param modelos: Lista de modelos a comparar.
+    :param referencia: Modelo con el que se compara el top 3 de los demás.
+    :param fotos: Carpeta de fotos de consulta, o None para el modo sintético.
+    :param directorio_indices: Carpeta de los índices de cada modelo.
+    :param filas: Tamaño de la base sintética.
+    :param consultas: Número de caras sintéticas de consulta.
+    :return: Lista de diccionarios con los resultados de cada modelo.
+    """
+    if referencia not in modelos:
+        modelos = [referencia] + list(modelos)
+
+    with _directorio_trabajo() as tmp:
+        if fotos:
+            rutas = [os.path.join(fotos, f) for f in sorted(os.listdir(fotos))
+                     if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
+        else:
+            instalar_modelo_simulado()
+            from celebrity_index import build_model_index
+            from embedding_backends import create_backend
+            matriz, identidades = generar_embeddings(filas, 8)
+            generar_dataframe(matriz, identidades).to_pickle("base.pkl")
+            escribir_imagenes_sinteticas(pd.read_pickle("base.pkl"), "imdb_data_set")
+            for modelo in modelos:
+                build_model_index("base.pkl", "imdb_data_set", modelo, backend=create_backend("deepface", modelo))
+            rutas = []
+            for i in range(consultas):
+                ruta = f"consulta_{i}.jpg"
+                cv2.imwrite(ruta, generar_cara_sintetica(100000 + i, 128))
+                rutas.append(ruta)
+            directorio_indices = tmp
+        if not rutas:
+            raise ValueError(f"No images found in {fotos}")
+
+        import celebrity2
+        from celebrity_index import CelebrityIndex, index_path
+
+        resultados, tops = [], {}
+        for modelo in modelos:
+            resultado = {"benchmark": "models", "model": modelo, "queries": len(rutas)}
+            try:
+                rss_antes = _rss_mb()
+                inicio = time.perf_counter()
+                indice = CelebrityIndex.load(index_path(modelo, directorio_indices), modelo)
+                resultado["index_load_s"] = round(time.perf_counter() - inicio, 4)
+                resultado["index_rows"] = len(indice)
+                resultado["dim"] = indice.dimension
+                resultado["matrix_mb"] = round(indice.matrix.nbytes / 2**20, 2)
+                resultado["index_rss_mb"] = round(max(0.0, _rss_mb() - rss_antes), 2)
+
+                backend = celebrity2.get_embedding_backend(modelo)
+                inicio = time.perf_counter()
+                backend.warm_up()
+                resultado["model_load_s"] = round(time.perf_counter() - inicio, 4)
+
+                tiempos_embedding, tiempos_busqueda, tops[modelo] = [], [], []
+                for ruta in rutas:
+                    inicio = time.perf_counter()
+                    embedding = backend.represent(ruta)
+                    tiempos_embedding.append(time.perf_counter() - inicio)
+                    inicio = time.perf_counter()
+                    top = indice.search(celebrity2.extract_vector(embedding), top_n=3)
+                    tiempos_busqueda.append(time.perf_counter() - inicio)
+                    tops[modelo].append([indice.df.loc[idx, 'celebrity_name'] for idx, _ in top])
+            except Exception as e:
+                resultado["error"] = f"{type(e).__name__}: {e}"
+                resultados.append(resultado)
+                continue
+
+            resultado["embedding"] = _percentiles(tiempos_embedding)
+            resultado["search"] = _percentiles(tiempos_busqueda)
+            resultados.append(resultado)
+
+    # Coincidencia con la referencia: mismo primer famoso y famosos en común dentro del top 3
+    for resultado in resultados:
+        modelo = resultado["model"]
+        if modelo not in tops or referencia not in tops:
+            continue
+        pares = list(zip(tops[modelo], tops[referencia]))
+        resultado["agreement_vs"] = referencia
+        resultado["top1_agreement"] = round(float(np.mean([a[:1] == b[:1] for a, b in pares])), 4)
+        resultado["top3_overlap"] = round(float(np.mean([len(set(a) & set(b)) / 3 for a, b in pares])), 4)
+    return resultados
+
+
+def guardar_resultados(resultados, ruta):
+    """
+    Guarda los resultados junto con la información del entorno.
+
+    :param resultados: Lista de diccionarios de resultados.
+    :param ruta: Ruta del archivo JSON de salida.
+    """
+    documento = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": np.__version__,
+        "cpu_count": os.cpu_count(),
+        "results": resultados,
+    }
+    with open(ruta, "w") as f:
+        json.dump(documento, f, indent=4)
+    print(f"Results saved to {ruta}")
+
+
+def _lista_enteros(texto):
+    return [int(v) for v in texto.split(',') if v]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the celebrity matching hot paths")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    search = subparsers.add_parser("search", help="Search latency, load time and memory on synthetic databases")
+    search.add_argument("--sizes", type=_lista_enteros, default=[10000, 100000],
+                        help="Comma separated database sizes (default: 10000,100000)")
+    search.add_argument("--dims", type=_lista_enteros, default=[128, 2622],
+                        help="Comma separated embedding dimensions (default: 128,2622)")
+    search.add_argument("--queries", type=int, default=20,
+                        help="Number of single queries measured per configuration (default: 20)")
+    search.add_argument("--batch", type=int, default=64,
+                        help="Batch size for batched search (default: 64)")
+    search.add_argument("--max_legacy_rows", type=int, default=100000,
+                        help="Skip the pandas/list based implementations above this size (default: 100000)")
+
+    mmap_search = subparsers.add_parser("mmap", help="Chunked multi-threaded search over an on-disk index")
+    mmap_search.add_argument("--rows", type=int, default=1000000,
+                             help="Rows of the synthetic on-disk index (default: 1000000)")
+    mmap_search.add_argument("--dim", type=int, default=128,
+                             help="Embedding dimension (default: 128)")
+    mmap_search.add_argument("--queries", type=int, default=20,
+                             help="Number of single queries to time (default: 20)")
+    mmap_search.add_argument("--batch", type=int, default=16,
+                             help="Batch size for the batched search (default: 16)")
+    mmap_search.add_argument("--chunk_mb", type=float, default=64,
+                             help="MB of the matrix scanned per chunk (default: 64)")
+    mmap_search.add_argument("--threads", type=_lista_enteros, default=[1, os.cpu_count() or 1],
+                             help="Comma-separated search thread counts (default: 1 and one per core)")
+
+    shards = subparsers.add_parser("shards", help="Single-process search versus scatter-gather over local shards")
+    shards.add_argument("--rows", type=int, default=200000,
+                        help="Rows of the synthetic index (default: 200000)")
+    shards.add_argument("--dim", type=int, default=128,
+                        help="Embedding dimension (default: 128)")
+    shards.add_argument("--queries", type=int, default=20,
+                        help="Number of queries to time (default: 20)")
+    shards.add_argument("--shards", type=int, default=4,
+                        help="Number of shards (default: 4)")
+    shards.add_argument("--timeout", type=float, default=0.5,
+                        help="Seconds to wait for each shard (default: 0.5)")
+
+    reduction = subparsers.add_parser("reduction", help="Recall@3 and latency of the two-stage reduced search")
+    reduction.add_argument("--index", type=str,
+                           help="Real .pkl index to measure (default: a synthetic one)")
+    reduction.add_argument("--rows", type=int, default=20000,
+                           help="Rows of the synthetic index (default: 20000)")
+    reduction.add_argument("--dim", type=int, default=2622,
+                           help="Embedding dimension of the synthetic index (default: 2622)")
+    reduction.add_argument("--rank", type=int, default=128,
+                           help="Dimensions actually used by the synthetic celebrities (default: 128)")
+    reduction.add_argument("--queries", type=int, default=200,
+                           help="Number of queries (default: 200)")
+    reduction.add_argument("--dims", type=_lista_enteros, default=[64, 128, 256],
+                           help="Comma-separated reduced dimensions (default: 64,128,256)")
+    reduction.add_argument("--candidates", type=_lista_enteros, default=[256, 1024],
+                           help="Comma-separated first-stage candidate counts (default: 256,1024)")
+    reduction.add_argument("--methods", type=str, default="pca,random",
+                           help="Comma-separated reduction methods (default: pca,random)")
+
+    prototypes = subparsers.add_parser("prototypes", help="Recall@3 and latency of the per-celebrity prototype search")
+    prototypes.add_argument("--index", type=str,
+                            help="Real .pkl index to measure (default: a synthetic one)")
+    prototypes.add_argument("--rows", type=int, default=50000,
+                            help="Rows of the synthetic index (default: 50000)")
+    prototypes.add_argument("--dim", type=int, default=512,
+                            help="Embedding dimension of the synthetic index (default: 512)")
+    prototypes.add_argument("--outliers", type=float, default=0.05,
+                            help="Fraction of synthetic photos that do not look like their celebrity (default: 0.05)")
+    prototypes.add_argument("--queries", type=int, default=200,
+                            help="Number of queries (default: 200)")
+    prototypes.add_argument("--methods", type=str, default="mean,medoids",
+                            help="Comma-separated prototype methods (default: mean,medoids)")
+    prototypes.add_argument("--per_identity", type=int, default=3,
+                            help="Prototypes per celebrity with medoids (default: 3)")
+    prototypes.add_argument("--refine", type=_lista_enteros, default=[0, 4, 8, 16],
+                            help="Comma-separated numbers of celebrities refined photo by photo (default: 0,4,8,16)")
+    prototypes.add_argument("--prune", type=float, default=2.0,
+                            help="Standard deviations for pruning outlier photos (default: 2)")
+
+    pipeline = subparsers.add_parser("pipeline", help="End-to-end /process_image throughput with a stubbed model")
+    pipeline.add_argument("--backend", choices=["app", "imdb"], default="imdb")
+    pipeline.add_argument("--requests", type=int, default=20,
+                          help="Number of captures sent (default: 20)")
+    pipeline.add_argument("--rows", type=int, default=2000,
+                          help="Synthetic celebrity database size for the imdb backend (default: 2000)")
+    pipeline.add_argument("--dim", type=int, default=2622,
+                          help="Embedding dimension of the stubbed model (default: 2622)")
+    pipeline.add_argument("--latency", type=float, default=0.0,
+                          help="Simulated inference seconds per model call (default: 0)")
+
+    reload = subparsers.add_parser("reload", help="/process_image latency while the celebrity index is hot reloaded")
+    reload.add_argument("--requests", type=int, default=200,
+                        help="Number of captures sent (default: 200)")
+    reload.add_argument("--rows", type=int, default=20000,
+                        help="Synthetic celebrity database size (default: 20000)")
+    reload.add_argument("--dim", type=int, default=128,
+                        help="Embedding dimension of the stubbed model (default: 128)")
+    reload.add_argument("--reloads", type=int, default=5,
+                        help="Index reloads during the run (default: 5)")
+    reload.add_argument("--visitors", type=int, default=4,
+                        help="Concurrent visitors sending captures (default: 4)")
+
+    detectors = subparsers.add_parser("detectors", help="Per-detector latency and recall on a local image set")
+    detectors.add_argument("--images", type=str, required=True,
+                           help="Folder of test photos; every photo must contain at least one face")
+    detectors.add_argument("--detectors", type=str, default="haar,opencv,ssd,mtcnn,retinaface",
+                           help="Comma separated single detectors to measure (default: haar,opencv,ssd,mtcnn,retinaface)")
+    detectors.add_argument("--cascades", type=str, default="haar+retinaface,haar+mtcnn,haar+ssd",
+                           help="Comma separated cascades, detectors joined with '+' (default: haar+retinaface,haar+mtcnn,haar+ssd)")
+    detectors.add_argument("--labels", type=str,
+                           help="Optional JSON file mapping image file names to their number of faces")
+
+    models = subparsers.add_parser("models", help="Latency, memory and top-3 agreement across embedding models")
+    models.add_argument("--models", type=str, default="VGG-Face,Facenet,Facenet512,ArcFace",
+                        help="Comma separated DeepFace models (default: VGG-Face,Facenet,Facenet512,ArcFace)")
+    models.add_argument("--reference", type=str, default="VGG-Face",
+                        help="Model the top-3 agreement is measured against (default: VGG-Face)")
+    models.add_argument("--photos", type=str,
+                        help="Folder of query photos; without it a synthetic database and the simulated model are used")
+    models.add_argument("--index_dir", type=str, default=".",
+                        help="Folder with representations_<model>.pkl for each model (default: .)")
+    models.add_argument("--rows", type=int, default=2000,
+                        help="Synthetic celebrity database size without --photos (default: 2000)")
+    models.add_argument("--queries", type=int, default=20,
+                        help="Number of synthetic query faces without --photos (default: 20)")
+
+    for subparser in (search, mmap_search, shards, reduction, prototypes, pipeline, reload, detectors, models):
+        subparser.add_argument("--output", type=str, default="benchmark_results.json",
+                               help="Path of the JSON results file (default: benchmark_results.json)")
+
+    args = parser.parse_args()
+
+    resultados = []
+    if args.command == "search":
+        # proyecto_paellas y celebrity2 importan deepface al cargarse
+        instalar_modelo_simulado(dim=max(args.dims))
+        for dim in args.dims:
+            for n in args.sizes:
+                print(f"Benchmarking search with {n} rows x {dim} dims...")
+                resultado = benchmark_busqueda(n, dim, args.queries, args.batch, args.max_legacy_rows)
+                print(json.dumps(resultado, indent=2))
+                resultados.append(resultado)
+    elif args.command == "mmap":
+        for hilos in dict.fromkeys(args.threads):
+            print(f"Benchmarking on-disk search with {args.rows} rows x {args.dim} dims and {hilos} threads...")
+            resultado = benchmark_mmap(args.rows, args.dim, args.queries, args.batch, args.chunk_mb, hilos)
+            print(json.dumps(resultado, indent=2))
+            resultados.append(resultado)
+    elif args.command == "shards":
+        resultado = benchmark_fragmentos(args.rows, args.dim, args.queries, args.shards, args.timeout)
+        print(json.dumps(resultado, indent=2))
+        resultados.append(resultado)
+    elif args.command == "reduction":
+        resultados = benchmark_reduccion(args.rows, args.dim, args.rank, args.queries, args.dims, args.candidates,
+                                         [m for m in args.methods.split(',') if m], args.index)
+    elif args.command == "prototypes":
+        resultados = benchmark_prototipos(args.rows, args.dim, args.queries, args.outliers,
+                                          [m for m in args.methods.split(',') if m], args.per_identity,
+                                          args.refine, args.prune, args.index)
+    elif args.command == "pipeline":
+        resultado = benchmark_pipeline(args.backend, args.requests, args.rows, args.dim, args.latency)
+        print(json.dumps(resultado, indent=2))
+        resultados.append(resultado)
+    elif args.command == "reload":
+        resultado = benchmark_recarga(args.requests, args.rows, args.dim, args.reloads, args.visitors)
+        print(json.dumps(resultado, indent=2))
+        resultados.append(resultado)
+    elif args.command == "detectors":
+        etiquetas = None
+        if args.labels:
+            with open(args.labels) as f:
+                etiquetas = json.load(f)
+        configuraciones = [c for c in args.detectors.split(',') + args.cascades.split(',') if c]
+        resultados = benchmark_detectores(args.images, configuraciones, etiquetas)
+        print(json.dumps(resultados, indent=2))
+    elif args.command == "models":
+        fotos = os.path.abspath(args.photos) if args.photos else None
+        resultados = benchmark_modelos([m for m in args.models.split(',') if m], args.reference, fotos,
+                                       os.path.abspath(args.index_dir), args.rows, args.queries)
+        print(json.dumps(resultados, indent=2))
+
+    guardar_resultados(resultados, os.path.abspath(args.output))
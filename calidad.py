@@ -0,0 +1,201 @@
+"""
+Calidad de servicio adaptativa: respuestas algo menos exactas antes que tardías.
+
+carga.js deja de esperar a los 120 segundos y, en hora punta, una captura puede
+pasar mucho tiempo en cola detrás de otras. Cada captura tiene un presupuesto de
+latencia (CELEBRIA_LATENCY_BUDGET_S, en segundos) que empieza a contar cuando
+llega al servidor. Al empezar a procesarla se elige el nivel más exacto que se
+espera que termine dentro de lo que queda de presupuesto:
+
+- "exact": la configuración normal.
+- "fast": la foto se reduce a 480 px de lado antes de detectar caras y la
+  búsqueda recorta a la mitad sus fases aproximadas (candidatos de la matriz
+  reducida y famosos que se vuelven a puntuar con los prototipos, ver
+  celebrity_index.py).
+- "degraded": la foto se reduce a 320 px, la búsqueda se queda en la primera
+  fase y, si CELEBRIA_QOS_MODEL nombra otro modelo de CELEBRIA_MODELS (uno más
+  pequeño), se usa ese modelo y su índice.
+
+La estimación es sencilla: cada nivel guarda una media móvil de lo que cuesta
+una cara (la duración de la captura dividida entre las capturas que había en
+curso al empezar y entre sus caras), que se multiplica por las caras medias de
+una captura y por las capturas en curso ahora. Así una foto de grupo no hace
+parecer lento a su nivel. Un nivel que aún no se ha medido se supone que cabe.
+
+La primera captura de cada nivel y modelo no se mide: es la que carga el modelo
+(TensorFlow u ONNX Runtime) si nadie lo ha calentado antes, y dejaría al nivel
+fuera del presupuesto en una máquina sin carga. Además, un nivel solo se vuelve
+a medir cuando se usa, y una captura lenta (una foto enorme, un pico de carga)
+podría dejarlo fuera para siempre. Por eso, de cada SONDEO_CADA capturas que no
+van al nivel "exact", una va al nivel siguiente más exacto que el elegido,
+aunque no quepa, para renovar su coste.
+
+El nivel usado queda en cada resultado (`qos_tier`) y, con CELEBRIA_METRICS=1,
+en celebria_qos_tier_total; los sondeos, en celebria_qos_probe_total.
+
+Está desactivado por defecto (CELEBRIA_LATENCY_BUDGET_S=0): se usa siempre el
+nivel "exact". Con carga.js, que espera hasta 120 segundos, 15 es un buen
+punto de partida.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import cv2
+
+import metricas
+
+PRESUPUESTO = float(os.environ.get("CELEBRIA_LATENCY_BUDGET_S", "0"))
+MODELO_LIGERO = os.environ.get("CELEBRIA_QOS_MODEL") or None
+# Peso de la última captura en la media móvil del coste de cada nivel
+PESO_MEDIA = 0.2
+# Una de cada tantas capturas servidas por debajo de "exact" sube un nivel para volver a medirlo
+SONDEO_CADA = 10
+
+
+class Nivel:
+    """Ajustes de un nivel de calidad. No se modifica después de crearlo."""
+
+    __slots__ = ("nombre", "esfuerzo", "lado_deteccion", "modelo_ligero")
+
+    def __init__(self, nombre, esfuerzo, lado_deteccion=None, modelo_ligero=False):
+        """
+        :param nombre: Nombre que se guarda en los resultados.
+        :param esfuerzo: Fracción (0 a 1) de las fases aproximadas de la búsqueda.
+        :param lado_deteccion: Lado máximo de la foto para detectar caras, o None para no reducirla.
+        :param modelo_ligero: Si se cambia al modelo de CELEBRIA_QOS_MODEL.
+        """
+        self.nombre = nombre
+        self.esfuerzo = esfuerzo
+        self.lado_deteccion = lado_deteccion
+        self.modelo_ligero = modelo_ligero
+
+    def modelo(self, modelo, disponibles):
+        """
+        :param modelo: Modelo pedido para la captura.
+        :param disponibles: Modelos que se pueden usar (CELEBRIA_MODELS).
+        :return: Modelo con el que se procesa la captura en este nivel.
+        """
+        if self.modelo_ligero and MODELO_LIGERO in disponibles:
+            return MODELO_LIGERO
+        return modelo
+
+    def imagen_deteccion(self, imagen):
+        """
+        :param imagen: Foto BGR decodificada.
+        :return: La foto reducida a lado_deteccion, o la misma si ya es más pequeña.
+        """
+        if self.lado_deteccion is None or imagen is None:
+            return imagen
+        factor = self.lado_deteccion / max(imagen.shape[:2])
+        if factor >= 1.0:
+            return imagen
+        return cv2.resize(imagen, None, fx=factor, fy=factor, interpolation=cv2.INTER_AREA)
+
+
+NIVELES = (
+    Nivel("exact", 1.0),
+    Nivel("fast", 0.5, lado_deteccion=480),
+    Nivel("degraded", 0.0, lado_deteccion=320, modelo_ligero=True),
+)
+
+
+class Medicion:
+    """Nivel elegido para una captura y caras que ha procesado, para repartir su coste."""
+
+    __slots__ = ("nivel", "caras", "modelo")
+
+    def __init__(self, nivel):
+        """
+        :param nivel: Nivel con el que se procesa la captura.
+        """
+        self.nivel = nivel
+        self.caras = 1
+        self.modelo = None
+
+
+class ControlCalidad:
+    """Capturas en curso en este proceso y coste medido de cada nivel, para elegir el de cada captura."""
+
+    def __init__(self, presupuesto=PRESUPUESTO, niveles=NIVELES):
+        """
+        :param presupuesto: Segundos que puede tardar una captura desde que llega (0 para no degradar nunca).
+        :param niveles: Niveles del más exacto al más barato.
+        """
+        self.presupuesto = presupuesto
+        self.niveles = niveles
+        self._coste = {}
+        self._caras = 1.0
+        self._medidos = set()
+        self._en_curso = 0
+        self._saltadas = 0
+        self._lock = threading.Lock()
+
+    def elegir(self, llegada):
+        """
+        :param llegada: time.monotonic() de cuando llegó la captura.
+        :return: Nivel más exacto que se espera que termine dentro del presupuesto.
+        """
+        if self.presupuesto <= 0:
+            return self.niveles[0]
+        restante = self.presupuesto - (time.monotonic() - llegada)
+        with self._lock:
+            carga = max(1, self._en_curso) * self._caras
+            for nivel in self.niveles[:-1]:
+                if self._coste.get(nivel.nombre, 0.0) * carga <= restante:
+                    return nivel
+        return self.niveles[-1]
+
+    @contextmanager
+    def capturar(self, llegada=None):
+        """
+        Elige el nivel de una captura y mide cuánto cuesta mientras se procesa.
+
+        :param llegada: time.monotonic() de cuando llegó la captura (por defecto, ahora).
+        :return: Context manager que da la Medicion de la captura; quien la procesa pone en caras las que
+                 ha encontrado y en modelo el que ha usado (si puede cambiar).
+        """
+        llegada = time.monotonic() if llegada is None else llegada
+        with self._lock:
+            self._en_curso += 1
+            concurrentes = self._en_curso
+        nivel = self.elegir(llegada)
+        posicion = self.niveles.index(nivel)
+        with self._lock:
+            if posicion > 0 and self.presupuesto > 0:
+                self._saltadas += 1
+                sondeo = self._saltadas >= SONDEO_CADA
+                if sondeo:
+                    self._saltadas = 0
+            else:
+                sondeo = False
+        if sondeo:
+            # El coste guardado del nivel más exacto puede ser de hace mucho: volver a medirlo
+            nivel = self.niveles[posicion - 1]
+            metricas.incrementar("qos_probe_total", tier=nivel.nombre)
+        metricas.incrementar("qos_tier_total", tier=nivel.nombre)
+        medicion = Medicion(nivel)
+        inicio = time.monotonic()
+        terminada = False
+        try:
+            yield medicion
+            terminada = True
+        finally:
+            duracion = (time.monotonic() - inicio) / concurrentes
+            with self._lock:
+                self._en_curso -= 1
+                # Una captura cancelada o con error a medias no dice lo que cuesta el nivel
+                if terminada:
+                    # Sin caras también se ha detectado: cuenta como una
+                    caras = max(1, medicion.caras)
+                    self._caras = (1 - PESO_MEDIA) * self._caras + PESO_MEDIA * caras
+                    clave = (nivel.nombre, medicion.modelo)
+                    if clave not in self._medidos:
+                        # La primera puede haber cargado el modelo: no dice lo que cuesta el nivel
+                        self._medidos.add(clave)
+                    else:
+                        coste = duracion / caras
+                        anterior = self._coste.get(nivel.nombre)
+                        self._coste[nivel.nombre] = coste if anterior is None else \
+                            (1 - PESO_MEDIA) * anterior + PESO_MEDIA * coste
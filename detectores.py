@@ -0,0 +1,184 @@
+"""
+Detección de caras configurable: un detector rápido y alternativas más precisas.
+
+CELEBRIA_DETECTORS es la cascada de detectores, separados por comas, en el orden
+en que se prueban. Los siguientes solo se ejecutan cuando los anteriores no
+encuentran ninguna cara, así que el primero debe ser rápido y los demás
+precisos. Por defecto "haar,retinaface".
+
+Detectores disponibles:
+- "haar": clasificador Haar de OpenCV (el de proyecto_paellas.py). No carga
+  TensorFlow y tarda milisegundos en CPU. Se configura con CELEBRIA_HAAR_MIN_SIZE
+  (40 px), CELEBRIA_HAAR_NEIGHBORS (5) y CELEBRIA_DETECT_MAX_SIDE (640 px: las
+  fotos más grandes se reducen antes de buscar caras).
+- cualquier detector_backend de DeepFace: "opencv", "ssd", "mtcnn",
+  "retinaface", "dlib", "mediapipe"...
+
+Todos devuelven el mismo formato que DeepFace.extract_faces: una lista de
+diccionarios con "face" (RGB en float [0, 1] de TAMANO_CARA), "facial_area" y
+"confidence". Si ningún detector encuentra caras la lista está vacía y el
+backend decide qué hacer (usar la foto entera).
+
+`python benchmark.py detectors --images <carpeta>` compara latencia y recall de
+cada detector y cascada sobre un conjunto de fotos local.
+"""
+import os
+import threading
+
+import cv2
+import numpy as np
+
+import metricas
+
+DETECTORES = os.environ.get("CELEBRIA_DETECTORS", "haar,retinaface")
+TAMANO_CARA = (224, 224)
+HAAR_TAMANO_MINIMO = int(os.environ.get("CELEBRIA_HAAR_MIN_SIZE", "40"))
+HAAR_VECINOS = int(os.environ.get("CELEBRIA_HAAR_NEIGHBORS", "5"))
+LADO_MAXIMO = int(os.environ.get("CELEBRIA_DETECT_MAX_SIDE", "640"))
+
+
+def _leer(imagen):
+    if isinstance(imagen, np.ndarray):
+        return imagen
+    img = cv2.imread(imagen)
+    if img is None:
+        raise ValueError(f"Confirm that {imagen} exists")
+    return img
+
+
+def recortar_cara(img, x, y, w, h, confianza=1.0):
+    """
+    Recorta una cara y la devuelve con el formato de DeepFace.extract_faces.
+
+    :param img: Imagen BGR completa.
+    :param x: Coordenada x de la caja.
+    :param y: Coordenada y de la caja.
+    :param w: Ancho de la caja.
+    :param h: Alto de la caja.
+    :param confianza: Confianza de la detección.
+    :return: Diccionario con face, facial_area y confidence.
+    """
+    recorte = img[y:y + h, x:x + w]
+    cara = cv2.resize(recorte, TAMANO_CARA, interpolation=cv2.INTER_AREA)
+    cara = cv2.cvtColor(cara, cv2.COLOR_BGR2RGB).astype(np.float32) / 255.0
+    return {"face": cara, "facial_area": {"x": int(x), "y": int(y), "w": int(w), "h": int(h)},
+            "confidence": float(confianza)}
+
+
+class DetectorHaar:
+    """Clasificador Haar de OpenCV sobre la imagen reducida a LADO_MAXIMO."""
+
+    nombre = "haar"
+
+    def __init__(self, escala=1.1, vecinos=HAAR_VECINOS, tamano_minimo=HAAR_TAMANO_MINIMO, lado_maximo=LADO_MAXIMO):
+        self.escala = escala
+        self.vecinos = vecinos
+        self.tamano_minimo = tamano_minimo
+        self.lado_maximo = lado_maximo
+        self._ruta = os.path.join(cv2.data.haarcascades, "haarcascade_frontalface_default.xml")
+        # CascadeClassifier no es seguro entre hilos: uno por hilo
+        self._local = threading.local()
+
+    def _clasificador(self):
+        if not hasattr(self._local, "clasificador"):
+            self._local.clasificador = cv2.CascadeClassifier(self._ruta)
+        return self._local.clasificador
+
+    def detectar(self, imagen):
+        img = _leer(imagen)
+        gris = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        factor = min(1.0, self.lado_maximo / max(gris.shape[:2]))
+        if factor < 1.0:
+            gris = cv2.resize(gris, None, fx=factor, fy=factor, interpolation=cv2.INTER_AREA)
+        minimo = max(1, int(self.tamano_minimo * factor))
+        cajas = self._clasificador().detectMultiScale(gris, scaleFactor=self.escala, minNeighbors=self.vecinos,
+                                                      minSize=(minimo, minimo))
+        caras = []
+        for (x, y, w, h) in cajas:
+            caras.append(recortar_cara(img, int(x / factor), int(y / factor), int(w / factor), int(h / factor)))
+        return caras
+
+
+class DetectorDeepFace:
+    """Detector de DeepFace (detector_backend) con alineación."""
+
+    def __init__(self, backend):
+        self.nombre = backend
+        self.backend = backend
+
+    def detectar(self, imagen):
+        from deepface import DeepFace
+        try:
+            # Con enforce_detection=False DeepFace devolvería la foto entera como si fuera una cara
+            return DeepFace.extract_faces(_leer(imagen), target_size=TAMANO_CARA,
+                                          detector_backend=self.backend, enforce_detection=True)
+        except ValueError:
+            return []
+
+
+class CascadaDetectores:
+    """Prueba los detectores en orden y se queda con el primero que encuentra caras."""
+
+    def __init__(self, detectores):
+        self.detectores = detectores
+        self.nombre = "+".join(d.nombre for d in detectores)
+
+    def detectar_con_origen(self, imagen):
+        """
+        :param imagen: Ruta o imagen BGR.
+        :return: Tupla (caras, nombre del detector que las encontró o None).
+        """
+        img = _leer(imagen)
+        for detector in self.detectores:
+            try:
+                with metricas.etapa(f"detection_{detector.nombre}"):
+                    caras = detector.detectar(img)
+            except Exception as e:
+                # Un detector que no está disponible (p. ej. OpenCV sin el módulo Haar) no tumba la cascada
+                print(f"Error in face detector {detector.nombre}: {str(e)}")
+                caras = []
+            if caras:
+                metricas.incrementar("face_detector_hits_total", detector=detector.nombre)
+                return caras, detector.nombre
+        metricas.incrementar("face_detector_misses_total")
+        return [], None
+
+    def detectar(self, imagen):
+        return self.detectar_con_origen(imagen)[0]
+
+
+def crear_detector(nombre):
+    """
+    :param nombre: "haar" o un detector_backend de DeepFace.
+    :return: Detector.
+    """
+    if nombre == "haar":
+        return DetectorHaar()
+    return DetectorDeepFace(nombre)
+
+
+def crear_cascada(texto):
+    """
+    :param texto: Nombres de detectores separados por comas (o '+').
+    :return: CascadaDetectores.
+    """
+    nombres = [n.strip() for n in texto.replace("+", ",").split(",") if n.strip()]
+    if not nombres:
+        raise ValueError("At least one face detector is required")
+    return CascadaDetectores([crear_detector(n) for n in nombres])
+
+
+_cascada = None
+
+
+def detectar_caras(imagen):
+    """
+    Detecta las caras de una foto con la cascada configurada en CELEBRIA_DETECTORS.
+
+    :param imagen: Ruta o imagen BGR.
+    :return: Lista de caras con el formato de DeepFace.extract_faces (vacía si no hay ninguna).
+    """
+    global _cascada
+    if _cascada is None:
+        _cascada = crear_cascada(DETECTORES)
+    return _cascada.detectar(imagen)
@@ -0,0 +1,235 @@
+"""
+Caché HTTP y compresión de los archivos estáticos y de las imágenes.
+
+- Huellas de contenido: url_for('static', ...) añade `?v=<hash>` con los
+  primeros caracteres del SHA-256 del archivo. Una petición con la huella
+  actual se sirve con `Cache-Control: immutable` durante un año; cuando el
+  archivo cambia, cambia la URL y el navegador lo descarga de nuevo. Las
+  peticiones sin huella (los @import y url() de las hojas de estilo, o las
+  rutas escritas a mano en los .js) se revalidan con ETag.
+- Precompresión: los archivos de texto (.js, .css, .svg, .ttf...) se
+  comprimen una vez con gzip, y con brotli si el paquete `brotli` está
+  instalado, y se sirve la variante que acepte el navegador. Se generan al
+  arrancar el servidor o con `python estaticos.py`.
+- Imágenes de face-db y personas: ETag y Last-Modified para peticiones
+  condicionales (304). Las de face-db se cachean CELEBRIA_FACE_DB_MAX_AGE
+  segundos (un día por defecto); las de personas se revalidan siempre porque
+  cada captura reescribe los mismos nombres.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+
+from flask import request, send_file, send_from_directory
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+EXTENSIONES_COMPRIMIBLES = ('.js', '.css', '.svg', '.html', '.ttf', '.ico', '.json', '.txt')
+CADUCIDAD_INMUTABLE = 365 * 24 * 3600
+CADUCIDAD_FACE_DB = int(os.environ.get("CELEBRIA_FACE_DB_MAX_AGE", str(24 * 3600)))
+LONGITUD_HUELLA = 12
+
+# Extensión del archivo precomprimido para cada Content-Encoding, por orden de preferencia
+_VARIANTES = (("br", ".br"), ("gzip", ".gz"))
+
+_huellas = {}
+_lock = threading.Lock()
+
+
+def huella(ruta):
+    """
+    Calcula la huella de contenido de un archivo, reutilizándola mientras no cambie.
+
+    :param ruta: Ruta del archivo.
+    :return: Prefijo hexadecimal del SHA-256 del contenido, o None si el archivo no existe.
+    """
+    try:
+        estado = os.stat(ruta)
+    except OSError:
+        return None
+    clave = (estado.st_mtime_ns, estado.st_size)
+    with _lock:
+        guardada = _huellas.get(ruta)
+    if guardada and guardada[0] == clave:
+        return guardada[1]
+    with open(ruta, 'rb') as f:
+        valor = hashlib.sha256(f.read()).hexdigest()[:LONGITUD_HUELLA]
+    with _lock:
+        _huellas[ruta] = (clave, valor)
+    return valor
+
+
+def precomprimir(carpeta):
+    """
+    Genera las variantes .gz (y .br si hay brotli) de los archivos de texto de una carpeta.
+
+    Solo se reescriben las variantes que no existen o son más antiguas que el original.
+
+    :param carpeta: Carpeta de archivos estáticos.
+    :return: Número de variantes generadas.
+    """
+    generadas = 0
+    for raiz, _, archivos in os.walk(carpeta):
+        for archivo in archivos:
+            if not archivo.lower().endswith(EXTENSIONES_COMPRIMIBLES):
+                continue
+            ruta = os.path.join(raiz, archivo)
+            modificado = os.path.getmtime(ruta)
+            with open(ruta, 'rb') as f:
+                contenido = f.read()
+            for codificacion, extension in _VARIANTES:
+                if codificacion == "br" and brotli is None:
+                    continue
+                destino = ruta + extension
+                if os.path.exists(destino) and os.path.getmtime(destino) >= modificado:
+                    continue
+                if codificacion == "br":
+                    comprimido = brotli.compress(contenido, quality=11)
+                else:
+                    comprimido = gzip.compress(contenido, compresslevel=9, mtime=0)
+                # Una variante que no ahorra nada no merece la cabecera Content-Encoding
+                if len(comprimido) >= len(contenido):
+                    continue
+                with open(destino, 'wb') as f:
+                    f.write(comprimido)
+                generadas += 1
+    return generadas
+
+
+def elegir_variante(ruta, codificaciones_aceptadas):
+    """
+    Elige el archivo precomprimido que se puede enviar según Accept-Encoding.
+
+    :param ruta: Ruta del archivo original.
+    :param codificaciones_aceptadas: `request.accept_encodings` de la petición.
+    :return: Tupla (ruta a enviar, Content-Encoding o None).
+    """
+    for codificacion, extension in _VARIANTES:
+        if codificaciones_aceptadas[codificacion] > 0:
+            variante = ruta + extension
+            if os.path.exists(variante) and os.path.getmtime(variante) >= os.path.getmtime(ruta):
+                return variante, codificacion
+    return ruta, None
+
+
+def resolver_ruta(carpeta, filename):
+    """
+    Resuelve un archivo dentro de una carpeta sin permitir salir de ella.
+
+    :param carpeta: Carpeta desde la que se sirven los archivos.
+    :param filename: Ruta relativa pedida.
+    :return: Ruta absoluta del archivo, o None si no existe o queda fuera de la carpeta.
+    """
+    base = os.path.abspath(carpeta)
+    ruta = os.path.abspath(os.path.join(base, filename))
+    if not ruta.startswith(base + os.sep) or not os.path.isfile(ruta):
+        return None
+    return ruta
+
+
+def etag_archivo(ruta):
+    """
+    Calcula un ETag a partir de la fecha de modificación y el tamaño del archivo.
+
+    :param ruta: Ruta del archivo.
+    :return: Valor del ETag (sin comillas).
+    """
+    estado = os.stat(ruta)
+    return f"{estado.st_mtime_ns:x}-{estado.st_size:x}"
+
+
+def aplicar_cache_estatico(response, ruta, codificacion, version):
+    """
+    Añade las cabeceras de caché y codificación a la respuesta de un archivo estático.
+
+    :param response: Respuesta con el contenido del archivo.
+    :param ruta: Ruta del archivo original.
+    :param codificacion: Content-Encoding de la variante enviada, o None.
+    :param version: Valor del parámetro `v` de la petición.
+    :return: La misma respuesta.
+    """
+    if codificacion:
+        response.headers["Content-Encoding"] = codificacion
+    response.vary.add("Accept-Encoding")
+    if version and version == huella(ruta):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = CADUCIDAD_INMUTABLE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
+def aplicar_cache_imagen(response, carpeta):
+    """
+    Añade las cabeceras de caché de una imagen de face-db o personas.
+
+    :param response: Respuesta con la imagen.
+    :param carpeta: 'face-db' o 'personas'.
+    :return: La misma respuesta.
+    """
+    if carpeta == 'face-db':
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = CADUCIDAD_FACE_DB
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
+def servir_imagen(carpeta, filename):
+    """
+    Sirve una imagen de face-db o personas con soporte de peticiones condicionales.
+
+    :param carpeta: 'face-db' o 'personas'.
+    :param filename: Ruta relativa de la imagen.
+    :return: Respuesta de Flask (200 o 304).
+    """
+    response = send_from_directory(os.path.abspath(carpeta), filename, conditional=True)
+    return aplicar_cache_imagen(response, carpeta)
+
+
+def registrar_huellas(app):
+    """
+    Hace que url_for('static', ...) añada la huella de contenido del archivo como `?v=`.
+
+    :param app: Aplicación Flask o Quart.
+    """
+    @app.url_defaults
+    def _anadir_huella(endpoint, values):
+        if endpoint == 'static' and 'filename' in values and 'v' not in values:
+            valor = huella(os.path.join(app.static_folder, values['filename']))
+            if valor:
+                values['v'] = valor
+
+
+def instalar_estaticos(app):
+    """
+    Registra en la aplicación Flask las huellas en url_for y el servidor de estáticos con caché.
+
+    :param app: Aplicación Flask.
+    """
+    precomprimir(app.static_folder)
+    registrar_huellas(app)
+
+    def static(filename):
+        ruta = resolver_ruta(app.static_folder, filename)
+        if ruta is None:
+            return app.send_static_file(filename)
+        enviada, codificacion = elegir_variante(ruta, request.accept_encodings)
+        response = send_file(enviada, mimetype=mimetypes.guess_type(ruta)[0], conditional=True)
+        return aplicar_cache_estatico(response, ruta, codificacion, request.args.get('v'))
+
+    app.view_functions['static'] = static
+
+
+if __name__ == "__main__":
+    carpeta = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Frontend', 'Static')
+    print(f"Generated {precomprimir(carpeta)} precompressed variants in {carpeta}"
+          + ("" if brotli else " (gzip only; pip install brotli for .br)"))
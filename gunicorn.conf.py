@@ -0,0 +1,45 @@
+"""
+Configuración de gunicorn para producción: gunicorn -c gunicorn.conf.py wsgi:app
+
+Un proceso maestro carga el backend (índice de famosos y modelo) y hace fork de
+un worker por núcleo. Cada worker atiende varias peticiones con hilos para que
+las rutas de solo E/S (/process_status, /get_results, imágenes) no esperen a
+que termine una inferencia.
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get("CELEBRIA_BIND", "0.0.0.0:5000")
+
+# Cargar la aplicación antes del fork para compartir índice y modelo copy-on-write
+preload_app = True
+
+# Un worker por núcleo; los hilos de cada worker cubren las peticiones de E/S
+workers = int(os.environ.get("CELEBRIA_WORKERS", multiprocessing.cpu_count()))
+worker_class = "gthread"
+threads = int(os.environ.get("CELEBRIA_THREADS", "8"))
+
+# Repartir los núcleos entre workers para que TensorFlow/BLAS no creen N hilos en cada uno
+_hilos_por_worker = str(max(1, multiprocessing.cpu_count() // workers))
+for _variable in ("TF_NUM_INTRAOP_THREADS", "OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+    os.environ.setdefault(_variable, _hilos_por_worker)
+os.environ.setdefault("TF_NUM_INTEROP_THREADS", "1")
+
+# Mayor que MAX_WAIT_TIME de carga.js (120 s) para no matar capturas que el visitante sigue esperando
+timeout = 150
+graceful_timeout = 30
+keepalive = 5
+
+accesslog = os.environ.get("CELEBRIA_ACCESS_LOG", "-")
+errorlog = "-"
+loglevel = os.environ.get("CELEBRIA_LOG_LEVEL", "info")
+
+
+def post_fork(server, worker):
+    server.log.info(f"Worker {worker.pid} started with shared celebrity index")
+
+
+def post_worker_init(worker):
+    # Las sesiones de ONNX Runtime no se heredan del maestro: cada worker calienta las suyas antes de atender
+    import wsgi
+    wsgi.calentar_worker()
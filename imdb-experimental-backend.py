@@ -1,25 +1,69 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, send_from_directory
+from flask import Flask, render_template, request, jsonify, redirect, url_for, Response, g
 import os
 import cv2
 import base64
 import numpy as np
-import json
 import time
 import shutil
 import sys
+import logging
+from concurrent.futures import Future, wait
+from contextlib import nullcontext
 from PIL import Image
 import pandas as pd
-from deepface import DeepFace
+
+import metricas
+from metricas import instalar_metricas
+from perfilador import instalar_perfilador
+from estaticos import instalar_estaticos
+from miniaturas import servir_imagen_adaptada
+from trabajos import (INTERVALO_CANCELACION, MAX_CANDIDATOS, CapturaCancelada, instalar_trabajos, registro,
+                      trabajo_actual)
+from detectores import detectar_caras
+from indices import AlmacenIndices, instalar_recarga
+from lotes import VENTANA_MS, AgrupadorLotes
+from inferencia import PROCESOS, PoolInferencia
+from calidad import MODELO_LIGERO, ControlCalidad
+from planificador import planificador
+
+# celebrity2.py and its helper modules live in imdb-wiki/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'imdb-wiki'))
 
 # Import functions from celebrity2.py
-from celebrity2 import load_embeddings, get_face_embedding, find_similar_celebrities, extract_vector
+from celebrity2 import (get_embedding_backend, get_face_embedding, get_face_embeddings, find_similar_celebrities,
+                        extract_vector)
+from celebrity_index import CelebrityIndex, index_path
+from embedding_backends import DEFAULT_MODEL, MODEL_INPUT_SIZES
+from result_card import render_result_card
 
 app = Flask(__name__, 
             static_folder='Frontend/Static',
             template_folder='Frontend/Templates')
 
+logger = logging.getLogger(__name__)
+
+# Per-stage latency metrics and the /metrics endpoint (enabled with CELEBRIA_METRICS=1)
+instalar_metricas(app)
+
+# Opt-in request profiling and the /admin/profiles endpoints (enabled with CELEBRIA_PROFILING=1)
+instalar_perfilador(app)
+
+# Fingerprinted, precompressed static assets and conditional GET for images
+instalar_estaticos(app)
+
+# One capture job per browser (cookie) with its own folder under personas/
+instalar_trabajos(app)
+
+# Embedding model (CELEBRIA_MODEL) and the models a capture may ask for (CELEBRIA_MODELS, comma separated).
+# Each model has its own index: representations.pkl for VGG-Face, representations_<model>.pkl for the rest.
+MODELO = os.environ.get("CELEBRIA_MODEL", DEFAULT_MODEL)
+MODELOS = [m.strip() for m in os.environ.get("CELEBRIA_MODELS", MODELO).split(",") if m.strip()]
+# Models loaded at startup: the default one and the lighter one the "degraded" quality tier switches to
+# (CELEBRIA_QOS_MODEL, see calidad.py), so the first capture that degrades at rush hour doesn't load it
+MODELOS_PRECARGA = [MODELO] + ([MODELO_LIGERO] if MODELO_LIGERO in MODELOS and MODELO_LIGERO != MODELO else [])
+
 # Paths for the celebrity embeddings and image dataset
-EMBEDDINGS_PATH = "representations.pkl"
+EMBEDDINGS_PATH = index_path(MODELO)
 IMDB_IMAGES_PATH = "imdb_data_set"
 
 # Ensure the personas directory exists
@@ -28,14 +72,74 @@ os.makedirs('personas', exist_ok=True)
 # Ensure the face-db directory exists
 os.makedirs('face-db', exist_ok=True)
 
-# Load celebrity embeddings at startup
-try:
-    celebrity_df = load_embeddings(EMBEDDINGS_PATH)
-    print(f"Successfully loaded {len(celebrity_df)} celebrity embeddings")
-except Exception as e:
-    print(f"Warning: Failed to load celebrity embeddings: {e}")
-    print("Using empty DataFrame as fallback")
-    celebrity_df = pd.DataFrame()
+def indice_vacio(modelo):
+    """
+    Crea un índice sin famosos, para seguir respondiendo mientras no haya uno que cargar.
+    
+    :param modelo: Nombre del modelo de embeddings.
+    :return: CelebrityIndex vacío.
+    """
+    return CelebrityIndex(pd.DataFrame(columns=['celebrity_name', 'gender', 'full_path', 'face_vector_raw']), modelo)
+
+def cargar_indice(modelo, ruta=None):
+    """
+    Carga el índice de famosos de un modelo.
+    
+    :param modelo: Nombre del modelo de embeddings.
+    :param ruta: Archivo del índice (por defecto, el del modelo).
+    :return: CelebrityIndex.
+    """
+    ruta = ruta or index_path(modelo)
+    indice = CelebrityIndex.load(ruta, modelo)
+    print(f"Successfully loaded {len(indice)} {modelo} celebrity embeddings from {ruta}")
+    return indice
+
+# Celebrity index of each model, swapped atomically on reload (see indices.py).
+# The models in MODELOS_PRECARGA are loaded at startup; the others are loaded on first use.
+indices_famosos = AlmacenIndices(cargar_indice, index_path, indice_vacio)
+for _modelo in MODELOS_PRECARGA:
+    indices_famosos.precargar(_modelo)
+
+# /admin/index and /admin/index/reload
+instalar_recarga(app, indices_famosos, MODELO, MODELOS)
+
+def indice_famosos(modelo=MODELO):
+    """
+    Devuelve la versión vigente del índice de famosos de un modelo, cargándolo la primera vez.
+    
+    :param modelo: Nombre del modelo de embeddings.
+    :return: VersionIndice (el CelebrityIndex está en .indice).
+    """
+    return indices_famosos.actual(modelo)
+
+# Faces from concurrent captures are embedded and searched together (CELEBRIA_BATCH_WINDOW_MS, see lotes.py)
+agrupador = AgrupadorLotes(get_face_embeddings, extract_vector, top_n=MAX_CANDIDATOS) if VENTANA_MS > 0 else None
+
+# Face detection and embeddings in separate processes fed through shared memory
+# (CELEBRIA_INFERENCE_PROCESSES, see inferencia.py); the index search stays here
+pool_inferencia = PoolInferencia() if PROCESOS > 0 else None
+
+# Cheaper detection, search and model settings when a capture would not finish within its
+# latency budget (CELEBRIA_LATENCY_BUDGET_S, see calidad.py)
+control_calidad = ControlCalidad()
+
+def calentar_modelos():
+    """
+    Construye los backends de embeddings de MODELOS_PRECARGA en este proceso, para que la primera captura
+    (o la primera que baja al nivel "degraded") no pague la carga del modelo.
+    
+    Con procesos de inferencia (CELEBRIA_INFERENCE_PROCESSES) los modelos viven en ellos y no se hace nada.
+    """
+    if pool_inferencia is not None:
+        return
+    for modelo in MODELOS_PRECARGA:
+        get_embedding_backend(modelo).warm_up()
+        print(f"Warmed up {modelo} embedding backend")
+
+@app.before_request
+def _marcar_llegada():
+    """Stamp when the request reached Flask, so the latency budget counts from there and not from detection"""
+    g.llegada = time.monotonic()
 
 @app.route('/')
 def index():
@@ -55,202 +159,381 @@ def resultado():
 @app.route('/process_image', methods=['POST'])
 def process_image():
     """Process the captured image and find celebrity matches"""
-    try:
-        # Get the image data from the request
-        image_data = request.json.get('image')
-        
-        # Get the gender filter if present
-        gender = request.json.get('gender')
-        
-        # Remove the data URL prefix
-        image_data = image_data.split(',')[1]
-        
-        # Decode the base64 image
-        image_bytes = base64.b64decode(image_data)
-        
-        # Convert to numpy array
-        nparr = np.frombuffer(image_bytes, np.uint8)
-        
-        # Decode the image
-        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        
-        # Save the original image
-        original_path = "personas/foto.jpg"
-        cv2.imwrite(original_path, image)
-        
-        # Process the image and wait for results
-        results = procesar_imagen(original_path, gender)
-        
-        # Check if we have valid results
-        if not results or len(results) == 0:
-            return jsonify({"success": False, "error": "No faces detected"})
-        
-        return jsonify({
-            "success": True, 
-            "redirect": "/resultado",
-            "faces_detected": len(results)
-        })
-    
-    except Exception as e:
-        print(f"Error in process_image: {str(e)}")
-        return jsonify({"success": False, "error": str(e)})
+    trabajo = trabajo_actual()
+    trabajo.nueva_captura()
+    return jsonify(procesar_peticion(request.json, trabajo, g.llegada))
+
+@app.route('/cancel_processing', methods=['POST'])
+def cancel_processing():
+    """Cancel the capture being processed, because the visitor left or gave up waiting"""
+    return jsonify(cancelar_procesamiento(trabajo_actual()))
 
 @app.route('/get_results')
 def get_results():
-    """Get the results from the JSON files"""
+    """Get the results of the current capture job"""
+    return jsonify(leer_resultados(trabajo_actual()))
+
+@app.route('/more_results/<int:n>')
+def more_results(n):
+    """Get the next page of ranked lookalikes for a detected face"""
     try:
-        results = []
-        # Read all JSON files in the personas directory
-        json_files = [file for file in os.listdir('personas') if file.startswith('json_persona') and file.endswith('.json')]
-        
-        # Log the number of JSON files found
-        print(f"Found {len(json_files)} JSON files: {json_files}")
-        
-        for file in json_files:
-            with open(os.path.join('personas', file), 'r') as f:
-                result_data = json.load(f)
-                # Log each result file content summary
-                print(f"File {file} contains data for persona: {result_data.get('cara_detectada')}")
-                results.append(result_data)
-        
-        # Return more diagnostic information
-        return jsonify({
-            "success": True,
-            "file_count": len(json_files),
-            "file_names": json_files,
-            "results": results
-        })
-    
-    except Exception as e:
-        print(f"Error in get_results: {str(e)}")
-        return jsonify({"error": str(e), "success": False})
+        pagina = mas_resultados(trabajo_actual(), n, request.args.get('cursor'),
+                                request.args.get('limit', 3, type=int))
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    if pagina is None:
+        return jsonify({"success": False, "error": "Result not found"}), 404
+    return jsonify(pagina)
 
 @app.route('/face-db/<path:filename>')
 def serve_image(filename):
-    """Serve images from the face-db directory"""
-    return send_from_directory('face-db', filename)
+    """Serve images from the face-db directory, resized and re-encoded on request"""
+    with metricas.etapa("image_serving"):
+        return servir_imagen_adaptada('face-db', filename)
+
+@app.route('/result_card/<int:n>')
+def result_card(n):
+    """Render the shareable result card for a detected face"""
+    try:
+        card = generar_tarjeta(trabajo_actual(), n)
+        if card is None:
+            return jsonify({"success": False, "error": "Result not found"}), 404
+        return Response(card, mimetype='image/jpeg')
+    
+    except Exception as e:
+        print(f"Error in result_card: {str(e)}")
+        return jsonify({"success": False, "error": str(e)}), 500
 
 @app.route('/personas/<path:filename>')
 def serve_persona_image(filename):
-    """Serve images from the personas directory"""
-    return send_from_directory('personas', filename)
+    """Serve images from the personas directory, resized and re-encoded on request"""
+    with metricas.etapa("image_serving"):
+        return servir_imagen_adaptada('personas', filename)
 
 @app.route('/clear_data', methods=['POST'])
 def clear_data():
-    """Clear the data in the personas directory"""
-    try:
-        # Ensure the personas directory exists
-        os.makedirs('personas', exist_ok=True)
-        
-        # Delete all files in the personas directory
-        borrar_contenido_carpeta_flask("personas")
-        
-        # Add a small delay to ensure files are cleared
-        time.sleep(0.5)
-        
-        # Return success response
-        return jsonify({"success": True, "message": "Data cleared successfully", "timestamp": time.time()})
-    except Exception as e:
-        print(f"Error clearing data: {e}")
-        return jsonify({"success": False, "error": str(e)})
+    """Drop the current capture job and start a new one"""
+    respuesta, g.trabajo = limpiar_datos(trabajo_actual())
+    return jsonify(respuesta)
 
 @app.route('/process_status', methods=['GET'])
 def process_status():
     """Check the status of the image processing"""
+    return jsonify(estado_procesamiento(trabajo_actual()))
+
+# Request handlers shared by the Flask routes and the ASGI variant (asgi.py).
+# They take plain data and return dictionaries ready to be serialized as JSON.
+
+def procesar_peticion(datos, trabajo, llegada=None):
+    """
+    Decodifica la foto enviada por el navegador y ejecuta el pipeline completo.
+    
+    :param datos: Cuerpo JSON de /process_image (imagen en data URL, género y, opcionalmente, id del photocall).
+    :param trabajo: Trabajo del navegador que envía la foto.
+    :param llegada: time.monotonic() de cuando llegó la petición, si esperó en una cola (por defecto, ahora).
+    :return: Diccionario con el resultado para el navegador.
+    """
+    metricas.ajustar("processing_in_flight", 1)
     try:
-        # Check if the original image exists
-        if not os.path.exists('personas/foto.jpg'):
-            return jsonify({
-                "status": "waiting", 
-                "message": "Esperando imagen..."
-            })
+        trabajo.cambiar_estado("detectando")
         
-        # Check if there are any JSON files in the personas directory
-        json_files = [f for f in os.listdir('personas') if f.startswith('json_persona') and f.endswith('.json')]
+        # The visitor may have left while the capture waited for a worker
+        trabajo.comprobar_cancelacion("queue")
         
-        if not json_files:
-            # Check if face detection has started
-            face_files = [f for f in os.listdir('personas') if f.startswith('foto') and f.endswith('.jpg') and f != 'foto.jpg']
-            if face_files:
-                return jsonify({
-                    "status": "processing", 
-                    "message": "Buscando coincidencias con famosos..."
-                })
-            else:
-                return jsonify({
-                    "status": "processing", 
-                    "message": "Detectando rostros en la imagen..."
-                })
+        # Get the gender filter if present
+        gender = datos.get('gender')
         
-        # Read the first JSON file to check if it has matches
-        with open(os.path.join('personas', json_files[0]), 'r') as f:
-            data = json.load(f)
+        # Embedding model for this capture (must be one of CELEBRIA_MODELS)
+        modelo = datos.get('model') or MODELO
+        if modelo not in MODELOS or modelo not in MODEL_INPUT_SIZES:
+            trabajo.cambiar_estado("error", f"Modelo no disponible: {modelo}")
+            return {"success": False, "error": f"Unknown model '{modelo}'. Available models: {', '.join(MODELOS)}"}
         
-        if not data.get('matches') or len(data.get('matches', [])) == 0:
-            return jsonify({
-                "status": "error", 
-                "message": "No se encontraron coincidencias con famosos"
-            })
+        with metricas.etapa("decode"):
+            # Get the image data from the request
+            image_data = datos.get('image')
+            
+            # Remove the data URL prefix
+            image_data = image_data.split(',')[1]
+            
+            # Decode the base64 image
+            image_bytes = base64.b64decode(image_data)
+            
+            # Convert to numpy array
+            nparr = np.frombuffer(image_bytes, np.uint8)
+            
+            # Decode the image
+            image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+            
+            # Save the original image in the job folder
+            original_path = trabajo.ruta("foto.jpg")
+            cv2.imwrite(original_path, image)
+        
+        # Process the image and wait for results, with the settings that fit in the latency budget
+        with control_calidad.capturar(llegada) as medicion:
+            nivel = medicion.nivel
+            modelo = nivel.modelo(modelo, MODELOS)
+            medicion.modelo = modelo
+            results, candidatos = procesar_imagen(original_path, trabajo, gender, modelo, image, nivel,
+                                                  str(datos.get('kiosk') or trabajo.id)[:64])
+            medicion.caras = len(results or ())
         
-        return jsonify({
-            "status": "complete", 
-            "message": "¡Coincidencias encontradas! Redirigiendo..."
-        })
+        # Check if we have valid results
+        if not results or len(results) == 0:
+            trabajo.cambiar_estado("error", "No se detectaron rostros en la imagen")
+            return {"success": False, "error": "No faces detected"}
+        
+        if not results[0].get('matches'):
+            trabajo.cambiar_estado("error", "No se encontraron coincidencias con famosos")
+        else:
+            with metricas.etapa("serialization"):
+                trabajo.cambiar_estado("completo", resultados=results, candidatos=candidatos)
+        
+        return {
+            "success": True, 
+            "redirect": "/resultado",
+            "faces_detected": len(results)
+        }
+    
+    except CapturaCancelada as e:
+        print(f"Job {trabajo.id}: {e}")
+        trabajo.cambiar_estado("cancelado")
+        return {"success": False, "cancelled": True, "error": "Processing cancelled"}
+    
+    except Exception as e:
+        print(f"Error in process_image: {str(e)}")
+        trabajo.cambiar_estado("error", f"Error en el procesamiento: {str(e)}")
+        return {"success": False, "error": str(e)}
+    finally:
+        metricas.ajustar("processing_in_flight", -1)
+
+def leer_resultados(trabajo):
+    """
+    Devuelve los resultados de cada cara detectada en la captura del trabajo.
+    
+    :param trabajo: Trabajo del navegador.
+    :return: Diccionario con los resultados e información de diagnóstico.
+    """
+    results = trabajo.resultados
+    logger.debug(f"Job {trabajo.id} has results for {len(results)} faces")
+    return {
+        "success": True,
+        "job": trabajo.id,
+        "face_count": len(results),
+        "results": results
+    }
+
+def mas_resultados(trabajo, n, cursor=None, limite=3):
+    """
+    Devuelve la siguiente página de famosos parecidos a una cara, de la lista que guardó su búsqueda.
+    
+    Solo se copian a face-db las imágenes de los famosos de la página pedida.
     
+    :param trabajo: Trabajo del navegador.
+    :param n: Número de la cara detectada, empezando en 1.
+    :param cursor: Cursor de la página anterior (next_cursor), o None para seguir tras los 3 primeros.
+    :param limite: Famosos por página.
+    :return: Diccionario con la página, o None si no hay lista para esa cara.
+    :raises ValueError: Si el cursor no es válido o es de otra captura.
+    """
+    pagina = trabajo.pagina_candidatos(n, cursor, limite)
+    if pagina is None:
+        return None
+    rutas = []
+    for candidato in pagina["candidatos"]:
+        try:
+            rutas.append(copiar_a_face_db(candidato["name"], candidato["source"]))
+        except Exception as e:
+            print(f"Error copying celebrity image {candidato['source']}: {e}")
+            error_path = f"face-db/error_{len(rutas)}.jpg"
+            create_placeholder_image(error_path, "Image not found")
+            rutas.append(error_path)
+    # Same names as the first 3 matches, taken from the face-db file name
+    nombres = sacar_nombre_ruta(rutas)
+    matches = [{"name": nombre, "similarity": candidato["similarity"], "image_data": ruta}
+               for nombre, candidato, ruta in zip(nombres, pagina["candidatos"], rutas)]
+    return {
+        "success": True,
+        "face": n,
+        "matches": matches,
+        "next_cursor": pagina["next_cursor"],
+        "total": pagina["total"]
+    }
+
+def generar_tarjeta(trabajo, n):
+    """
+    Genera la tarjeta para compartir de la cara detectada número n.
+    
+    :param trabajo: Trabajo del navegador.
+    :param n: Número de la cara detectada, empezando en 1.
+    :return: Bytes JPEG de la tarjeta, o None si no hay resultado para esa cara.
+    """
+    if n < 1 or n > len(trabajo.resultados):
+        return None
+    result_data = trabajo.resultados[n - 1]
+    
+    matches = [(m['name'], m['similarity'], m['image_data']) for m in result_data.get('matches', [])]
+    user_image = result_data.get('cara_detectada') or result_data.get('persona')
+    
+    # Render the card in memory so several cards can be served concurrently
+    return render_result_card(user_image, matches, similarity_format="{:.2f}%")
+
+def limpiar_datos(trabajo):
+    """
+    Descarta la captura anterior del navegador y le asigna un trabajo nuevo.
+    
+    La carpeta del trabajo anterior se borra en segundo plano (trabajos.py).
+    
+    :param trabajo: Trabajo actual del navegador.
+    :return: Tupla (respuesta, trabajo nuevo para el navegador).
+    """
+    try:
+        nuevo = registro.reemplazar(trabajo)
+        return {"success": True, "message": "Data cleared successfully", "timestamp": time.time()}, nuevo
     except Exception as e:
-        return jsonify({
-            "status": "error", 
-            "message": f"Error en el procesamiento: {str(e)}"
-        })
+        print(f"Error clearing data: {e}")
+        return {"success": False, "error": str(e)}, trabajo
+
+def estado_procesamiento(trabajo):
+    """
+    Comprueba en qué punto está el procesamiento de la captura actual.
+    
+    Cada consulta cuenta como señal de que el visitante sigue esperando (ver trabajos.py).
+    
+    :param trabajo: Trabajo del navegador.
+    :return: Diccionario con el estado (waiting, processing, complete, error o cancelled) y un mensaje.
+    """
+    trabajo.latido()
+    return trabajo.estado_publico()
+
+def cancelar_procesamiento(trabajo):
+    """
+    Cancela la captura en curso del trabajo; el pipeline se detiene en su siguiente punto de cancelación.
+    
+    :param trabajo: Trabajo del navegador.
+    :return: Diccionario que indica si había una captura que cancelar.
+    """
+    return {"success": True, "cancelled": trabajo.cancelar()}
 
 # Backend functions using celebrity2.py logic
 
-def detectar_personas(ruta_front):
+def detectar_personas(ruta_front, trabajo, imagen=None):
     """
     Detecta las caras en una imagen y guarda cada cara detectada como una imagen separada.
     
     :param ruta_front: Ruta de la imagen donde se detectarán las caras.
+    :param trabajo: Trabajo en cuya carpeta se guardan las caras.
+    :param imagen: Imagen ya decodificada (BGR) en la que buscar las caras, o None para leer ruta_front.
     :return: Lista de rutas de las imágenes de las caras detectadas.
     """
     try:
-        # Intentar extraer caras de la imagen
-        faces = DeepFace.extract_faces(ruta_front, enforce_detection=False)
+        # Extraer las caras con la cascada de detectores (CELEBRIA_DETECTORS, ver detectores.py)
+        with metricas.etapa("detection"):
+            faces = detectar_caras(ruta_front if imagen is None else imagen)
         lista_rutas = []
         
         if not faces or len(faces) == 0:
             print("No faces detected, using original image")
-            # Si no se detectan caras, usar la imagen original
-            shutil.copy(ruta_front, "personas/foto0.jpg")
-            lista_rutas.append("personas/foto0.jpg")
+            # Si ningún detector de la cascada encuentra caras, usar la imagen original
+            shutil.copy(ruta_front, trabajo.ruta("foto0.jpg"))
+            lista_rutas.append(trabajo.ruta("foto0.jpg"))
         else:
-            # Procesar cada cara detectada
-            for i in range(len(faces)):
-                face_array = faces[i]['face']  # Obtener el array de la cara detectada
-                face_array = (face_array * 255).astype(np.uint8)  # Convertir a formato de imagen
-                face_image = Image.fromarray(face_array)  # Convertir el array en una imagen PIL
-                face_image.save(f"personas/foto{i}.jpg")  # Guardar la imagen
-                lista_rutas.append(f"personas/foto{i}.jpg")  # Añadir la ruta a la lista
+            # Procesar cada cara alineada: normalizar el recorte y guardarlo
+            with metricas.etapa("alignment"):
+                for i in range(len(faces)):
+                    face_array = faces[i]['face']  # Obtener el array de la cara detectada
+                    face_array = (face_array * 255).astype(np.uint8)  # Convertir a formato de imagen
+                    face_image = Image.fromarray(face_array)  # Convertir el array en una imagen PIL
+                    face_image.save(trabajo.ruta(f"foto{i}.jpg"))  # Guardar la imagen
+                    lista_rutas.append(trabajo.ruta(f"foto{i}.jpg"))  # Añadir la ruta a la lista
     
     except Exception as e:
         print(f"Error detecting faces: {e}")
         # En caso de error, usar la imagen original
-        shutil.copy(ruta_front, "personas/foto0.jpg")
-        lista_rutas = ["personas/foto0.jpg"]
+        shutil.copy(ruta_front, trabajo.ruta("foto0.jpg"))
+        lista_rutas = [trabajo.ruta("foto0.jpg")]
     
     return lista_rutas
 
-def hacer_json(lista_personas, n, lista_ruta_famosos, lista_nombre_famosos, lista_parecidos):
+def detectar_personas_fuera_de_proceso(ruta_front, imagen, trabajo, modelo):
+    """
+    Detecta las caras y calcula sus embeddings en un proceso de inferencia (inferencia.py)
+    y guarda cada cara detectada como una imagen separada.
+    
+    :param ruta_front: Ruta de la imagen original.
+    :param imagen: Imagen original ya decodificada (BGR), o None para leerla de ruta_front.
+    :param trabajo: Trabajo en cuya carpeta se guardan las caras.
+    :param modelo: Modelo de embeddings.
+    :return: Tupla (lista de rutas de las caras, vector del embedding de cada una).
+    """
+    if imagen is None:
+        imagen = cv2.imread(ruta_front)
+    with metricas.etapa("inference_process"):
+        resultado = pool_inferencia.analizar(imagen, modelo)
+    
+    # Los recortes apuntan a la memoria compartida: se guardan antes de liberar la ranura
+    with resultado:
+        if not resultado.caras:
+            print("No faces detected, using original image")
+            shutil.copy(ruta_front, trabajo.ruta("foto0.jpg"))
+            return [trabajo.ruta("foto0.jpg")], resultado.vectores
+        
+        lista_rutas = []
+        with metricas.etapa("alignment"):
+            for i, cara in enumerate(resultado.caras):
+                Image.fromarray(cara).save(trabajo.ruta(f"foto{i}.jpg"))
+                lista_rutas.append(trabajo.ruta(f"foto{i}.jpg"))
+        return lista_rutas, resultado.vectores
+
+def buscar_vectores(vectores, version, gender_filter, esfuerzo=1.0):
+    """
+    Busca a la vez en el índice los embeddings ya calculados de las caras de una captura.
+    
+    :param vectores: Vector del embedding de cada cara.
+    :param version: Versión del índice en la que se busca.
+    :param gender_filter: Filtro de género ya convertido, o None.
+    :param esfuerzo: Fracción de las fases aproximadas de la búsqueda (ver calidad.py).
+    :return: Un Future ya resuelto por cara, como los del agrupador de lotes.
+    """
+    busquedas = [Future() for _ in vectores]
+    try:
+        with metricas.etapa("search"):
+            resultados = version.indice.search_batch(vectores, MAX_CANDIDATOS, [gender_filter] * len(vectores),
+                                                     esfuerzo)
+        for busqueda, resultado in zip(busquedas, resultados):
+            busqueda.set_result(resultado)
+    except Exception as e:
+        for busqueda in busquedas:
+            busqueda.set_exception(e)
+    return busquedas
+
+def esperar_busqueda(busqueda, trabajo, caras_pendientes):
+    """
+    Espera a que el agrupador de lotes resuelva la búsqueda de una cara, comprobando mientras tanto
+    si la captura se ha cancelado.
+    
+    :param busqueda: Future de la búsqueda de la cara.
+    :param trabajo: Trabajo al que pertenece la captura.
+    :param caras_pendientes: Caras de la captura que aún no tienen resultado.
+    :raises CapturaCancelada: Si la captura se cancela antes de que llegue el resultado.
+    """
+    while not wait([busqueda], timeout=INTERVALO_CANCELACION).done:
+        trabajo.comprobar_cancelacion("search", caras_pendientes)
+
+def hacer_json(trabajo, lista_personas, n, lista_ruta_famosos, lista_nombre_famosos, lista_parecidos):
     """
-    Crea un archivo JSON con la información de las personas detectadas y sus coincidencias.
+    Crea el resultado (serializable a JSON) de una persona detectada y sus coincidencias.
     
+    :param trabajo: Trabajo al que pertenece la captura.
     :param lista_personas: Lista de rutas de las imágenes de las personas detectadas.
     :param n: Índice de la persona actual en la lista.
     :param lista_ruta_famosos: Lista de rutas de las imágenes de los famosos parecidos.
     :param lista_nombre_famosos: Lista de nombres de los famosos parecidos.
     :param lista_parecidos: Lista de porcentajes de similitud con los famosos.
+    :return: Diccionario con la persona y sus coincidencias.
     """
     # Siempre usar la imagen original para mostrar en el cuadrado pequeño
-    original_image = "personas/foto.jpg"
+    original_image = trabajo.ruta("foto.jpg")
     
     if len(lista_personas) > 1:
         data = {
@@ -273,12 +556,7 @@ def hacer_json(lista_personas, n, lista_ruta_famosos, lista_nombre_famosos, list
                 "image_data": lista_ruta_famosos[i]  # Ruta de la imagen del famoso
             })
 
-    # Convertir el diccionario a formato JSON
-    json_data = json.dumps(data, indent=4)
-
-    # Escribir el JSON en un archivo
-    with open(f"personas/json_persona{n+1}.json", "w") as json_file:
-        json_file.write(json_data)
+    return data
 
 def sacar_nombre_ruta(lista_rutas_celebridades):
     """
@@ -304,57 +582,113 @@ def sacar_nombre_ruta(lista_rutas_celebridades):
     
     return nombres
 
-def encontrar_3_mas_parecidos(ruta_cara, gender=None):
+# Celebrity images already copied to face-db by this process (saves a stat per match)
+_copias_face_db = set()
+
+def filtro_genero(gender):
+    """
+    Convierte el género recibido del navegador en el filtro de la búsqueda.
+    
+    :param gender: Género tal como llega en la petición (número, texto o None).
+    :return: Género como float, o None para no filtrar.
+    """
+    if gender is None:
+        return None
+    try:
+        gender_filter = float(gender)
+        print(f"Using gender filter: {gender_filter}")
+        return gender_filter
+    except ValueError:
+        print(f"Invalid gender value: {gender}, ignoring gender filter")
+        return None
+
+def buscar_famosos(ruta_cara, gender_filter, modelo, version, esfuerzo=1.0):
+    """
+    Calcula el embedding de una cara y busca los MAX_CANDIDATOS famosos más parecidos en el índice.
+    
+    :param ruta_cara: Ruta de la imagen de la cara.
+    :param gender_filter: Filtro de género ya convertido (ver filtro_genero), o None.
+    :param modelo: Modelo de embeddings.
+    :param version: Versión del índice en la que se busca.
+    :param esfuerzo: Fracción de las fases aproximadas de la búsqueda (ver calidad.py).
+    :return: Lista de (etiqueta de la fila, similitud).
+    """
+    if agrupador is not None:
+        return agrupador.enviar(ruta_cara, modelo, version, gender_filter, esfuerzo).result()
+    
+    # Get the face embedding
+    with metricas.etapa("embedding"):
+        user_embedding = get_face_embedding(ruta_cara, modelo)
+    
+    # Find the ranked list of similar celebrities with gender filter (the first 3 are shown, the rest paginated)
+    with metricas.etapa("search"):
+        return find_similar_celebrities(user_embedding, version.indice, top_n=MAX_CANDIDATOS, gender=gender_filter,
+                                        effort=esfuerzo)
+
+def copiar_a_face_db(nombre, path):
+    """
+    Copia la imagen de un famoso a face-db para servirla, reutilizando la copia de un visitante anterior.
+    
+    :param nombre: Nombre del famoso.
+    :param path: Ruta de la imagen en el conjunto de datos.
+    :return: Ruta de la imagen en face-db.
+    """
+    target_path = f"face-db/{nombre.replace(' ', '_')}.jpg"
+    if target_path in _copias_face_db or os.path.exists(target_path):
+        metricas.acierto_cache("face_db", True)
+    elif os.path.exists(path):
+        metricas.acierto_cache("face_db", False)
+        shutil.copy(path, target_path)
+    else:
+        # Create a placeholder image if original not found
+        metricas.acierto_cache("face_db", False)
+        create_placeholder_image(target_path, nombre)
+    _copias_face_db.add(target_path)
+    return target_path
+
+def encontrar_3_mas_parecidos(ruta_cara, gender=None, modelo=MODELO, version=None, busqueda=None, esfuerzo=1.0):
     """
     Encuentra las 3 imágenes más parecidas en la base de datos de celebrities.
     Usa celebrity2.py para encontrar coincidencias.
     
     :param ruta_cara: Ruta de la imagen de la cara a comparar.
     :param gender: Filtro de género para la búsqueda.
-    :return: Lista de rutas de las imágenes más parecidas y sus porcentajes de similitud.
+    :param modelo: Modelo de embeddings; se busca en el índice de ese modelo.
+    :param version: Versión del índice a usar (por defecto, la vigente del modelo).
+    :param busqueda: Future de una búsqueda de esta cara ya enviada al agrupador de lotes, si la hay.
+    :param esfuerzo: Fracción de las fases aproximadas de la búsqueda (ver calidad.py).
+    :return: Lista de rutas de las imágenes más parecidas, sus porcentajes de similitud y la lista
+             ordenada de todos los candidatos de la búsqueda (nombre, similitud y ruta en el conjunto de datos).
     """
     try:
-        # Convert gender to float if it's provided as a string
-        gender_filter = None
-        if gender is not None:
-            try:
-                gender_filter = float(gender)
-                print(f"Using gender filter: {gender_filter}")
-            except ValueError:
-                print(f"Invalid gender value: {gender}, ignoring gender filter")
-        
-        # Get the face embedding
-        user_embedding = get_face_embedding(ruta_cara)
+        version = version or indice_famosos(modelo)
+        celebrity_df = version.indice.df
+        if busqueda is not None:
+            top_matches = busqueda.result()
+        else:
+            top_matches = buscar_famosos(ruta_cara, filtro_genero(gender), modelo, version, esfuerzo)
         
-        # Find similar celebrities (top 3) with gender filter
-        top_matches = find_similar_celebrities(user_embedding, celebrity_df, top_n=3, gender=gender_filter)
+        # Ranked list of every candidate, kept by the job for "show more" pagination
+        candidatos = []
+        for idx, similarity in top_matches:
+            celebrity = celebrity_df.loc[idx]
+            candidatos.append({
+                "name": celebrity['celebrity_name'],
+                # Convert similarity to percentage (0-100)
+                "similarity": round(float(similarity) * 100, 2),
+                "source": f"{IMDB_IMAGES_PATH}/{celebrity['full_path'][0]}"
+            })
         
-        # Extract paths and similarities
+        # Extract paths and similarities of the 3 shown now
         rutas_imagen = []
         porcentage_parecidos = []
         
-        for idx, similarity in top_matches:
-            # Get celebrity path
-            celebrity = celebrity_df.loc[idx]
-            path = f"{IMDB_IMAGES_PATH}/{celebrity['full_path'][0]}"
-            
-            # Copy the image to face-db for serving
-            filename = f"{celebrity['celebrity_name'].replace(' ', '_')}.jpg"
-            target_path = f"face-db/{filename}"
-            
+        for candidato in candidatos[:3]:
+            path = candidato["source"]
             try:
-                # Copy the celebrity image to face-db
-                if os.path.exists(path):
-                    shutil.copy(path, target_path)
-                else:
-                    # Create a placeholder image if original not found
-                    create_placeholder_image(target_path, celebrity['celebrity_name'])
-                
-                rutas_imagen.append(target_path)
-                
-                # Convert similarity to percentage (0-100)
-                similarity_pct = round(similarity * 100, 2)
-                porcentage_parecidos.append(similarity_pct)
+                # Copy the celebrity image to face-db for serving
+                rutas_imagen.append(copiar_a_face_db(candidato["name"], path))
+                porcentage_parecidos.append(candidato["similarity"])
                 
             except Exception as e:
                 print(f"Error copying celebrity image {path}: {e}")
@@ -371,7 +705,7 @@ def encontrar_3_mas_parecidos(ruta_cara, gender=None):
             rutas_imagen.append(error_path)
             porcentage_parecidos.append(30.0 - (5.0 * len(rutas_imagen)))
             
-        return rutas_imagen[:3], porcentage_parecidos[:3]
+        return rutas_imagen[:3], porcentage_parecidos[:3], candidatos
         
     except Exception as e:
         print(f"Error finding similar celebrities: {e}")
@@ -386,7 +720,7 @@ def encontrar_3_mas_parecidos(ruta_cara, gender=None):
             rutas_imagen.append(error_path)
             porcentage_parecidos.append(30.0 - (5.0 * i))
             
-        return rutas_imagen, porcentage_parecidos
+        return rutas_imagen, porcentage_parecidos, []
 
 def create_placeholder_image(path, text):
     """Create a placeholder image with text"""
@@ -404,64 +738,85 @@ def create_placeholder_image(path, text):
     # Save the image
     cv2.imwrite(path, img)
 
-def procesar_imagen(original_path, gender=None):
-    """Process the image using celebrity2.py and return the results"""
-    # Detect faces
-    lista_personas = detectar_personas(original_path)
+def procesar_imagen(original_path, trabajo, gender=None, modelo=MODELO, imagen=None, nivel=None, origen=None):
+    """Process the image using celebrity2.py and return the results and the ranked candidates of each face"""
+    # Source (kiosk) whose turns of the fair scheduler this capture uses (planificador.py)
+    origen = origen or trabajo.id
+    # Quality tier chosen for the latency budget (calidad.py): downscaled detection and a cheaper search
+    nivel = nivel or control_calidad.niveles[0]
+    if nivel.lado_deteccion is not None:
+        imagen = nivel.imagen_deteccion(imagen if imagen is not None else cv2.imread(original_path))
+    
+    trabajo.comprobar_cancelacion("detection")
+    
+    # Detect faces, in an inference process if there is a pool (then the embeddings come back too)
+    vectores = None
+    with planificador.turno(origen, al_esperar=lambda: trabajo.comprobar_cancelacion("detection")):
+        if pool_inferencia is not None:
+            try:
+                lista_personas, vectores = detectar_personas_fuera_de_proceso(original_path, imagen, trabajo, modelo)
+            except ValueError as e:
+                # Frames too large for a shared memory slot are processed here
+                print(f"{e}; processing it in the web process")
+        if vectores is None:
+            lista_personas = detectar_personas(original_path, trabajo, imagen)
+    trabajo.comprobar_cancelacion("search", len(lista_personas))
+    trabajo.cambiar_estado("buscando")
     results = []
+    candidatos = []
     
     # Log the gender value received
     print(f"Processing image with gender filter: {gender}")
     
+    # All the faces of a capture are searched in the same index version, even if it is reloaded meanwhile
+    version = indice_famosos(modelo)
+    
+    # With batching, send every face at once so they share a batch with each other and with other captures
+    busquedas = [None] * len(lista_personas)
+    if vectores is not None:
+        busquedas = buscar_vectores(vectores, version, filtro_genero(gender), nivel.esfuerzo)
+    elif agrupador is not None:
+        gender_filter = filtro_genero(gender)
+        busquedas = [agrupador.enviar(ruta, modelo, version, gender_filter, nivel.esfuerzo) for ruta in lista_personas]
+    
     # Process each detected face
     for i in range(len(lista_personas)):
+        try:
+            trabajo.comprobar_cancelacion("search", len(lista_personas) - i)
+            if busquedas[i] is not None:
+                esperar_busqueda(busquedas[i], trabajo, len(lista_personas) - i)
+        except CapturaCancelada:
+            # Faces still waiting for a batch are dropped from it
+            for busqueda in busquedas[i:]:
+                if busqueda is not None:
+                    busqueda.cancel()
+            raise
+        
+        # Without a batch the embedding and search of each face take one turn, so other captures
+        # can be served between the faces of a group photo
+        turno = nullcontext() if busquedas[i] is not None else planificador.turno(
+            origen, al_esperar=lambda: trabajo.comprobar_cancelacion("search", len(lista_personas) - i))
+        
         # Find the 3 most similar celebrities with gender filter if provided
-        lista_ruta_famosos, lista_parecidos = encontrar_3_mas_parecidos(lista_personas[i], gender)
+        with turno:
+            lista_ruta_famosos, lista_parecidos, ranking = encontrar_3_mas_parecidos(lista_personas[i], gender,
+                                                                                     modelo, version, busquedas[i],
+                                                                                     nivel.esfuerzo)
         
         # Extract celebrity names from paths
         lista_nombre_famosos = sacar_nombre_ruta(lista_ruta_famosos)
         
-        # Create JSON result for this face
-        hacer_json(lista_personas, i, lista_ruta_famosos, lista_nombre_famosos, lista_parecidos)
-        
-        # Create a result object for this person
-        person_result = {
-            "persona": original_path,  # Original image path
-            "cara_detectada": lista_personas[i],  # Detected face path
-            "matches": []
-        }
-        
-        # Add each celebrity match
-        for j in range(len(lista_nombre_famosos)):
-            person_result["matches"].append({
-                "name": lista_nombre_famosos[j],
-                "similarity": lista_parecidos[j],
-                "image_data": lista_ruta_famosos[j]
-            })
-        
-        results.append(person_result)
-    
-    return results
-
-def borrar_contenido_carpeta_flask(carpeta):
-    """
-    Borra el contenido de una carpeta (versión para Flask)
+        # Create the result for this face, recording which model and index version produced it
+        resultado = hacer_json(trabajo, lista_personas, i, lista_ruta_famosos, lista_nombre_famosos, lista_parecidos)
+        resultado["model"] = modelo
+        resultado["index_generation"] = version.generacion
+        resultado["index_version"] = version.version
+        resultado["ranked_matches"] = len(ranking)
+        resultado["qos_tier"] = nivel.nombre
+        results.append(resultado)
+        candidatos.append(ranking)
     
-    :param carpeta: Ruta de la carpeta a borrar
-    """
-    if os.path.exists(carpeta) and os.path.isdir(carpeta):
-        for archivo in os.listdir(carpeta):
-            archivo_path = os.path.join(carpeta, archivo)
-            try:
-                if os.path.isdir(archivo_path):
-                    shutil.rmtree(archivo_path)  # Borrar subcarpeta
-                else:
-                    os.remove(archivo_path)  # Borrar archivo
-            except Exception as e:
-                print(f"No se pudo borrar {archivo_path}: {e}")
-        print(f"Contenido de la carpeta '{carpeta}' ha sido borrado.")
-    else:
-        print(f"La carpeta {carpeta} no existe o no es una carpeta válida.")
+    return results, candidatos
 
 if __name__ == '__main__':
     # Check if the embeddings file exists
@@ -475,4 +830,6 @@ if __name__ == '__main__':
         print("Please make sure to download and extract the IMDB dataset.")
     
     # Start the Flask app
-    app.run(debug=True) 
\ No newline at end of file
+    # Development server only (production: gunicorn -c gunicorn.conf.py wsgi:app).
+    # The reloader runs a second process that loads everything again, so it is opt-in.
+    app.run(debug=True, use_reloader=os.environ.get("CELEBRIA_RELOAD", "0") == "1")
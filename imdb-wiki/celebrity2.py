@@ -1,28 +1,25 @@
 import os
-import pandas as pd
 import numpy as np
 import cv2
-from deepface import DeepFace
-from sklearn.metrics.pairwise import cosine_similarity
-import matplotlib.pyplot as plt
-from matplotlib.gridspec import GridSpec
 import time
 import argparse
+import logging
 
-# Cargar el dataframe de embeddings de celebridades
+from result_card import render_result_card, render_cards_batch
+from embedding_backends import DEFAULT_MODEL, backend_from_env, create_backend
+from celebrity_index import CelebrityIndex, extract_vector, index_path
+
+logger = logging.getLogger(__name__)
+
+# Cargar el dataframe de embeddings de celebridades.
+# pandas se importa aquí para que `celebrity2.py --help` y los imports del módulo no lo carguen.
 def load_embeddings(pkl_path):
+    import pandas as pd
     print(f"Loading celebrity embeddings from {pkl_path}...")
     df = pd.read_pickle(pkl_path)
     print(f"Loaded {len(df)} celebrity embeddings")
     return df
 
-# Extraer el vector del objeto de representación de DeepFace
-def extract_vector(representation):
-    if isinstance(representation, list) and len(representation) > 0:
-        return representation[0]['embedding']
-    else:
-        return representation['embedding']
-
 # Capturar imagen desde la webcam
 def capture_image():
     print("Initializing webcam...")
@@ -89,38 +86,58 @@ def use_existing_photo(photo_path):
     print(f"Using existing photo: {photo_path}")
     return photo_path
 
+# Backends de embeddings (DeepFace u ONNX Runtime, ver embedding_backends.py), uno por modelo.
+# Por defecto se configuran con CELEBRIA_EMBEDDING_BACKEND; la línea de comandos los cambia con --backend.
+_embedding_backends = {}
+
+def get_embedding_backend(model_name=DEFAULT_MODEL):
+    if model_name not in _embedding_backends:
+        _embedding_backends[model_name] = backend_from_env(model_name)
+    return _embedding_backends[model_name]
+
+def set_embedding_backend(backend):
+    _embedding_backends[backend.model_name] = backend
+
 # Obtener el embedding facial para la imagen
-def get_face_embedding(image_path):
+def get_face_embedding(image_path, model_name=DEFAULT_MODEL):
     print("Processing face in the image...")
     try:
-        embedding = DeepFace.represent(
-            img_path=image_path,
-            model_name="VGG-Face",
-            enforce_detection=False
-        )
-        return embedding
+        return get_embedding_backend(model_name).represent(image_path)
     except Exception as e:
         raise Exception(f"Error processing face: {str(e)}")
 
+# Obtener los embeddings de varias imágenes, en lotes si el backend lo permite
+def get_face_embeddings(image_paths, model_name=DEFAULT_MODEL):
+    print(f"Processing faces in {len(image_paths)} images...")
+    try:
+        return get_embedding_backend(model_name).represent_batch(image_paths)
+    except Exception as e:
+        raise Exception(f"Error processing faces: {str(e)}")
+
 # Encontrar las celebridades más similares
-def find_similar_celebrities(user_embedding, celebrity_df, top_n=3, gender=None):
+def find_similar_celebrities(user_embedding, celebrity_df, top_n=3, gender=None, effort=1.0):
     print("Finding celebrity lookalikes...")
     
     # Extraer el vector del embedding del usuario
     user_vector = extract_vector(user_embedding)
     
+    # Con un CelebrityIndex la búsqueda es un producto de matrices (ver celebrity_index.py)
+    if isinstance(celebrity_df, CelebrityIndex):
+        return celebrity_df.search(user_vector, top_n=top_n, gender=gender, effort=effort)
+    
     # Filtrar por género si se especifica
     if gender is not None:
         print(f"Filtering by gender: {gender}")
         
-        # Imprimir los primeros valores de género para verificar el formato
-        print("Sample gender values in dataset:")
-        for i in range(min(5, len(celebrity_df))):
-            print(f"  Index {i}: {celebrity_df['gender'].iloc[i]}, Type: {type(celebrity_df['gender'].iloc[i])}")
+        # Registrar los primeros valores de género para verificar el formato
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Sample gender values in dataset:")
+            for i in range(min(5, len(celebrity_df))):
+                logger.debug(f"  Index {i}: {celebrity_df['gender'].iloc[i]}, Type: {type(celebrity_df['gender'].iloc[i])}")
         
         # Convertir valores de género a enteros si están almacenados como arrays/listas
         if isinstance(celebrity_df['gender'].iloc[0], (list, np.ndarray)):
-            print("Gender values stored as arrays/lists")
+            logger.debug("Gender values stored as arrays/lists")
             filtered_df = celebrity_df[celebrity_df['gender'].apply(lambda x: x[0] == gender)]
         else:
             filtered_df = celebrity_df[celebrity_df['gender'] == gender]
@@ -132,12 +149,12 @@ def find_similar_celebrities(user_embedding, celebrity_df, top_n=3, gender=None)
             print(f"Found {len(filtered_df)} celebrities with specified gender.")
             
         # Verificar los primeros registros en el conjunto de datos filtrado
-        print("First 5 celebrities after filtering:")
-        for i in range(min(5, len(filtered_df))):
-            idx = filtered_df.index[i]
-            gender_val = filtered_df['gender'].iloc[i]
-            name = filtered_df['celebrity_name'].iloc[i]
-            print(f"  {name}: gender={gender_val}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("First 5 celebrities after filtering:")
+            for i in range(min(5, len(filtered_df))):
+                gender_val = filtered_df['gender'].iloc[i]
+                name = filtered_df['celebrity_name'].iloc[i]
+                logger.debug(f"  {name}: gender={gender_val}")
     else:
         filtered_df = celebrity_df
     
@@ -148,7 +165,8 @@ def find_similar_celebrities(user_embedding, celebrity_df, top_n=3, gender=None)
         if raw_vector is not None:
             celebrity_vectors.append((idx, extract_vector(raw_vector)))
     
-    # Calcular similitudes
+    # Calcular similitudes (scikit-learn solo se carga en esta ruta, la del DataFrame)
+    from sklearn.metrics.pairwise import cosine_similarity
     similarities = []
     for idx, celeb_vector in celebrity_vectors:
         similarity = cosine_similarity([user_vector], [celeb_vector])[0][0]
@@ -169,16 +187,26 @@ def find_similar_celebrities(user_embedding, celebrity_df, top_n=3, gender=None)
     top_matches = unique_similarities[:top_n]
     
     # Verificar el género de las coincidencias seleccionadas
-    print("\nVerifying gender of top matches:")
-    for idx, similarity in top_matches:
-        gender_val = celebrity_df.loc[idx, 'gender']
-        name = celebrity_df.loc[idx, 'celebrity_name']
-        print(f"  {name}: gender={gender_val}, similarity={similarity:.2f}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Verifying gender of top matches:")
+        for idx, similarity in top_matches:
+            gender_val = celebrity_df.loc[idx, 'gender']
+            name = celebrity_df.loc[idx, 'celebrity_name']
+            logger.debug(f"  {name}: gender={gender_val}, similarity={similarity:.2f}")
     
     return top_matches
 
+# Preparar las coincidencias (nombre, similitud, ruta de imagen) para la tarjeta de resultados
+def card_matches(top_matches, celebrity_df, base_path):
+    matches = []
+    for idx, similarity in top_matches:
+        celebrity = celebrity_df.loc[idx]
+        celebrity_path = f"{base_path}/{celebrity['full_path'][0]}"
+        matches.append((celebrity['celebrity_name'], similarity, celebrity_path))
+    return matches
+
 # Mostrar los resultados
-def display_results(user_image_path, top_matches, celebrity_df, base_path):
+def display_results(user_image_path, top_matches, celebrity_df, base_path, result_path="celebrity_lookalikes_result.jpg"):
     print("Displaying results...")
     
     # Mostrar las mejores coincidencias de celebridades con información de género
@@ -189,70 +217,26 @@ def display_results(user_image_path, top_matches, celebrity_df, base_path):
         gender_val = celebrity['gender']
         print(f"Match #{i+1}: {celebrity_name}, Gender: {gender_val}, Similarity: {similarity:.2f}")
     
-    # Crear una figura con un diseño de cuadrícula
-    fig = plt.figure(figsize=(15, 10))
-    gs = GridSpec(2, 4, figure=fig)
-    
-    # Mostrar la imagen del usuario
-    user_img = cv2.imread(user_image_path)
-    user_img = cv2.cvtColor(user_img, cv2.COLOR_BGR2RGB)
-    ax_user = fig.add_subplot(gs[0, 1:3])
-    ax_user.imshow(user_img)
-    ax_user.set_title("Your Photo", fontsize=16)
-    ax_user.axis('off')
-    
-    # Mostrar las mejores coincidencias de celebridades
-    for i, (idx, similarity) in enumerate(top_matches):
-        # Obtener información de la celebridad
-        celebrity = celebrity_df.loc[idx]
-        celebrity_name = celebrity['celebrity_name']
-        celebrity_path = f"{base_path}/{celebrity['full_path'][0]}"
-        
-        # Crear subgráfico basado en la posición
-        if i == 0:
-            ax = fig.add_subplot(gs[1, 0:2])
-        elif i == 1:
-            ax = fig.add_subplot(gs[1, 1:3])
-        else:
-            ax = fig.add_subplot(gs[1, 2:4])
-        
-        # Mostrar imagen de la celebridad
-        try:
-            celeb_img = cv2.imread(celebrity_path)
-            celeb_img = cv2.cvtColor(celeb_img, cv2.COLOR_BGR2RGB)
-            ax.imshow(celeb_img)
-        except Exception as e:
-            ax.text(0.5, 0.5, "Image not found", 
-                    horizontalalignment='center', verticalalignment='center')
-        
-        # Añadir leyenda con nombre y puntuación de similitud
-        ax.set_title(f"{celebrity_name}\nSimilarity: {similarity:.2f}", fontsize=14)
-        ax.axis('off')
-    
-    # Añadir un título principal
-    plt.suptitle("Celebrity Lookalikes", fontsize=20)
-    plt.tight_layout()
-    plt.subplots_adjust(top=0.9)
+    # Componer la tarjeta de resultados en memoria
+    card = render_result_card(user_image_path, card_matches(top_matches, celebrity_df, base_path))
     
     # Guardar resultado
-    result_path = "celebrity_lookalikes_result.jpg"
-    plt.savefig(result_path)
+    with open(result_path, "wb") as f:
+        f.write(card)
     print(f"Results saved to {result_path}")
     
-    # Mostrar el resultado
-    plt.show()
-    
     return result_path
 
 # Función principal
-def find_celebrity_lookalikes(pkl_path, imdb_images_base_path, photo_path=None, use_webcam=True, num_matches=3, gender=None):
+def find_celebrity_lookalikes(pkl_path, imdb_images_base_path, photo_path=None, use_webcam=True, num_matches=3, gender=None, result_path="celebrity_lookalikes_result.jpg", model_name=DEFAULT_MODEL):
     try:
         # Cargar los embeddings de celebridades
         celebrity_df = load_embeddings(pkl_path)
         
         # Preparar los vectores para una comparación más rápida
         print("Preprocessing celebrity embeddings...")
-        celebrity_df = celebrity_df.dropna(subset=['face_vector_raw'])
+        index = CelebrityIndex.from_dataframe(celebrity_df, model_name, pkl_path)
+        celebrity_df = index.df
         
         # Obtener la imagen del usuario - ya sea desde la webcam o desde un archivo
         if use_webcam:
@@ -263,16 +247,15 @@ def find_celebrity_lookalikes(pkl_path, imdb_images_base_path, photo_path=None,
             user_image_path = use_existing_photo(photo_path)
         
         # Obtener el embedding facial para la imagen
-        user_embedding = get_face_embedding(user_image_path)
+        user_embedding = get_face_embedding(user_image_path, model_name)
         
         # Encontrar celebridades similares
-        top_matches = find_similar_celebrities(user_embedding, celebrity_df, top_n=num_matches, gender=gender)
+        top_matches = find_similar_celebrities(user_embedding, index, top_n=num_matches, gender=gender)
         
         # Mostrar resultados
-        result_path = display_results(user_image_path, top_matches, celebrity_df, imdb_images_base_path)
+        result_path = display_results(user_image_path, top_matches, celebrity_df, imdb_images_base_path, result_path)
         
-        print("\nDone! Check the matplotlib window for your celebrity lookalikes.")
-        print(f"Results saved to {result_path}")
+        print("\nDone! Open the result card to see your celebrity lookalikes.")
         
         return top_matches, result_path
         
@@ -280,13 +263,53 @@ def find_celebrity_lookalikes(pkl_path, imdb_images_base_path, photo_path=None,
         print(f"An error occurred: {str(e)}")
         return None, None
 
+# Procesar todas las fotos de un directorio y renderizar sus tarjetas en paralelo
+def find_celebrity_lookalikes_batch(pkl_path, imdb_images_base_path, photos_dir, output_dir, num_matches=3, gender=None, workers=None, model_name=DEFAULT_MODEL):
+    index = CelebrityIndex.from_dataframe(load_embeddings(pkl_path), model_name, pkl_path)
+    celebrity_df = index.df
+    os.makedirs(output_dir, exist_ok=True)
+    
+    photos = sorted(f for f in os.listdir(photos_dir) if f.lower().endswith(('.jpg', '.jpeg', '.png')))
+    print(f"Processing {len(photos)} photos from {photos_dir}...")
+    
+    # Los embeddings se calculan en lotes (con el backend ONNX) y el renderizado va en paralelo
+    photo_paths = [os.path.join(photos_dir, photo) for photo in photos]
+    try:
+        user_embeddings = get_face_embeddings(photo_paths, model_name)
+    except Exception as e:
+        # Si falla el lote, procesar foto a foto para saltar solo las que fallan
+        print(f"Batch embedding failed, falling back to one photo at a time: {str(e)}")
+        user_embeddings = [None] * len(photo_paths)
+    
+    jobs = []
+    for photo, photo_path, user_embedding in zip(photos, photo_paths, user_embeddings):
+        try:
+            if user_embedding is None:
+                user_embedding = get_face_embedding(photo_path, model_name)
+            top_matches = find_similar_celebrities(user_embedding, index, top_n=num_matches, gender=gender)
+        except Exception as e:
+            print(f"Skipping {photo}: {str(e)}")
+            continue
+        jobs.append({
+            "user_image": photo_path,
+            "matches": card_matches(top_matches, celebrity_df, imdb_images_base_path),
+            "output_path": os.path.join(output_dir, f"{os.path.splitext(photo)[0]}_lookalikes.jpg"),
+        })
+    
+    render_cards_batch(jobs, max_workers=workers)
+    print(f"Saved {len(jobs)} result cards to {output_dir}")
+    return [job["output_path"] for job in jobs]
+
 if __name__ == "__main__":
     # Configurar argumentos de línea de comandos
     parser = argparse.ArgumentParser(description="Find celebrity lookalikes from a photo")
     
-    parser.add_argument("--pkl_path", type=str, 
-                        default="representations.pkl",
-                        help="Path to the pickle file with celebrity embeddings")
+    parser.add_argument("--model", type=str, default=os.environ.get("CELEBRIA_MODEL", DEFAULT_MODEL),
+                        help="Embedding model: VGG-Face, Facenet, Facenet512, ArcFace... (default: CELEBRIA_MODEL or VGG-Face)")
+    
+    parser.add_argument("--pkl_path", type=str,
+                        help="Path to the pickle file with celebrity embeddings "
+                             "(default: the index of --model, representations.pkl for VGG-Face)")
     
     parser.add_argument("--imdb_path", type=str, 
                         default="imdb_data_set",
@@ -301,9 +324,32 @@ if __name__ == "__main__":
     parser.add_argument("--matches", type=int, default=3,
                         help="Number of celebrity matches to show (default: 3)")
     
+    parser.add_argument("--output", type=str,
+                        default="celebrity_lookalikes_result.jpg",
+                        help="Path where the result card is saved")
+    
+    parser.add_argument("--batch", type=str,
+                        help="Directory of photos to process offline, one result card per photo")
+    
+    parser.add_argument("--output_dir", type=str,
+                        default="lookalike_cards",
+                        help="Directory where batch result cards are saved (default: lookalike_cards)")
+    
+    parser.add_argument("--workers", type=int,
+                        help="Number of threads used to render batch result cards")
+    
     parser.add_argument("--gender", type=str, choices=['0', '1', 'm', 'f', 'male', 'female'],
                         help="Filter celebrities by gender (0/m/male or 1/f/female)")
     
+    parser.add_argument("--backend", type=str, choices=['deepface', 'onnx'],
+                        help="Embedding backend (default: CELEBRIA_EMBEDDING_BACKEND or deepface)")
+    
+    parser.add_argument("--onnx_model", type=str,
+                        help="Path to the ONNX model exported with embedding_backends.py export")
+    
+    parser.add_argument("--threads", type=int,
+                        help="ONNX Runtime intra-op threads (default: one per physical core)")
+    
     # Analizar argumentos
     args = parser.parse_args()
     
@@ -322,12 +368,39 @@ if __name__ == "__main__":
         # Añadir información de depuración
         print(f"Gender filter set to: {gender} ({args.gender})")
     
-    # Ejecutar la función principal
-    find_celebrity_lookalikes(
-        pkl_path=args.pkl_path,
-        imdb_images_base_path=args.imdb_path,
-        photo_path=args.photo,
-        use_webcam=use_webcam,
-        num_matches=args.matches,
-        gender=gender
-    )
\ No newline at end of file
+    # Elegir el backend de embeddings
+    if args.backend or args.onnx_model:
+        set_embedding_backend(create_backend(
+            args.backend or 'onnx',
+            model_name=args.model,
+            model_path=args.onnx_model or (os.environ.get("CELEBRIA_ONNX_MODEL") or "").replace("{model}", args.model),
+            threads=args.threads
+        ))
+    
+    # Cada modelo tiene su propio índice (representations_<modelo>.pkl, ver celebrity_index.py)
+    pkl_path = args.pkl_path or index_path(args.model)
+    
+    # Modo por lotes: procesar un directorio de fotos sin webcam ni ventanas
+    if args.batch:
+        find_celebrity_lookalikes_batch(
+            pkl_path=pkl_path,
+            imdb_images_base_path=args.imdb_path,
+            photos_dir=args.batch,
+            output_dir=args.output_dir,
+            num_matches=args.matches,
+            gender=gender,
+            workers=args.workers,
+            model_name=args.model
+        )
+    else:
+        # Ejecutar la función principal
+        find_celebrity_lookalikes(
+            pkl_path=pkl_path,
+            imdb_images_base_path=args.imdb_path,
+            photo_path=args.photo,
+            use_webcam=use_webcam,
+            num_matches=args.matches,
+            gender=gender,
+            result_path=args.output,
+            model_name=args.model
+        )
\ No newline at end of file
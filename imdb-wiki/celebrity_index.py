@@ -0,0 +1,632 @@
+import argparse
+import hashlib
+import mmap
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from embedding_backends import DEFAULT_MODEL, create_backend
+
+DEFAULT_INDEX = "representations.pkl"
+
+# Búsqueda en dos fases con la matriz reducida (build_reduction): candidatos que se vuelven a ordenar
+# con los embeddings completos (0 para buscar siempre con los embeddings completos)
+REDUCTION_CANDIDATES = int(os.environ.get("CELEBRIA_REDUCTION_CANDIDATES", "256"))
+# Búsqueda por prototipos (build_prototypes): famosos cuyas fotos se vuelven a puntuar una a una
+# (0 para responder directamente con los prototipos)
+PROTOTYPE_REFINE = int(os.environ.get("CELEBRIA_PROTOTYPE_REFINE", "8"))
+# Búsqueda en índices en disco: MB de la matriz por bloque e hilos que recorren los bloques
+SEARCH_CHUNK_MB = float(os.environ.get("CELEBRIA_SEARCH_CHUNK_MB", "64"))
+SEARCH_THREADS = int(os.environ.get("CELEBRIA_SEARCH_THREADS", str(os.cpu_count() or 1)))
+
+# Extraer el vector del objeto de representación de DeepFace
+def extract_vector(representation):
+    if isinstance(representation, list) and len(representation) > 0:
+        return representation[0]['embedding']
+    else:
+        return representation['embedding']
+
+# Nombre del índice de cada modelo, con la misma convención que DeepFace: representations_vgg_face.pkl,
+# representations_facenet.pkl... El índice original (representations.pkl) es el de VGG-Face.
+# Si existe su versión dividida en fragmentos (representations_<modelo>_sharded.pkl, ver sharded_index.py)
+# o en disco (representations_<modelo>_mmap.pkl, ver build_mmap_index) se usa esa.
+def index_path(model_name=DEFAULT_MODEL, directory=".", on_disk=True):
+    path = os.path.join(directory, f"representations_{model_name.lower().replace('-', '_')}.pkl")
+    if model_name == DEFAULT_MODEL and not any(os.path.exists(p) for p in [path] + _variant_paths(path)):
+        path = os.path.join(directory, DEFAULT_INDEX)
+    if on_disk:
+        return next((p for p in _variant_paths(path) if os.path.exists(p)), path)
+    return path
+
+# Nombre de la matriz reducida de un índice (build_reduction)
+def reduction_path(pkl_path):
+    return os.path.splitext(pkl_path)[0] + "_reduced.npz"
+
+# Nombre de los prototipos de cada famoso de un índice (build_prototypes)
+def prototypes_path(pkl_path):
+    return os.path.splitext(pkl_path)[0] + "_prototypes.npz"
+
+# Nombre de la versión en disco de un índice
+def mmap_index_path(pkl_path):
+    return os.path.splitext(pkl_path)[0] + "_mmap.pkl"
+
+def _variant_paths(pkl_path):
+    return [os.path.splitext(pkl_path)[0] + "_sharded.pkl", mmap_index_path(pkl_path)]
+
+# Normalizar cada fila a norma 1 (las filas a cero se quedan a cero)
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+# Índice de famosos de un modelo: los embeddings normalizados en una matriz float32 para buscar
+# con un producto de matrices en lugar de comparar fila a fila
+class CelebrityIndex:
+
+    # Proyección y matriz reducida para la búsqueda en dos fases (attach_reduction)
+    reduction = None
+    # Prototipos de cada famoso para buscar primero entre famosos y no entre fotos (attach_prototypes)
+    prototypes = None
+
+    def __init__(self, df, model_name=None):
+        df = df.dropna(subset=['face_vector_raw'])
+        self.df = df
+        self.model_name = model_name or df.attrs.get('model_name', DEFAULT_MODEL)
+
+        matrix = np.asarray([extract_vector(raw) for raw in df['face_vector_raw']], dtype=np.float32)
+        if len(df) == 0:
+            matrix = np.zeros((0, df.attrs.get('dimension', 0)), dtype=np.float32)
+        self.matrix = normalize_rows(matrix)
+        self._set_metadata(df)
+
+    # Etiquetas, géneros e identidades de cada fila, que se quedan en memoria aunque la matriz no
+    def _set_metadata(self, df):
+        self.labels = df.index.to_numpy()
+        genders = df['gender']
+        # El género puede estar guardado como número o como array de un elemento
+        if len(genders) and isinstance(genders.iloc[0], (list, np.ndarray)):
+            genders = genders.apply(lambda x: x[0])
+        self.genders = np.asarray(genders, dtype=np.float32)
+        self.identities, self.names = df['celebrity_name'].factorize()
+
+    def __len__(self):
+        return len(self.labels)
+
+    @property
+    def dimension(self):
+        return self.matrix.shape[1]
+
+    # Cargar un índice guardado con pandas, comprobando que es del modelo esperado
+    @classmethod
+    def load(cls, pkl_path, model_name=None):
+        import pandas as pd
+        index = cls.from_dataframe(pd.read_pickle(pkl_path), model_name, pkl_path)
+        if type(index) is CelebrityIndex and REDUCTION_CANDIDATES > 0 and os.path.exists(reduction_path(pkl_path)):
+            index.attach_reduction(reduction_path(pkl_path))
+        if type(index) is CelebrityIndex and os.path.exists(prototypes_path(pkl_path)):
+            index.attach_prototypes(prototypes_path(pkl_path))
+        return index
+
+    # Usar la matriz reducida de build_reduction para buscar en dos fases: las filas más parecidas en
+    # la matriz reducida y, entre ellas, los mejores famosos con los embeddings completos.
+    # Si la matriz reducida no es de este índice se avisa y se sigue buscando sin ella.
+    def attach_reduction(self, npz_path, candidates=REDUCTION_CANDIDATES):
+        with np.load(npz_path) as data:
+            reduction = {key: data[key] for key in data.files}
+        if str(reduction['fingerprint']) != matrix_fingerprint(self.matrix):
+            print(f"Warning: {npz_path} was built for another index, searching with full embeddings")
+            return
+        reduction['candidates'] = candidates
+        self.reduction = reduction
+        print(f"Using {reduction['method']} reduction to {reduction['reduced'].shape[1]} dimensions "
+              f"for the first search stage ({candidates} candidates)")
+
+    # Usar los prototipos de build_prototypes: la consulta se compara con los prototipos, se eligen los
+    # `refine` famosos más parecidos y se puntúan sus fotos (sin las descartadas al construirlos).
+    # Con refine=0 el resultado sale de los prototipos, con la foto más cercana a cada uno.
+    def attach_prototypes(self, npz_path, refine=PROTOTYPE_REFINE):
+        with np.load(npz_path) as data:
+            prototypes = {key: data[key] for key in data.files}
+        if str(prototypes['fingerprint']) != matrix_fingerprint(self.matrix):
+            print(f"Warning: {npz_path} was built for another index, searching all photos")
+            return
+        # Fotos conservadas de cada famoso, agrupadas: las de la identidad i son order[starts[i]:starts[i + 1]]
+        kept = np.flatnonzero(prototypes['kept'])
+        prototypes['order'] = kept[np.argsort(self.identities[kept], kind='stable')]
+        prototypes['starts'] = np.searchsorted(self.identities[prototypes['order']], np.arange(len(self.names) + 1))
+        prototypes['refine'] = refine
+        self.prototypes = prototypes
+        print(f"Using {len(prototypes['rows'])} {prototypes['method']} prototypes of {len(self.names)} celebrities "
+              f"({len(self) - len(kept)} outlier photos pruned, refining the best {refine})")
+
+    # Crear el índice de un DataFrame ya cargado. Si es el de un índice en disco (build_mmap_index)
+    # se devuelve un MmapCelebrityIndex que lee la matriz de su archivo, y si es el de un índice
+    # dividido (sharded_index.py) un ShardedCelebrityIndex que busca en sus fragmentos.
+    @classmethod
+    def from_dataframe(cls, df, model_name=None, pkl_path=None):
+        stored_model = df.attrs.get('model_name')
+        if model_name and stored_model and stored_model != model_name:
+            raise ValueError(f"{pkl_path} was built with {stored_model}, not {model_name}")
+        if df.attrs.get('shard_files'):
+            from sharded_index import ShardedCelebrityIndex
+            directory = os.path.dirname(pkl_path or ".")
+            return ShardedCelebrityIndex(df, [os.path.join(directory, name) for name in df.attrs['shard_files']],
+                                         model_name or stored_model)
+        if df.attrs.get('matrix_file'):
+            matrix_path = os.path.join(os.path.dirname(pkl_path or "."), df.attrs['matrix_file'])
+            return MmapCelebrityIndex(df, matrix_path, model_name or stored_model)
+        return cls(df, model_name or stored_model)
+
+    # Buscar los top_n famosos más parecidos: mismo resultado que find_similar_celebrities,
+    # la mejor foto de cada famoso ordenada por similitud coseno
+    def search(self, user_vector, top_n=3, gender=None, effort=1.0):
+        return self.search_batch([user_vector], top_n, [gender], effort)[0]
+
+    # Buscar varias consultas a la vez: un producto de matrices por cada filtro de género distinto
+    # en lugar de uno por consulta. Devuelve una lista de resultados como los de search.
+    # `effort` (0 a 1) recorta las fases aproximadas: los candidatos de la matriz reducida y los
+    # famosos que se vuelven a puntuar con los prototipos. Sin ellas la búsqueda es exacta y no cambia.
+    def search_batch(self, user_vectors, top_n=3, genders=None, effort=1.0):
+        queries = self._queries(user_vectors)
+        genders = genders if genders is not None else [None] * len(queries)
+
+        results = [None] * len(queries)
+        for gender in dict.fromkeys(genders):
+            positions = [i for i, g in enumerate(genders) if g == gender]
+            rows = self._rows_for_gender(gender)
+            if self.prototypes is not None:
+                refine = int(round(self.prototypes['refine'] * effort))
+                for i, result in zip(positions, self._search_prototypes(queries[positions], gender, rows, top_n, refine)):
+                    results[i] = result
+                continue
+            candidates = max(top_n, int(self.reduction['candidates'] * effort)) if self.reduction is not None else 0
+            if self.reduction is not None and (len(self) if rows is None else len(rows)) > candidates:
+                for i, result in zip(positions, self._search_reduced(queries[positions], rows, top_n, candidates)):
+                    results[i] = result
+                continue
+            matrix = self.matrix if rows is None else self.matrix[rows]
+            similarities = queries[positions] @ matrix.T
+            for row, i in enumerate(positions):
+                results[i] = self._best_per_identity(similarities[row], rows, top_n)
+        return results
+
+    # Primera fase en la matriz reducida y segunda con los embeddings completos de los candidatos.
+    # Si entre los candidatos hay menos de top_n famosos distintos se repite con más.
+    def _search_reduced(self, queries, rows, top_n, candidates):
+        reduced = self.reduction['reduced'] if rows is None else self.reduction['reduced'][rows]
+        # q·x = q·media + q·(x - media): para ordenar las filas basta con la parte centrada, proyectada
+        coarse = (queries @ self.reduction['components'].T) @ reduced.T
+        results = []
+        for query, scores in zip(queries, coarse):
+            first_stage = candidates
+            while True:
+                chosen = np.argpartition(-scores, first_stage - 1)[:first_stage] if first_stage < len(scores) \
+                    else np.arange(len(scores))
+                # En orden de fila, para desempatar igual que la búsqueda completa
+                chosen = np.sort(chosen if rows is None else rows[chosen])
+                best, similarities = self._best_positions(self.matrix[chosen] @ query, chosen, top_n)
+                if len(best) >= top_n or first_stage >= len(scores):
+                    break
+                first_stage *= 4
+            results.append([(self.labels[position], float(score)) for position, score in zip(best, similarities)])
+        return results
+
+    # Comparar con los prototipos y, si refine > 0, puntuar las fotos de los mejores famosos.
+    # Si con los prototipos no salen top_n famosos se buscan en todas las fotos.
+    def _search_prototypes(self, queries, gender, rows, top_n, refine):
+        prototype_rows = self.prototypes['rows']
+        matrix = self.prototypes['prototypes']
+        if rows is not None:
+            selected = self.genders[prototype_rows] == gender
+            prototype_rows, matrix = prototype_rows[selected], matrix[selected]
+        order, starts = self.prototypes['order'], self.prototypes['starts']
+        results = []
+        for query, scores in zip(queries, queries @ matrix.T):
+            best, similarities = self._best_positions(scores, prototype_rows, max(top_n, refine))
+            if refine > 0 and len(best) >= top_n:
+                identities = self.identities[best]
+                chosen = np.sort(np.concatenate([order[starts[i]:starts[i + 1]] for i in identities]))
+                if rows is not None:
+                    chosen = chosen[self.genders[chosen] == gender]
+                best, similarities = self._best_positions(self.matrix[chosen] @ query, chosen, top_n)
+            if len(best) < top_n:
+                matrix_rows = self.matrix if rows is None else self.matrix[rows]
+                best, similarities = self._best_positions(matrix_rows @ query, rows, top_n)
+            results.append([(self.labels[position], float(score)) for position, score in zip(best[:top_n], similarities[:top_n])])
+        return results
+
+    # Consultas como matriz float32 normalizada, comprobando que son del modelo del índice
+    def _queries(self, user_vectors):
+        queries = np.asarray(user_vectors, dtype=np.float32).reshape(len(user_vectors), -1)
+        if queries.shape[1] != self.dimension:
+            raise ValueError(f"Query has {queries.shape[1]} dimensions but the {self.model_name} index has "
+                             f"{self.dimension}. Use the index built with the same model.")
+        return normalize_rows(queries)
+
+    # Filas de un género, o None para buscar en todas
+    def _rows_for_gender(self, gender):
+        if gender is None:
+            return None
+        rows = np.flatnonzero(self.genders == gender)
+        if len(rows) == 0:
+            print(f"No celebrities found with gender '{gender}'. Using all celebrities.")
+            return None
+        return rows
+
+    # Quedarse con la mejor fila de cada famoso. Basta con ordenar los mejores candidatos;
+    # solo si entre ellos hay menos de top_n famosos distintos se ordena todo.
+    def _best_per_identity(self, similarities, rows, top_n):
+        positions, scores = self._best_positions(similarities, rows, top_n)
+        return [(self.labels[position], float(score)) for position, score in zip(positions, scores)]
+
+    # Filas (posiciones en la matriz completa) y similitudes de la mejor foto de cada uno de los top_n famosos
+    def _best_positions(self, similarities, rows, top_n):
+        n = len(similarities)
+        candidates = min(n, max(top_n * 32, 256))
+        while True:
+            if candidates < n:
+                order = np.argpartition(-similarities, candidates - 1)[:candidates]
+                order = order[np.argsort(-similarities[order], kind='stable')]
+            else:
+                order = np.argsort(-similarities, kind='stable')
+            positions = order if rows is None else rows[order]
+            identities = self.identities[positions]
+            _, first = np.unique(identities, return_index=True)
+            if len(first) >= top_n or candidates >= n:
+                break
+            candidates = n
+        first.sort()
+        best = first[:top_n]
+        return positions[best], similarities[order[best]]
+
+# Huella de una matriz de embeddings, para comprobar que una matriz reducida es de ese índice
+def matrix_fingerprint(matrix):
+    step = max(1, len(matrix) // 1024)
+    return f"{matrix.shape[0]}x{matrix.shape[1]}:" + hashlib.sha1(np.ascontiguousarray(matrix[::step]).tobytes()).hexdigest()
+
+# Proyección de los embeddings normalizados a `dimensions` dimensiones: PCA (las direcciones de más
+# varianza, calculadas con una muestra de filas) o una proyección aleatoria ortonormal
+def fit_reduction(matrix, dimensions, method="pca", sample=20000, seed=0):
+    rng = np.random.default_rng(seed)
+    dimensions = min(dimensions, matrix.shape[1])
+    if method == "random":
+        components, _ = np.linalg.qr(rng.standard_normal((matrix.shape[1], dimensions)))
+        return np.zeros(matrix.shape[1], dtype=np.float32), components.T.astype(np.float32)
+    rows = matrix if len(matrix) <= sample else matrix[np.sort(rng.choice(len(matrix), sample, replace=False))]
+    mean = rows.mean(axis=0, dtype=np.float64).astype(np.float32)
+    centered = rows - mean
+    # Autovectores de la covarianza (d x d), más barato que la SVD de la muestra cuando hay más filas que dimensiones
+    _, vectors = np.linalg.eigh(centered.T @ centered)
+    return mean, np.ascontiguousarray(vectors[:, ::-1][:, :dimensions].T, dtype=np.float32)
+
+# Guardar junto al índice (<índice>_reduced.npz) la matriz reducida para la búsqueda en dos fases.
+# Las filas se proyectan centradas, (x - media) · componentes.
+def build_reduction(pkl_path, dimensions, method="pca", output_path=None, model_name=None):
+    import pandas as pd
+    output_path = output_path or reduction_path(pkl_path)
+    index = CelebrityIndex.from_dataframe(pd.read_pickle(pkl_path), model_name, pkl_path)
+    if type(index) is not CelebrityIndex:
+        raise ValueError(f"{pkl_path} is not an in-memory index")
+    start = time.perf_counter()
+    mean, components = fit_reduction(index.matrix, dimensions, method)
+    reduced = np.empty((len(index), components.shape[0]), dtype=np.float32)
+    for first in range(0, len(index), 65536):
+        reduced[first:first + 65536] = (index.matrix[first:first + 65536] - mean) @ components.T
+    # np.savez añade .npz si el nombre no termina así
+    with open(output_path + ".tmp", "wb") as f:
+        np.savez(f, mean=mean, components=components, reduced=reduced, method=method,
+                 fingerprint=matrix_fingerprint(index.matrix))
+    os.replace(output_path + ".tmp", output_path)
+    print(f"Saved {method} reduction from {index.dimension} to {components.shape[0]} dimensions "
+          f"in {time.perf_counter() - start:.1f} s to {output_path}")
+    return output_path
+
+# Comparar la búsqueda aproximada (matriz reducida o prototipos) con la exacta: recall@top_n (famosos
+# del top_n exacto que también encuentra la aproximada) y milisegundos por consulta de cada una
+def evaluate_approximate(index, queries, top_n=3):
+    reduction, prototypes = index.reduction, index.prototypes
+    index.reduction = index.prototypes = None
+    start = time.perf_counter()
+    exact = [index.search(query, top_n) for query in queries]
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+    index.reduction, index.prototypes = reduction, prototypes
+    start = time.perf_counter()
+    approximate = [index.search(query, top_n) for query in queries]
+    approximate_ms = (time.perf_counter() - start) * 1000 / len(queries)
+    names = index.df['celebrity_name']
+    found = sum(len({names.loc[label] for label, _ in a} & {names.loc[label] for label, _ in e}) for a, e in zip(approximate, exact))
+    return {"recall": found / max(1, sum(len(e) for e in exact)), "exact_ms": exact_ms, "approximate_ms": approximate_ms}
+
+# Consultas de prueba a partir de las filas del índice: la mezcla de dos fotos al azar, que no está en el índice
+def sample_queries(index, count=200, seed=0):
+    rng = np.random.default_rng(seed)
+    return normalize_rows(index.matrix[rng.integers(0, len(index), count)] + index.matrix[rng.integers(0, len(index), count)])
+
+# Fotos de un famoso que se conservan: si tiene al menos 3, se descartan las que se parecen a su
+# media bastante menos que el resto (más de `prune` desviaciones típicas por debajo), que suelen ser
+# caras mal detectadas, de otra persona o de muy mala calidad
+def prune_outliers(vectors, prune=2.0):
+    if prune <= 0 or len(vectors) < 3:
+        return np.ones(len(vectors), dtype=bool)
+    similarities = vectors @ normalize_rows(vectors.mean(axis=0, keepdims=True))[0]
+    kept = similarities >= similarities.mean() - prune * similarities.std()
+    return kept if kept.any() else np.ones(len(vectors), dtype=bool)
+
+# k-medoides de las fotos de un famoso con similitud coseno: el más central, después el más alejado de
+# los ya elegidos, y se alterna asignar cada foto a su medoide y elegir el más central de cada grupo
+def k_medoids(vectors, k, iterations=10):
+    similarities = vectors @ vectors.T
+    if len(vectors) <= k:
+        return np.arange(len(vectors))
+    medoids = [int(np.argmax(similarities.sum(axis=1)))]
+    while len(medoids) < k:
+        medoids.append(int(np.argmin(similarities[:, medoids].max(axis=1))))
+    medoids = np.array(medoids)
+    for _ in range(iterations):
+        assignment = np.argmax(similarities[:, medoids], axis=1)
+        updated = medoids.copy()
+        for cluster in range(k):
+            members = np.flatnonzero(assignment == cluster)
+            if len(members):
+                updated[cluster] = members[np.argmax(similarities[np.ix_(members, members)].sum(axis=1))]
+        if np.array_equal(updated, medoids):
+            break
+        medoids = updated
+    return medoids
+
+# Guardar junto al índice (<índice>_prototypes.npz) uno o pocos prototipos por famoso, calculados con sus
+# fotos conservadas: la media normalizada ("mean") o `per_identity` k-medoides ("medoids"). Cada
+# prototipo se representa en los resultados con una foto real: la más cercana a la media, o el medoide.
+def build_prototypes(pkl_path, method="mean", per_identity=3, prune=2.0, output_path=None, model_name=None):
+    import pandas as pd
+    output_path = output_path or prototypes_path(pkl_path)
+    index = CelebrityIndex.from_dataframe(pd.read_pickle(pkl_path), model_name, pkl_path)
+    if type(index) is not CelebrityIndex:
+        raise ValueError(f"{pkl_path} is not an in-memory index")
+    start = time.perf_counter()
+    order = np.argsort(index.identities, kind='stable')
+    starts = np.searchsorted(index.identities[order], np.arange(len(index.names) + 1))
+    kept = np.zeros(len(index), dtype=bool)
+    prototypes, rows = [], []
+    for identity in range(len(index.names)):
+        photos = order[starts[identity]:starts[identity + 1]]
+        photos = photos[prune_outliers(index.matrix[photos], prune)]
+        kept[photos] = True
+        vectors = index.matrix[photos]
+        if method == "medoids":
+            chosen = photos[k_medoids(vectors, per_identity)]
+            prototypes.append(index.matrix[chosen])
+            rows.extend(chosen)
+        else:
+            mean = normalize_rows(vectors.mean(axis=0, keepdims=True))
+            prototypes.append(mean)
+            rows.append(photos[np.argmax(vectors @ mean[0])])
+    prototypes = np.concatenate(prototypes) if prototypes else np.zeros((0, index.dimension), dtype=np.float32)
+    with open(output_path + ".tmp", "wb") as f:
+        np.savez(f, prototypes=prototypes.astype(np.float32), rows=np.array(rows, dtype=np.int64), kept=kept,
+                 method=method, fingerprint=matrix_fingerprint(index.matrix))
+    os.replace(output_path + ".tmp", output_path)
+    print(f"Saved {len(rows)} {method} prototypes of {len(index.names)} celebrities ({len(index)} photos, "
+          f"{len(index) - kept.sum()} outliers pruned) in {time.perf_counter() - start:.1f} s to {output_path}")
+    return output_path
+
+# Índice cuya matriz se queda en disco (build_mmap_index) y se recorre por bloques de filas en varios hilos.
+# Cada bloque se busca por separado y se queda con la mejor foto de sus top_n famosos; la mejor foto de
+# cada uno de los top_n globales está siempre entre las de su bloque, así que unir los bloques da el
+# mismo resultado que la búsqueda exacta en memoria. NumPy suelta el GIL en el producto de matrices
+# y las páginas de cada bloque se liberan al terminarlo: la memoria depende del tamaño de bloque y del
+# número de hilos, no del número de famosos.
+class MmapCelebrityIndex(CelebrityIndex):
+
+    def __init__(self, df, matrix_path, model_name=None, chunk_mb=SEARCH_CHUNK_MB, threads=SEARCH_THREADS):
+        self.df = df
+        self.model_name = model_name or df.attrs.get('model_name', DEFAULT_MODEL)
+        dimension = df.attrs['dimension']
+        with open(matrix_path, 'rb') as f:
+            # El mapa sigue abierto después de cerrar el archivo
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else None
+        if self._mmap is None:
+            self.matrix = np.zeros((0, dimension), dtype=np.float32)
+        else:
+            self.matrix = np.frombuffer(self._mmap, dtype=np.float32).reshape(-1, dimension)
+        if len(self.matrix) != len(df):
+            raise ValueError(f"{matrix_path} has {len(self.matrix)} rows but its index has {len(df)}")
+        self._set_metadata(df)
+        self.chunk_rows = max(1, int(chunk_mb * 2**20) // (4 * max(1, dimension)))
+        self.threads = max(1, threads)
+        self._executor = None
+        self._executor_pid = None
+
+    # Recorre siempre toda la matriz: no hay fase aproximada que recortar con `effort`
+    def search_batch(self, user_vectors, top_n=3, genders=None, effort=1.0):
+        queries = self._queries(user_vectors)
+        genders = genders if genders is not None else [None] * len(queries)
+        groups = {gender: ([i for i, g in enumerate(genders) if g == gender], self._rows_for_gender(gender))
+                  for gender in dict.fromkeys(genders)}
+
+        starts = range(0, len(self), self.chunk_rows)
+        if len(starts) > 1 and self.threads > 1:
+            partials = list(self._pool().map(lambda start: self._search_chunk(queries, groups, start, top_n), starts))
+        else:
+            partials = [self._search_chunk(queries, groups, start, top_n) for start in starts]
+
+        results = []
+        for i in range(len(queries)):
+            candidates = [candidate for partial in partials for candidate in partial[i]]
+            # Misma regla que _best_positions: la similitud mayor y, si empatan, la primera fila
+            candidates.sort(key=lambda candidate: (-candidate[1], candidate[0]))
+            best, seen = [], set()
+            for position, score in candidates:
+                if self.identities[position] not in seen:
+                    seen.add(self.identities[position])
+                    best.append((self.labels[position], float(score)))
+                    if len(best) == top_n:
+                        break
+            results.append(best)
+        return results
+
+    # Mejores filas de un bloque para cada consulta: lista de (posición, similitud) por consulta
+    def _search_chunk(self, queries, groups, start, top_n):
+        end = min(start + self.chunk_rows, len(self))
+        chunk = self.matrix[start:end]
+        found = [[] for _ in range(len(queries))]
+        try:
+            for positions, rows in groups.values():
+                if rows is None:
+                    block, block_rows = chunk, np.arange(start, end)
+                else:
+                    first, last = np.searchsorted(rows, [start, end])
+                    block_rows = rows[first:last]
+                    if len(block_rows) == 0:
+                        continue
+                    block = chunk[block_rows - start]
+                similarities = queries[positions] @ block.T
+                for row, i in enumerate(positions):
+                    best, scores = self._best_positions(similarities[row], block_rows, top_n)
+                    found[i] = list(zip(best.tolist(), scores.tolist()))
+        finally:
+            self._release(start, end)
+        return found
+
+    # Devolver al sistema las páginas ya leídas del bloque (siguen en la caché de disco)
+    def _release(self, start, end):
+        if self._mmap is None or not hasattr(mmap, 'MADV_DONTNEED'):
+            return
+        row_bytes = self.matrix.shape[1] * 4
+        offset = start * row_bytes // mmap.PAGESIZE * mmap.PAGESIZE
+        self._mmap.madvise(mmap.MADV_DONTNEED, offset, end * row_bytes - offset)
+
+    # Los hilos no sobreviven al fork de gunicorn: cada worker crea los suyos
+    def _pool(self):
+        if self._executor_pid != os.getpid():
+            self._executor_pid = os.getpid()
+            self._executor = ThreadPoolExecutor(self.threads, thread_name_prefix="search")
+        return self._executor
+
+# Convertir uno o varios índices (.pkl) en un índice en disco: la matriz normalizada en un archivo
+# float32 (<output>.f32) y los nombres, géneros y rutas en <output>, que es el .pkl que se carga.
+# Los índices de entrada se procesan de uno en uno, así que la base completa nunca está en memoria.
+def build_mmap_index(source_pkls, output_path, model_name=None):
+    import pandas as pd
+    matrix_path = os.path.splitext(output_path)[0] + ".f32"
+    metadata, dimension = [], None
+    with open(matrix_path + ".tmp", "wb") as f:
+        for source_pkl in source_pkls:
+            index = CelebrityIndex.load(source_pkl, model_name)
+            if isinstance(index, MmapCelebrityIndex):
+                raise ValueError(f"{source_pkl} is already an on-disk index")
+            model_name = index.model_name
+            if dimension is not None and len(index) and index.dimension != dimension:
+                raise ValueError(f"{source_pkl} has {index.dimension} dimensions, not {dimension}")
+            dimension = index.dimension if len(index) else dimension
+            f.write(np.ascontiguousarray(index.matrix, dtype=np.float32).tobytes())
+            metadata.append(index.df.drop(columns=['face_vector_raw']))
+            print(f"  {source_pkl}: {len(index)} embeddings")
+            del index
+
+    df = pd.concat(metadata, ignore_index=True)
+    df.attrs['model_name'] = model_name
+    df.attrs['dimension'] = dimension or 0
+    df.attrs['matrix_file'] = os.path.basename(matrix_path)
+    # La matriz primero y el .pkl al final: quien vigila el .pkl nunca lo ve antes que su matriz
+    os.replace(matrix_path + ".tmp", matrix_path)
+    df.to_pickle(output_path + ".tmp", compression=None)
+    os.replace(output_path + ".tmp", output_path)
+    print(f"Saved on-disk {model_name} index with {len(df)} embeddings to {output_path} and {matrix_path}")
+    return output_path
+
+# Construir el índice de otro modelo a partir de un índice existente: mismas fotos, nombres y géneros,
+# con los embeddings recalculados en lotes. Las fotos que no se encuentran se descartan.
+def build_model_index(source_pkl, imdb_path, model_name, output_path=None, backend=None, batch_size=64):
+    import pandas as pd
+    backend = backend or create_backend("deepface", model_name)
+    output_path = output_path or index_path(model_name, os.path.dirname(source_pkl) or ".", on_disk=False)
+    df = pd.read_pickle(source_pkl)
+
+    paths = [os.path.join(imdb_path, full_path[0]) for full_path in df['full_path']]
+    keep = [os.path.exists(path) for path in paths]
+    df = df[keep].copy()
+    paths = [path for path, found in zip(paths, keep) if found]
+    print(f"Embedding {len(paths)} images with {model_name} ({len(keep) - len(paths)} missing images skipped)...")
+
+    start = time.perf_counter()
+    representations = []
+    for first in range(0, len(paths), batch_size):
+        representations.extend(backend.represent_batch(paths[first:first + batch_size]))
+        done = min(len(paths), first + batch_size)
+        print(f"  {done}/{len(paths)} images ({done / (time.perf_counter() - start):.1f} img/s)")
+
+    df['face_vector_raw'] = representations
+    df.attrs['model_name'] = model_name
+    df.attrs['dimension'] = len(extract_vector(representations[0])) if representations else 0
+    # Escribir en un temporal y renombrar: un servidor que vigila el índice nunca ve un archivo a medias
+    df.to_pickle(output_path + ".tmp", compression=None)
+    os.replace(output_path + ".tmp", output_path)
+    print(f"Saved {model_name} index with {len(df)} embeddings to {output_path}")
+    return output_path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the celebrity index for another embedding model, "
+                                                 "or an on-disk index searched in chunks (--mmap)")
+    parser.add_argument("--model", type=str,
+                        help="DeepFace model to build the index with (e.g. Facenet, Facenet512, ArcFace)")
+    parser.add_argument("--source", type=str, nargs="+", default=[DEFAULT_INDEX],
+                        help="Existing index whose photos, names and genders are reused (default: representations.pkl). "
+                             "With --mmap, one or more indices to merge")
+    parser.add_argument("--reduce", type=int,
+                        help="Store the index projected to this many dimensions (<source>_reduced.npz) for a "
+                             "two-stage search, and report its recall@3 against the exact search")
+    parser.add_argument("--method", type=str, choices=["pca", "random"], default="pca",
+                        help="Projection used with --reduce (default: pca)")
+    parser.add_argument("--prototypes", type=str, choices=["mean", "medoids"],
+                        help="Store per-celebrity prototypes (<source>_prototypes.npz) searched before the "
+                             "photos, and report their recall@3 against the exact search")
+    parser.add_argument("--per_identity", type=int, default=3,
+                        help="Prototypes per celebrity with --prototypes medoids (default: 3)")
+    parser.add_argument("--prune", type=float, default=2.0,
+                        help="Drop photos this many standard deviations less similar to their celebrity's mean "
+                             "than the rest, with --prototypes (0 keeps all; default: 2)")
+    parser.add_argument("--mmap", action="store_true",
+                        help="Convert --source into an on-disk index (<source>_mmap.pkl and .f32) "
+                             "that is searched without loading the embeddings into memory")
+    parser.add_argument("--imdb_path", type=str, default="imdb_data_set",
+                        help="Path to the IMDB dataset image directory")
+    parser.add_argument("--output", type=str,
+                        help="Path of the new index (default: representations_<model>.pkl next to --source, "
+                             "or <source>_mmap.pkl with --mmap)")
+    parser.add_argument("--backend", type=str, choices=["deepface", "onnx"], default="deepface",
+                        help="Embedding backend (default: deepface)")
+    parser.add_argument("--onnx_model", type=str,
+                        help="Path to the ONNX export of --model (with --backend onnx)")
+    parser.add_argument("--batch_size", type=int, default=64,
+                        help="Images embedded per batch (default: 64)")
+    args = parser.parse_args()
+
+    if args.reduce:
+        build_reduction(args.source[0], args.reduce, args.method, args.output, args.model)
+        index = CelebrityIndex.load(args.source[0], args.model)
+        index.prototypes = None
+        if index.reduction is not None:
+            evaluation = evaluate_approximate(index, sample_queries(index))
+            print(f"recall@3 {evaluation['recall']:.3f}: {evaluation['approximate_ms']:.2f} ms per query "
+                  f"({evaluation['exact_ms']:.2f} ms with full embeddings)")
+    elif args.prototypes:
+        build_prototypes(args.source[0], args.prototypes, args.per_identity, args.prune, args.output, args.model)
+        index = CelebrityIndex.load(args.source[0], args.model)
+        index.reduction = None
+        if index.prototypes is not None:
+            evaluation = evaluate_approximate(index, sample_queries(index))
+            print(f"recall@3 {evaluation['recall']:.3f}: {evaluation['approximate_ms']:.2f} ms per query "
+                  f"({evaluation['exact_ms']:.2f} ms searching all photos)")
+    elif args.mmap:
+        build_mmap_index(args.source, args.output or mmap_index_path(args.source[0]), args.model)
+    else:
+        if not args.model:
+            parser.error("--model is required unless --mmap is given")
+        if len(args.source) > 1:
+            parser.error("only --mmap accepts several --source indices")
+        build_model_index(args.source[0], args.imdb_path, args.model, args.output,
+                          create_backend(args.backend, args.model, args.onnx_model, batch_size=args.batch_size),
+                          args.batch_size)
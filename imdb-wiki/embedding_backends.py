@@ -0,0 +1,378 @@
+import argparse
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+
+# Tamaño de entrada de cada modelo en DeepFace 0.0.79 (alto, ancho)
+MODEL_INPUT_SIZES = {
+    "VGG-Face": (224, 224),
+    "Facenet": (160, 160),
+    "Facenet512": (160, 160),
+    "OpenFace": (96, 96),
+    "DeepFace": (152, 152),
+    "DeepID": (47, 55),
+    "ArcFace": (112, 112),
+    "SFace": (112, 112),
+}
+
+DEFAULT_MODEL = "VGG-Face"
+DEFAULT_DETECTOR = "opencv"
+DEFAULT_BATCH_SIZE = 16
+
+# Leer una imagen que puede venir como ruta o como array BGR
+def _load_image(img):
+    if isinstance(img, np.ndarray):
+        return img
+    loaded = cv2.imread(img)
+    if loaded is None:
+        raise ValueError(f"Confirm that {img} exists")
+    return loaded
+
+# Detectar las caras como el detector "opencv" de DeepFace 0.0.79 (OpenCvWrapper.detect_face con align=True):
+# clasificador Haar con los mismos parámetros, las caras en el orden de detectMultiScale3 (extract_vector se
+# queda con la primera) y cada recorte girado para poner los ojos en horizontal.
+# Como con enforce_detection=False, si no hay ninguna cara se usa la imagen entera.
+_haar_classifiers = {}
+
+def _cascade(name):
+    if name not in _haar_classifiers:
+        _haar_classifiers[name] = cv2.CascadeClassifier(os.path.join(cv2.data.haarcascades, name))
+    return _haar_classifiers[name]
+
+def _detect_faces(img):
+    boxes, _, scores = _cascade("haarcascade_frontalface_default.xml").detectMultiScale3(
+        img, 1.1, 10, outputRejectLevels=True)
+    faces = []
+    for (x, y, w, h), confidence in zip(boxes, scores):
+        face = _align_face(img[int(y):int(y + h), int(x):int(x + w)])
+        if face.shape[0] > 0 and face.shape[1] > 0:
+            faces.append((face, {"x": int(x), "y": int(y), "w": int(w), "h": int(h)}, float(confidence)))
+    if not faces:
+        h, w = img.shape[:2]
+        faces.append((img, {"x": 0, "y": 0, "w": w, "h": h}, 0))
+    return faces
+
+# OpenCvWrapper.align_face: los dos ojos más grandes del clasificador Haar de ojos y, si los hay, el giro de
+# FaceDetector.alignment_procedure (con PIL, como DeepFace, para que la interpolación sea la misma)
+def _align_face(face):
+    eyes = _cascade("haarcascade_eye.xml").detectMultiScale(cv2.cvtColor(face, cv2.COLOR_BGR2GRAY), 1.1, 10)
+    # DeepFace ordena con esta clave (no es el área del ojo); se copia para elegir los mismos ojos
+    eyes = sorted(eyes, key=lambda v: abs((v[0] - v[2]) * (v[1] - v[3])), reverse=True)
+    if len(eyes) < 2:
+        return face
+    eye_1, eye_2 = eyes[0], eyes[1]
+    left_eye, right_eye = (eye_1, eye_2) if eye_1[0] < eye_2[0] else (eye_2, eye_1)
+    left_x, left_y = int(left_eye[0] + left_eye[2] / 2), int(left_eye[1] + left_eye[3] / 2)
+    right_x, right_y = int(right_eye[0] + right_eye[2] / 2), int(right_eye[1] + right_eye[3] / 2)
+    if left_y > right_y:
+        third, direction = (right_x, left_y), -1
+    else:
+        third, direction = (left_x, right_y), 1
+    a = np.linalg.norm(np.subtract((left_x, left_y), third))
+    b = np.linalg.norm(np.subtract((right_x, right_y), third))
+    c = np.linalg.norm(np.subtract((right_x, right_y), (left_x, left_y)))
+    if b == 0 or c == 0:
+        return face
+    angle = np.degrees(np.arccos((b * b + c * c - a * a) / (2 * b * c)))
+    if direction == -1:
+        angle = 90 - angle
+    from PIL import Image
+    return np.array(Image.fromarray(face).rotate(direction * angle))
+
+# Escalar la cara al tamaño del modelo con bandas negras, igual que functions.extract_faces de DeepFace:
+# mismo redimensionado, mismo relleno, canales BGR y píxeles en [0, 1]
+def preprocess_face(face, target_size):
+    factor = min(target_size[0] / face.shape[0], target_size[1] / face.shape[1])
+    face = cv2.resize(face, (int(face.shape[1] * factor), int(face.shape[0] * factor)))
+    diff_0 = target_size[0] - face.shape[0]
+    diff_1 = target_size[1] - face.shape[1]
+    face = np.pad(face, ((diff_0 // 2, diff_0 - diff_0 // 2), (diff_1 // 2, diff_1 - diff_1 // 2), (0, 0)),
+                  "constant")
+    if face.shape[0:2] != target_size:
+        face = cv2.resize(face, (target_size[1], target_size[0]))
+    return face.astype(np.float32) / 255.0
+
+# Embeddings con DeepFace (TensorFlow/Keras): el comportamiento original del proyecto
+class DeepFaceBackend:
+    name = "deepface"
+
+    def __init__(self, model_name=DEFAULT_MODEL, detector_backend=DEFAULT_DETECTOR):
+        self.model_name = model_name
+        self.detector_backend = detector_backend
+
+    def represent(self, img):
+        from deepface import DeepFace
+        return DeepFace.represent(img_path=img, model_name=self.model_name,
+                                  detector_backend=self.detector_backend, enforce_detection=False)
+
+    # DeepFace 0.0.79 no tiene inferencia por lotes: se detectan las caras de cada imagen como en
+    # DeepFace.represent y se pasan todas por el modelo en una sola llamada. Si esta versión de DeepFace
+    # no tiene esas funciones, una llamada a represent por imagen.
+    def represent_batch(self, imgs):
+        if len(imgs) <= 1:
+            return [self.represent(img) for img in imgs]
+        try:
+            from deepface import DeepFace
+            from deepface.commons import functions
+        except ImportError:
+            return [self.represent(img) for img in imgs]
+
+        model = DeepFace.build_model(self.model_name)
+        target_size = functions.find_target_size(model_name=self.model_name)
+        faces, owners = [], []
+        for i, img in enumerate(imgs):
+            for face, region, confidence in functions.extract_faces(
+                    img=img, target_size=target_size, detector_backend=self.detector_backend,
+                    grayscale=False, enforce_detection=False, align=True):
+                faces.append(functions.normalize_input(img=face, normalization="base"))
+                owners.append((i, region, confidence))
+        if "keras" in str(type(model)):
+            embeddings = model(np.concatenate(faces), training=False).numpy()
+        else:
+            embeddings = model.predict(np.concatenate(faces))
+
+        representations = [[] for _ in imgs]
+        for (i, region, confidence), embedding in zip(owners, embeddings):
+            representations[i].append({"embedding": embedding.tolist(), "facial_area": region,
+                                       "face_confidence": confidence})
+        return representations
+
+    def warm_up(self):
+        from deepface import DeepFace
+        DeepFace.build_model(self.model_name)
+
+# Embeddings con ONNX Runtime en CPU a partir del modelo de DeepFace exportado (ver export_onnx).
+# No importa TensorFlow, agrupa las caras en lotes y permite fijar los hilos de cada inferencia.
+class OnnxBackend:
+    name = "onnx"
+
+    def __init__(self, model_path, model_name=DEFAULT_MODEL, detector_backend=DEFAULT_DETECTOR,
+                 intra_op_threads=None, inter_op_threads=1, batch_size=DEFAULT_BATCH_SIZE):
+        import onnxruntime as ort
+
+        if detector_backend not in ("opencv", "skip"):
+            raise ValueError(f"The ONNX backend supports the 'opencv' and 'skip' detectors, not '{detector_backend}'")
+        self.model_path = model_path
+        self.model_name = model_name
+        self.detector_backend = detector_backend
+        self.batch_size = batch_size
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        # 0 deja que ONNX Runtime use un hilo por núcleo físico
+        options.intra_op_num_threads = intra_op_threads or 0
+        options.inter_op_num_threads = inter_op_threads
+        self.session = ort.InferenceSession(model_path, sess_options=options, providers=["CPUExecutionProvider"])
+
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        # El tamaño de entrada sale del propio modelo si es fijo; si no, del modelo de DeepFace
+        height, width = model_input.shape[1:3]
+        if isinstance(height, int) and isinstance(width, int):
+            self.target_size = (height, width)
+        else:
+            self.target_size = MODEL_INPUT_SIZES[model_name]
+        batch_dim = model_input.shape[0]
+        self.fixed_batch = batch_dim if isinstance(batch_dim, int) else None
+
+    # Calcular los embeddings de un array de caras ya preprocesadas (N, alto, ancho, 3)
+    def embed_faces(self, faces):
+        faces = np.asarray(faces, dtype=np.float32)
+        step = self.fixed_batch or self.batch_size
+        outputs = []
+        for start in range(0, len(faces), step):
+            chunk = faces[start:start + step]
+            outputs.append(self.session.run(None, {self.input_name: chunk})[0])
+        return np.concatenate(outputs).reshape(len(faces), -1)
+
+    def _prepare(self, img):
+        img = _load_image(img)
+        h, w = img.shape[:2]
+        if self.detector_backend == "skip":
+            faces = [(img, {"x": 0, "y": 0, "w": w, "h": h}, 0)]
+        else:
+            faces = _detect_faces(img)
+        return [(preprocess_face(face, self.target_size), area, confidence) for face, area, confidence in faces]
+
+    def represent(self, img):
+        return self.represent_batch([img])[0]
+
+    # Misma estructura que DeepFace.represent: una lista con un diccionario por cara de cada imagen
+    def represent_batch(self, imgs):
+        prepared = [self._prepare(img) for img in imgs]
+        faces = [face for image_faces in prepared for face in image_faces]
+        if not faces:
+            return []
+        embeddings = iter(self.embed_faces(np.stack([face for face, _, _ in faces])))
+        return [[{"embedding": next(embeddings).tolist(), "facial_area": area, "face_confidence": confidence}
+                 for _, area, confidence in image_faces]
+                for image_faces in prepared]
+
+    def warm_up(self):
+        self.embed_faces(np.zeros((1, *self.target_size, 3), dtype=np.float32))
+
+# Crear un backend de embeddings por nombre ("deepface" u "onnx")
+def create_backend(name="deepface", model_name=DEFAULT_MODEL, model_path=None, threads=None,
+                   detector_backend=DEFAULT_DETECTOR, batch_size=DEFAULT_BATCH_SIZE):
+    if name == "deepface":
+        return DeepFaceBackend(model_name, detector_backend)
+    if name == "onnx":
+        if not model_path:
+            raise ValueError("The ONNX backend needs the path of the exported model (--onnx_model)")
+        return OnnxBackend(model_path, model_name, detector_backend, intra_op_threads=threads,
+                           batch_size=batch_size)
+    raise ValueError(f"Unknown embedding backend '{name}'. Choose 'deepface' or 'onnx'")
+
+# Backend configurado con variables de entorno, para los servidores web:
+# CELEBRIA_EMBEDDING_BACKEND (deepface u onnx), CELEBRIA_ONNX_MODEL, CELEBRIA_ONNX_THREADS y
+# CELEBRIA_EMBEDDING_DETECTOR ("skip" evita volver a detectar en los recortes que ya son caras).
+# CELEBRIA_ONNX_MODEL puede incluir {model} para tener un archivo por modelo (models/{model}.onnx).
+def backend_from_env(model_name=DEFAULT_MODEL):
+    threads = os.environ.get("CELEBRIA_ONNX_THREADS")
+    model_path = os.environ.get("CELEBRIA_ONNX_MODEL")
+    if model_path:
+        model_path = model_path.replace("{model}", model_name)
+    return create_backend(os.environ.get("CELEBRIA_EMBEDDING_BACKEND", "deepface"), model_name,
+                          model_path, int(threads) if threads else None,
+                          os.environ.get("CELEBRIA_EMBEDDING_DETECTOR", DEFAULT_DETECTOR))
+
+# Exportar el modelo de DeepFace a ONNX con tf2onnx (solo hace falta TensorFlow en este paso)
+def export_onnx(model_name, output_path, opset=13):
+    import tensorflow as tf
+    import tf2onnx
+    from deepface import DeepFace
+
+    model = DeepFace.build_model(model_name)
+    height, width = MODEL_INPUT_SIZES[model_name]
+    # Lote de tamaño variable para poder agrupar varias caras en una inferencia
+    signature = (tf.TensorSpec((None, height, width, 3), tf.float32, name="input"),)
+    tf2onnx.convert.from_keras(model, input_signature=signature, opset=opset, output_path=output_path)
+    print(f"Exported {model_name} to {output_path}")
+    return output_path
+
+def _cosine(a, b):
+    a = np.asarray(a, dtype=np.float32)
+    b = np.asarray(b, dtype=np.float32)
+    return float(a @ b / (np.linalg.norm(a) * np.linalg.norm(b) + 1e-12))
+
+# Comprobar que el backend reproduce los embeddings del índice construido con DeepFace.
+# Se recalculan los embeddings de una muestra de famosos del índice a partir de sus fotos
+# y se comparan por similitud coseno con los guardados.
+def check_parity(backend, pkl_path, imdb_path, samples=100, tolerance=0.01, seed=0):
+    import pandas as pd
+    from celebrity2 import extract_vector
+
+    df = pd.read_pickle(pkl_path).dropna(subset=['face_vector_raw'])
+    rows = []
+    for idx, row in df.iterrows():
+        path = os.path.join(imdb_path, row['full_path'][0])
+        if os.path.exists(path):
+            rows.append((idx, path, extract_vector(row['face_vector_raw'])))
+    if not rows:
+        raise ValueError(f"None of the index images were found under {imdb_path}")
+    rng = np.random.default_rng(seed)
+    rows = [rows[i] for i in rng.permutation(len(rows))[:samples]]
+
+    start = time.perf_counter()
+    representations = backend.represent_batch([path for _, path, _ in rows])
+    elapsed = time.perf_counter() - start
+
+    similarities = []
+    failures = []
+    for (idx, path, stored), representation in zip(rows, representations):
+        similarity = _cosine(extract_vector(representation), stored)
+        similarities.append(similarity)
+        if similarity < 1 - tolerance:
+            failures.append({"index": int(idx), "path": path, "cosine": round(similarity, 5)})
+
+    return {
+        "backend": backend.name,
+        "model": backend.model_name,
+        "images": len(rows),
+        "tolerance": tolerance,
+        "min_cosine": round(min(similarities), 5),
+        "mean_cosine": round(float(np.mean(similarities)), 5),
+        "ms_per_image": round(elapsed / len(rows) * 1000, 2),
+        "failures": failures,
+        "passed": not failures,
+    }
+
+# Medir imágenes por segundo del backend ONNX con distintos hilos y tamaños de lote
+def benchmark_onnx(model_path, model_name, threads_list, batch_sizes, images=64):
+    results = []
+    for threads in threads_list:
+        backend = OnnxBackend(model_path, model_name, intra_op_threads=threads)
+        faces = np.random.default_rng(0).random((images, *backend.target_size, 3), dtype=np.float32)
+        backend.warm_up()
+        for batch_size in batch_sizes:
+            backend.batch_size = batch_size
+            start = time.perf_counter()
+            backend.embed_faces(faces)
+            elapsed = time.perf_counter() - start
+            results.append({"threads": threads, "batch_size": batch_size,
+                            "images_per_s": round(images / elapsed, 2),
+                            "ms_per_image": round(elapsed / images * 1000, 3)})
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export, check and benchmark the face embedding backends")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export = subparsers.add_parser("export", help="Export a DeepFace model to ONNX (needs tensorflow and tf2onnx)")
+    export.add_argument("--model", type=str, default=DEFAULT_MODEL,
+                        help="DeepFace model name (default: VGG-Face)")
+    export.add_argument("--output", type=str, required=True,
+                        help="Path of the .onnx file to write")
+    export.add_argument("--opset", type=int, default=13,
+                        help="ONNX opset version (default: 13)")
+
+    check = subparsers.add_parser("check", help="Check that a backend reproduces the DeepFace index embeddings")
+    check.add_argument("--backend", type=str, choices=["deepface", "onnx"], default="onnx",
+                       help="Embedding backend to check (default: onnx)")
+    check.add_argument("--onnx_model", type=str,
+                       help="Path to the exported ONNX model")
+    check.add_argument("--model", type=str, default=DEFAULT_MODEL,
+                       help="Model the index was built with (default: VGG-Face)")
+    check.add_argument("--detector", type=str, default=DEFAULT_DETECTOR,
+                       help="Face detector used when the index was built (default: opencv)")
+    check.add_argument("--pkl_path", type=str, default="representations.pkl",
+                       help="Path to the pickle file with celebrity embeddings")
+    check.add_argument("--imdb_path", type=str, default="imdb_data_set",
+                       help="Path to the IMDB dataset image directory")
+    check.add_argument("--samples", type=int, default=100,
+                       help="Number of index images to re-embed (default: 100)")
+    check.add_argument("--tolerance", type=float, default=0.01,
+                       help="Maximum allowed 1 - cosine similarity per image (default: 0.01)")
+    check.add_argument("--threads", type=int,
+                       help="ONNX Runtime intra-op threads")
+
+    bench = subparsers.add_parser("bench", help="Images per second of the ONNX backend by threads and batch size")
+    bench.add_argument("--onnx_model", type=str, required=True,
+                       help="Path to the exported ONNX model")
+    bench.add_argument("--model", type=str, default=DEFAULT_MODEL,
+                       help="DeepFace model name the ONNX file was exported from (default: VGG-Face)")
+    bench.add_argument("--threads", type=str, default="1,2,4",
+                       help="Comma separated intra-op thread counts (default: 1,2,4)")
+    bench.add_argument("--batch_sizes", type=str, default="1,8,32",
+                       help="Comma separated batch sizes (default: 1,8,32)")
+    bench.add_argument("--images", type=int, default=64,
+                       help="Number of faces embedded per measurement (default: 64)")
+
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_onnx(args.model, args.output, args.opset)
+    elif args.command == "check":
+        backend = create_backend(args.backend, args.model, args.onnx_model, args.threads, args.detector)
+        report = check_parity(backend, args.pkl_path, args.imdb_path, args.samples, args.tolerance)
+        print(json.dumps(report, indent=2))
+        raise SystemExit(0 if report["passed"] else 1)
+    elif args.command == "bench":
+        print(json.dumps(benchmark_onnx(args.onnx_model, args.model,
+                                        [int(t) for t in args.threads.split(',')],
+                                        [int(b) for b in args.batch_sizes.split(',')],
+                                        args.images), indent=2))
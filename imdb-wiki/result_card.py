@@ -0,0 +1,130 @@
+import os
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import cv2
+import numpy as np
+
+# Dimensiones de la tarjeta de resultados (en píxeles)
+CARD_MIN_WIDTH = 1200
+USER_SIDE = 400
+CELEBRITY_SIDE = 300
+MARGIN = 40
+TITLE_HEIGHT = 90
+CAPTION_HEIGHT = 80
+
+BACKGROUND_COLOR = (255, 255, 255)
+TEXT_COLOR = (30, 30, 30)
+PLACEHOLDER_COLOR = (200, 200, 200)
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+
+# Número máximo de miniaturas de famosos que se mantienen en memoria
+THUMBNAIL_CACHE_SIZE = 512
+
+# Ajustar una imagen a un cuadrado de lado fijo, centrada y con bandas si hace falta
+def _fit_square(img, side):
+    h, w = img.shape[:2]
+    scale = side / max(h, w)
+    new_w, new_h = max(1, int(w * scale)), max(1, int(h * scale))
+    resized = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_AREA)
+
+    square = np.full((side, side, 3), BACKGROUND_COLOR, dtype=np.uint8)
+    y = (side - new_h) // 2
+    x = (side - new_w) // 2
+    square[y:y + new_h, x:x + new_w] = resized
+    return square
+
+# Crear un recuadro gris con un texto para imágenes que no se pueden leer
+def _placeholder(side, text="Image not found"):
+    square = np.full((side, side, 3), PLACEHOLDER_COLOR, dtype=np.uint8)
+    _put_centered(square, text, side // 2, side // 2, 0.7, 2)
+    return square
+
+# Escribir un texto centrado horizontalmente en (cx, y)
+def _put_centered(canvas, text, cx, y, scale, thickness):
+    # Las fuentes Hershey de OpenCV solo admiten ASCII: quitar tildes y diacríticos
+    text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode("ascii")
+    text_size = cv2.getTextSize(text, FONT, scale, thickness)[0]
+    x = max(0, cx - text_size[0] // 2)
+    cv2.putText(canvas, text, (x, y), FONT, scale, TEXT_COLOR, thickness, cv2.LINE_AA)
+
+# Miniaturas cacheadas por ruta, fecha de modificación y tamaño.
+# Los arrays se devuelven como solo lectura para poder compartirlos entre hilos.
+@lru_cache(maxsize=THUMBNAIL_CACHE_SIZE)
+def _cached_thumbnail(path, mtime, side):
+    img = cv2.imread(path)
+    if img is None:
+        return None
+    thumbnail = _fit_square(img, side)
+    thumbnail.setflags(write=False)
+    return thumbnail
+
+# Obtener la miniatura de una imagen de famoso (o un recuadro si no existe)
+def load_thumbnail(path, side=CELEBRITY_SIDE):
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return _placeholder(side)
+
+    thumbnail = _cached_thumbnail(path, mtime, side)
+    if thumbnail is None:
+        return _placeholder(side)
+    return thumbnail
+
+# Preparar la foto del usuario, que puede venir como ruta o como array BGR
+def _user_square(user_image, side):
+    if isinstance(user_image, np.ndarray):
+        img = user_image
+    else:
+        img = cv2.imread(user_image)
+    if img is None:
+        return _placeholder(side)
+    return _fit_square(img, side)
+
+# Componer la tarjeta de resultados y devolverla codificada en memoria.
+# matches es una lista de tuplas (nombre, similitud, ruta_imagen).
+def render_result_card(user_image, matches, title="Celebrity Lookalikes",
+                       similarity_format="Similarity: {:.2f}", ext=".jpg"):
+    columns = max(1, len(matches))
+    width = max(CARD_MIN_WIDTH, columns * (CELEBRITY_SIDE + MARGIN) + MARGIN)
+    height = TITLE_HEIGHT + USER_SIDE + CAPTION_HEIGHT + CELEBRITY_SIDE + CAPTION_HEIGHT + MARGIN
+
+    card = np.full((height, width, 3), BACKGROUND_COLOR, dtype=np.uint8)
+    _put_centered(card, title, width // 2, TITLE_HEIGHT - 30, 1.4, 3)
+
+    # Foto del usuario centrada en la fila superior
+    y = TITLE_HEIGHT
+    x = (width - USER_SIDE) // 2
+    card[y:y + USER_SIDE, x:x + USER_SIDE] = _user_square(user_image, USER_SIDE)
+    _put_centered(card, "Your Photo", width // 2, y + USER_SIDE + 45, 1.0, 2)
+
+    # Famosos repartidos en la fila inferior
+    y = TITLE_HEIGHT + USER_SIDE + CAPTION_HEIGHT
+    row_width = columns * CELEBRITY_SIDE + (columns - 1) * MARGIN
+    x0 = (width - row_width) // 2
+    for i, (name, similarity, image_path) in enumerate(matches):
+        x = x0 + i * (CELEBRITY_SIDE + MARGIN)
+        card[y:y + CELEBRITY_SIDE, x:x + CELEBRITY_SIDE] = load_thumbnail(image_path, CELEBRITY_SIDE)
+        cx = x + CELEBRITY_SIDE // 2
+        _put_centered(card, str(name), cx, y + CELEBRITY_SIDE + 32, 0.8, 2)
+        _put_centered(card, similarity_format.format(similarity), cx, y + CELEBRITY_SIDE + 64, 0.7, 1)
+
+    ok, buffer = cv2.imencode(ext, card)
+    if not ok:
+        raise Exception(f"Could not encode result card as {ext}")
+    return buffer.tobytes()
+
+# Renderizar varias tarjetas en paralelo (OpenCV libera el GIL al componer y codificar).
+# Cada trabajo es un diccionario con user_image, matches y opcionalmente output_path.
+def render_cards_batch(jobs, max_workers=None, **card_options):
+    def render(job):
+        card = render_result_card(job["user_image"], job["matches"], **card_options)
+        output_path = job.get("output_path")
+        if output_path:
+            with open(output_path, "wb") as f:
+                f.write(card)
+        return card
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(render, jobs))
@@ -0,0 +1,326 @@
+import argparse
+import itertools
+import multiprocessing
+import os
+import threading
+import time
+import weakref
+from concurrent.futures import Future
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+from celebrity_index import DEFAULT_INDEX, CelebrityIndex, extract_vector
+
+# Segundos que se espera a cada fragmento antes de responder sin él
+SHARD_TIMEOUT = float(os.environ.get("CELEBRIA_SHARD_TIMEOUT", "5"))
+# Fragmentos arrancados aparte (`sharded_index.py serve`), como host:puerto separados por comas.
+# Sin la variable, el índice arranca un proceso local por fragmento.
+SHARD_ADDRESSES = [a.strip() for a in os.environ.get("CELEBRIA_SHARD_ADDRESSES", "").split(",") if a.strip()]
+SHARD_KEY = os.environ.get("CELEBRIA_SHARD_KEY", "")
+
+_request_ids = itertools.count()
+
+# Nombre del archivo de cada fragmento, junto al índice que los agrupa
+def shard_paths(sharded_path, shards):
+    base = os.path.splitext(sharded_path)[0]
+    base = base[:-len("_sharded")] if base.endswith("_sharded") else base
+    return [f"{base}_shard{i}of{shards}.pkl" for i in range(shards)]
+
+# Nombre del índice dividido de un índice
+def sharded_index_path(pkl_path):
+    return os.path.splitext(pkl_path)[0] + "_sharded.pkl"
+
+# Dividir un índice en fragmentos. Todas las fotos de un famoso van al mismo fragmento y cada fila
+# conserva su etiqueta, así que los resultados de los fragmentos se refieren al índice completo.
+# El índice que los agrupa (<source>_sharded.pkl) solo guarda nombres, géneros y rutas.
+def split_index(source_pkl, shards, output_path=None):
+    import pandas as pd
+    output_path = output_path or sharded_index_path(source_pkl)
+    df = pd.read_pickle(source_pkl)
+    df = df.dropna(subset=['face_vector_raw'])
+    identities, _ = df['celebrity_name'].factorize()
+    paths = shard_paths(output_path, shards)
+    for shard, path in enumerate(paths):
+        part = df[identities % shards == shard]
+        part.attrs = dict(df.attrs)
+        part.to_pickle(path + ".tmp", compression=None)
+        os.replace(path + ".tmp", path)
+        print(f"  {path}: {len(part)} embeddings")
+
+    metadata = df.drop(columns=['face_vector_raw'])
+    metadata.attrs = dict(df.attrs)
+    metadata.attrs['dimension'] = len(extract_vector(df['face_vector_raw'].iloc[0])) if len(df) \
+        else df.attrs.get('dimension', 0)
+    metadata.attrs['shard_files'] = [os.path.basename(path) for path in paths]
+    # Los fragmentos primero y el índice que los agrupa al final, como en build_mmap_index
+    metadata.to_pickle(output_path + ".tmp", compression=None)
+    os.replace(output_path + ".tmp", output_path)
+    print(f"Saved {shards} shards of {len(df)} embeddings to {output_path}")
+    return output_path
+
+# Servir un fragmento: cada conexión recibe lotes de consultas ya normalizadas y devuelve,
+# para cada una, los top_n famosos del fragmento como (etiqueta, similitud)
+def serve_shard(pkl_path, address, authkey, model_name=None, ready=None):
+    index = CelebrityIndex.load(pkl_path, model_name)
+    listener = Listener(address, authkey=authkey)
+    print(f"Serving {len(index)} embeddings from {pkl_path} on {listener.address[0]}:{listener.address[1]}")
+    if ready is not None:
+        ready.send(listener.address)
+        ready.close()
+    while True:
+        try:
+            connection = listener.accept()
+        except (OSError, multiprocessing.AuthenticationError) as e:
+            print(f"Rejected shard connection: {e}")
+            continue
+        threading.Thread(target=_serve_connection, args=(index, connection), daemon=True).start()
+
+def _serve_connection(index, connection):
+    # Un género sin famosos en este fragmento no debe buscar en todos sus famosos, como haría el índice
+    # completo si no hubiera ninguno: el coordinador ya lo ha comprobado con todos los fragmentos
+    present = set(np.unique(index.genders).tolist())
+    while True:
+        try:
+            request_id, queries, top_n, genders = connection.recv()
+        except (EOFError, OSError):
+            connection.close()
+            return
+        try:
+            results = [[] for _ in queries]
+            keep = [i for i, gender in enumerate(genders) if gender is None or gender in present]
+            if keep and len(index):
+                found = index.search_batch(queries[keep], top_n, [genders[i] for i in keep])
+                for i, matches in zip(keep, found):
+                    results[i] = matches
+            reply = (request_id, True, results)
+        except Exception as e:
+            reply = (request_id, False, str(e))
+        try:
+            connection.send(reply)
+        except (EOFError, OSError):
+            connection.close()
+            return
+
+# Proceso local de un fragmento: escucha en un puerto libre y se lo comunica al índice
+def _shard_process(pkl_path, model_name, authkey, ready):
+    serve_shard(pkl_path, ("127.0.0.1", 0), authkey, model_name, ready)
+
+def _stop_shards(processes, owner_pid):
+    # Solo el proceso que los arrancó puede pararlos (los workers de gunicorn los heredan del maestro)
+    if os.getpid() != owner_pid:
+        return
+    for process in processes:
+        if process is not None and process.is_alive():
+            process.terminate()
+
+# Conexión con un fragmento, compartida por todos los hilos: cada petición lleva un número y un hilo
+# recibe las respuestas y las entrega en su Future
+class _ShardConnection:
+
+    def __init__(self, address, authkey):
+        self.connection = Client(address, authkey=authkey)
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.closed = False
+        threading.Thread(target=self._receive, daemon=True, name=f"shard-{address[1]}").start()
+
+    def request(self, queries, top_n, genders):
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise ConnectionError("Shard connection closed")
+            request_id = next(_request_ids)
+            self.pending[request_id] = future
+            self.connection.send((request_id, queries, top_n, genders))
+        return future
+
+    def _receive(self):
+        while True:
+            try:
+                request_id, ok, payload = self.connection.recv()
+            except (EOFError, OSError) as e:
+                with self.lock:
+                    self.closed = True
+                    pending, self.pending = self.pending, {}
+                for future in pending.values():
+                    future.set_exception(ConnectionError(f"Shard connection lost: {e}"))
+                return
+            with self.lock:
+                future = self.pending.pop(request_id, None)
+            # Si nadie la espera es que el fragmento respondió después del tiempo límite
+            if future is not None:
+                if ok:
+                    future.set_result(payload)
+                else:
+                    future.set_exception(RuntimeError(payload))
+
+# Índice repartido en fragmentos servidos por otros procesos. Cada consulta se envía a todos los
+# fragmentos a la vez, cada uno devuelve sus top_n famosos y aquí se unen con el mismo criterio que
+# la búsqueda en un solo índice. Un fragmento que no responde en `timeout` segundos se deja fuera de
+# ese resultado en lugar de retrasarlo. Tiene la misma interfaz que CelebrityIndex.
+class ShardedCelebrityIndex(CelebrityIndex):
+
+    def __init__(self, df, shard_files, model_name=None, addresses=None, timeout=SHARD_TIMEOUT):
+        self.df = df
+        self.model_name = model_name or df.attrs.get('model_name')
+        self._dimension = df.attrs['dimension']
+        self._set_metadata(df)
+        self.timeout = timeout
+        self.partial_searches = 0
+        self._lock = threading.Lock()
+        self._connections = {}
+        self._pid = None
+        addresses = SHARD_ADDRESSES if addresses is None else addresses
+        self._processes = []
+        if addresses:
+            self._addresses = [_parse_address(address) for address in addresses]
+            self._authkey = SHARD_KEY.encode()
+        else:
+            self._authkey = os.urandom(16)
+            self._shard_files = shard_files
+            self._owner_pid = os.getpid()
+            self._processes = [None] * len(shard_files)
+            self._restarting = set()
+            weakref.finalize(self, _stop_shards, self._processes, self._owner_pid)
+            self._addresses = self._launch(range(len(shard_files)))
+
+    @property
+    def dimension(self):
+        return self._dimension
+
+    # Arrancar un proceso por fragmento y esperar a que todos hayan cargado el suyo
+    def _launch(self, shards):
+        context = multiprocessing.get_context("spawn")
+        pipes = []
+        for shard in shards:
+            path = self._shard_files[shard]
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=_shard_process, args=(path, self.model_name, self._authkey, sender),
+                                      daemon=True, name=f"shard-{os.path.basename(path)}")
+            process.start()
+            sender.close()
+            self._processes[shard] = process
+            pipes.append((shard, receiver))
+        addresses = []
+        for shard, receiver in pipes:
+            try:
+                addresses.append(receiver.recv())
+            except EOFError:
+                _stop_shards([self._processes[s] for s, _ in pipes], self._owner_pid)
+                raise RuntimeError(f"Shard process for {self._shard_files[shard]} exited while loading it")
+        return addresses
+
+    # Volver a arrancar en segundo plano un fragmento local que se ha caído; mientras carga,
+    # las búsquedas responden sin él
+    def _revive(self, shard):
+        process = self._processes[shard] if self._processes else None
+        if process is None or process.is_alive() or os.getpid() != self._owner_pid:
+            return
+        with self._lock:
+            if shard in self._restarting:
+                return
+            self._restarting.add(shard)
+        print(f"Restarting celebrity index shard {shard} (exit code {process.exitcode})")
+        threading.Thread(target=self._restart, args=(shard,), daemon=True, name=f"shard-restart-{shard}").start()
+
+    def _restart(self, shard):
+        try:
+            self._addresses[shard] = self._launch([shard])[0]
+        except Exception as e:
+            print(f"Error restarting celebrity index shard {shard}: {e}")
+        finally:
+            with self._lock:
+                self._restarting.discard(shard)
+
+    def _connection(self, shard):
+        with self._lock:
+            # Los hilos y las conexiones no sobreviven al fork de gunicorn: cada worker abre las suyas
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._connections = {}
+            connection = self._connections.get(shard)
+            if connection is None or connection.closed:
+                connection = self._connections[shard] = _ShardConnection(self._addresses[shard], self._authkey)
+            return connection
+
+    # Cada fragmento busca de forma exacta: `effort` no cambia nada
+    def search_batch(self, user_vectors, top_n=3, genders=None, effort=1.0):
+        queries = self._queries(user_vectors)
+        genders = list(genders) if genders is not None else [None] * len(queries)
+        # Como en el índice completo: un género sin ningún famoso busca en todos
+        valid = {gender: gender is None or self._rows_for_gender(gender) is not None for gender in dict.fromkeys(genders)}
+        genders = [gender if valid[gender] else None for gender in genders]
+
+        futures = []
+        for shard in range(len(self._addresses)):
+            try:
+                futures.append(self._connection(shard).request(queries, top_n, genders))
+            except (OSError, ConnectionError) as e:
+                futures.append(Future())
+                futures[-1].set_exception(e)
+        deadline = time.monotonic() + self.timeout
+        partials, missing = [], []
+        for shard, future in enumerate(futures):
+            try:
+                partials.append(future.result(timeout=max(0, deadline - time.monotonic())))
+            except Exception as e:
+                missing.append(shard)
+                print(f"Celebrity index shard {shard} did not answer: {str(e) or 'timeout'}")
+                self._revive(shard)
+        if len(missing) == len(futures):
+            raise RuntimeError("No celebrity index shard answered")
+        if missing:
+            self.partial_searches += 1
+
+        results = []
+        for i in range(len(queries)):
+            labels = [label for partial in partials for label, _ in partial[i]]
+            scores = [score for partial in partials for _, score in partial[i]]
+            positions = self.df.index.get_indexer(labels)
+            # Misma regla que _best_positions: la similitud mayor y, si empatan, la primera fila
+            best, seen = [], set()
+            for j in sorted(range(len(labels)), key=lambda j: (-scores[j], positions[j])):
+                identity = self.identities[positions[j]]
+                if identity not in seen:
+                    seen.add(identity)
+                    best.append((labels[j], float(scores[j])))
+                    if len(best) == top_n:
+                        break
+            results.append(best)
+        return results
+
+# "host:puerto" como tupla para multiprocessing.connection
+def _parse_address(address):
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split the celebrity index into shards, or serve one shard")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    split = subparsers.add_parser("split", help="Split an index into shards searched by separate processes")
+    split.add_argument("--source", type=str, default=DEFAULT_INDEX,
+                       help="Index to split (default: representations.pkl)")
+    split.add_argument("--shards", type=int, required=True,
+                       help="Number of shards")
+    split.add_argument("--output", type=str,
+                       help="Path of the index that groups the shards (default: <source>_sharded.pkl)")
+
+    serve = subparsers.add_parser("serve", help="Serve one shard for CELEBRIA_SHARD_ADDRESSES (needs CELEBRIA_SHARD_KEY)")
+    serve.add_argument("--index", type=str, required=True,
+                       help="Shard file (<source>_shard<i>of<n>.pkl)")
+    serve.add_argument("--host", type=str, default="127.0.0.1",
+                       help="Address to listen on (default: 127.0.0.1)")
+    serve.add_argument("--port", type=int, required=True,
+                       help="Port to listen on")
+    serve.add_argument("--model", type=str,
+                       help="Embedding model the shard must have been built with")
+    args = parser.parse_args()
+
+    if args.command == "split":
+        split_index(args.source, args.shards, args.output)
+    else:
+        if not SHARD_KEY:
+            parser.error("set CELEBRIA_SHARD_KEY to the key shared with the web backend")
+        serve_shard(args.index, (args.host, args.port), SHARD_KEY.encode(), args.model)
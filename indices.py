@@ -0,0 +1,264 @@
+"""
+Índices de famosos compartidos por los hilos del backend, con recarga en caliente.
+
+Cada modelo de embeddings tiene una versión vigente de su índice
+(VersionIndice): el índice ya cargado, su número de generación y la
+identificación del archivo del que salió. Una versión no cambia nunca; recargar
+construye el índice nuevo fuera del lock y después sustituye la referencia de
+una sola vez. Cada captura toma la versión vigente al empezar y la usa para
+todas sus caras, así que las capturas en curso terminan con el índice antiguo,
+las nuevas usan el nuevo y nadie espera a que se cargue. La versión antigua se
+libera cuando termina la última captura que la usaba (mientras tanto conviven
+las dos en memoria).
+
+Si el índice no se puede cargar al arrancar se usa uno vacío (generación 0) y
+un hilo comprueba su archivo cada INTERVALO_VACIO segundos (o cada
+CELEBRIA_INDEX_WATCH, si está definido): en cuanto aparece, se carga sin
+reiniciar. Si falla una recarga se sigue sirviendo la versión anterior.
+
+Hay dos formas de recargar:
+- POST /admin/index/reload, con un JSON opcional {"model": ..., "path": ...}.
+  `path` es el nombre de otro .pkl de la carpeta del índice, para pasar a un
+  conjunto de famosos nuevo. GET /admin/index muestra las versiones cargadas.
+  Ambos exigen `X-Admin-Token` con el valor de CELEBRIA_ADMIN_TOKEN; si no
+  está definido, solo se aceptan desde la propia máquina (127.0.0.1 o ::1).
+- CELEBRIA_INDEX_WATCH=<segundos>: un hilo comprueba cada ese tiempo si el
+  archivo de cada índice cargado ha cambiado y lo recarga cuando deja de
+  cambiar (dos comprobaciones seguidas con la misma fecha y tamaño). Con varios
+  workers de gunicorn es la opción a usar: el endpoint solo recarga el worker
+  que atiende la petición, mientras que cada worker vigila los archivos.
+
+Para publicar un índice nuevo conviene escribirlo en un archivo temporal y
+renombrarlo encima del anterior (celebrity_index.py ya lo hace así).
+"""
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+from flask import abort, jsonify, request
+
+INTERVALO_VIGILANCIA = float(os.environ.get("CELEBRIA_INDEX_WATCH", "0"))
+TOKEN_ADMIN = os.environ.get("CELEBRIA_ADMIN_TOKEN")
+DIRECCIONES_LOCALES = ("127.0.0.1", "::1")
+# Segundos entre comprobaciones del archivo de un índice vacío cuando no se vigilan los demás
+INTERVALO_VACIO = 5.0
+
+
+class VersionIndice:
+    """Una versión cargada del índice de un modelo. No se modifica después de crearla."""
+
+    __slots__ = ("modelo", "indice", "generacion", "ruta", "version", "firma", "cargado")
+
+    def __init__(self, modelo, indice, generacion, ruta, firma):
+        self.modelo = modelo
+        self.indice = indice
+        self.generacion = generacion
+        self.ruta = ruta
+        self.firma = firma
+        # Identifica el archivo (no el proceso): todos los workers que cargan el mismo archivo dan la misma
+        self.version = hashlib.sha1(f"{os.path.basename(ruta)}:{firma}".encode()).hexdigest()[:12] \
+            if firma else "empty"
+        self.cargado = time.time()
+
+    def resumen(self):
+        """
+        :return: Diccionario serializable a JSON con la versión.
+        """
+        return {
+            "model": self.modelo,
+            "generation": self.generacion,
+            "version": self.version,
+            "path": self.ruta,
+            "rows": len(self.indice),
+            "loaded_at": self.cargado,
+        }
+
+
+def firma_archivo(ruta):
+    """
+    Fecha de modificación y tamaño de un archivo, para saber si ha cambiado.
+
+    :param ruta: Ruta del archivo.
+    :return: Tupla (mtime en ns, tamaño), o None si no existe.
+    """
+    try:
+        datos = os.stat(ruta)
+    except OSError:
+        return None
+    return datos.st_mtime_ns, datos.st_size
+
+
+class AlmacenIndices:
+    """Versión vigente del índice de cada modelo, con carga perezosa y recarga atómica."""
+
+    def __init__(self, cargar, ruta_indice, vacio, intervalo_vigilancia=INTERVALO_VIGILANCIA):
+        """
+        :param cargar: Función (modelo, ruta) que carga un índice o lanza una excepción.
+        :param ruta_indice: Función (modelo) con la ruta por defecto del índice del modelo.
+        :param vacio: Función (modelo) que crea un índice vacío.
+        :param intervalo_vigilancia: Segundos entre comprobaciones de los archivos (0 para vigilar solo los
+                                     índices vacíos).
+        """
+        self._cargar = cargar
+        self._ruta_indice = ruta_indice
+        self._vacio = vacio
+        self.intervalo_vigilancia = intervalo_vigilancia
+        self._versiones = {}
+        self._generaciones = {}
+        # Un lock por modelo para no cargar dos veces el mismo índice; las lecturas no lo usan
+        self._locks = {}
+        self._lock = threading.Lock()
+        self._pid_vigilante = None
+
+    def actual(self, modelo):
+        """
+        Devuelve la versión vigente del índice de un modelo, cargándolo la primera vez.
+
+        :param modelo: Nombre del modelo de embeddings.
+        :return: VersionIndice.
+        """
+        version = self._versiones.get(modelo) or self.precargar(modelo)
+        self._asegurar_vigilante()
+        return version
+
+    def precargar(self, modelo):
+        """
+        Carga el índice de un modelo si aún no está cargado, sin arrancar el hilo de vigilancia.
+
+        Se usa al importar el backend: con preload_app el proceso maestro de gunicorn
+        carga el índice antes del fork, pero solo los workers vigilan los archivos.
+
+        :param modelo: Nombre del modelo de embeddings.
+        :return: VersionIndice.
+        """
+        with self._lock_modelo(modelo):
+            if modelo not in self._versiones:
+                ruta = self._ruta_indice(modelo)
+                try:
+                    self._publicar(modelo, ruta, firma_archivo(ruta), self._cargar(modelo, ruta))
+                except Exception as e:
+                    print(f"Warning: Failed to load celebrity embeddings from {ruta}: {e}")
+                    print("Using empty index as fallback")
+                    self._versiones[modelo] = VersionIndice(modelo, self._vacio(modelo), 0, ruta, None)
+            return self._versiones[modelo]
+
+    def recargar(self, modelo, ruta=None):
+        """
+        Carga de nuevo el índice de un modelo y lo sustituye cuando está listo.
+
+        Si la carga falla se mantiene la versión anterior y se propaga la excepción.
+
+        :param modelo: Nombre del modelo de embeddings.
+        :param ruta: Archivo del índice nuevo (por defecto, el de la versión vigente).
+        :return: VersionIndice nueva.
+        """
+        with self._lock_modelo(modelo):
+            anterior = self._versiones.get(modelo)
+            ruta = ruta or (anterior.ruta if anterior else self._ruta_indice(modelo))
+            firma = firma_archivo(ruta)
+            inicio = time.perf_counter()
+            indice = self._cargar(modelo, ruta)
+            version = self._publicar(modelo, ruta, firma, indice)
+        print(f"Reloaded {modelo} celebrity index from {ruta}: generation {version.generacion}, "
+              f"{len(indice)} embeddings in {time.perf_counter() - inicio:.1f} s")
+        return version
+
+    def estado(self):
+        """
+        :return: Lista con el resumen de la versión vigente de cada modelo cargado.
+        """
+        return [version.resumen() for version in list(self._versiones.values())]
+
+    def _publicar(self, modelo, ruta, firma, indice):
+        with self._lock:
+            generacion = self._generaciones.get(modelo, 0) + 1
+            self._generaciones[modelo] = generacion
+        version = VersionIndice(modelo, indice, generacion, ruta, firma)
+        # Asignar una referencia es atómico: cada lector ve la versión antigua o la nueva, completas
+        self._versiones[modelo] = version
+        return version
+
+    def _lock_modelo(self, modelo):
+        with self._lock:
+            return self._locks.setdefault(modelo, threading.Lock())
+
+    def _asegurar_vigilante(self):
+        # Los hilos no sobreviven al fork de gunicorn: cada worker arranca el suyo
+        if self._pid_vigilante == os.getpid():
+            return
+        # Sin CELEBRIA_INDEX_WATCH solo hace falta vigilar si hay algún índice vacío esperando su archivo
+        if self.intervalo_vigilancia > 0 or any(v.generacion == 0 for v in list(self._versiones.values())):
+            self._pid_vigilante = os.getpid()
+            threading.Thread(target=self._vigilar, daemon=True, name="vigilancia-indices").start()
+
+    def _vigilar(self):
+        vistas, fallidas = {}, {}
+        while True:
+            time.sleep(self.intervalo_vigilancia if self.intervalo_vigilancia > 0 else INTERVALO_VACIO)
+            for version in list(self._versiones.values()):
+                if self.intervalo_vigilancia <= 0 and version.generacion != 0:
+                    continue
+                firma = firma_archivo(version.ruta)
+                if firma is None or firma == version.firma or firma == fallidas.get(version.modelo):
+                    continue
+                # Esperar a que el archivo deje de cambiar antes de cargarlo
+                if vistas.get(version.modelo) != firma:
+                    vistas[version.modelo] = firma
+                    continue
+                vistas.pop(version.modelo, None)
+                try:
+                    self.recargar(version.modelo, version.ruta)
+                except Exception as e:
+                    # No reintentar hasta que el archivo vuelva a cambiar
+                    fallidas[version.modelo] = firma
+                    print(f"Error reloading {version.modelo} celebrity index from {version.ruta}: {e}")
+
+
+def _token_valido():
+    # Sin token configurado no se abre a la red: solo a quien esté en la propia máquina
+    if not TOKEN_ADMIN:
+        return request.remote_addr in DIRECCIONES_LOCALES
+    return hmac.compare_digest(request.headers.get("X-Admin-Token", ""), TOKEN_ADMIN)
+
+
+def instalar_recarga(app, almacen, modelo_por_defecto, modelos):
+    """
+    Registra en la aplicación Flask los endpoints /admin/index y /admin/index/reload.
+
+    :param app: Aplicación Flask.
+    :param almacen: AlmacenIndices del backend.
+    :param modelo_por_defecto: Modelo que se recarga si la petición no indica otro.
+    :param modelos: Modelos que se pueden recargar.
+    """
+    @app.route('/admin/index')
+    def index_status():
+        """Show the celebrity index version loaded for each model"""
+        if not _token_valido():
+            abort(403)
+        return jsonify({"indices": almacen.estado()})
+
+    @app.route('/admin/index/reload', methods=['POST'])
+    def reload_index():
+        """Load the celebrity index again and swap it in once it is ready"""
+        if not _token_valido():
+            abort(403)
+        datos = request.get_json(silent=True) or {}
+        modelo = datos.get('model') or modelo_por_defecto
+        if modelo not in modelos:
+            return jsonify({"success": False, "error": f"Unknown model '{modelo}'"}), 400
+        ruta = None
+        if datos.get('path'):
+            # Solo otros índices de la misma carpeta, nunca rutas arbitrarias
+            nombre = os.path.basename(datos['path'])
+            if nombre != datos['path'] or not nombre.endswith(".pkl"):
+                return jsonify({"success": False, "error": "path must be a .pkl file name"}), 400
+            ruta = os.path.join(os.path.dirname(almacen.actual(modelo).ruta), nombre)
+        try:
+            version = almacen.recargar(modelo, ruta)
+        except Exception as e:
+            print(f"Error reloading {modelo} celebrity index: {e}")
+            return jsonify({"success": False, "error": str(e),
+                            "serving": almacen.actual(modelo).resumen()}), 500
+        return jsonify({"success": True, "index": version.resumen()})
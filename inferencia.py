@@ -0,0 +1,319 @@
+"""
+Inferencia en procesos aparte, con las fotos en memoria compartida.
+
+Con CELEBRIA_INFERENCE_PROCESSES=N (0 por defecto: todo en el proceso web) la
+detección de caras y los embeddings se ejecutan en N procesos de inferencia en
+lugar de en los hilos del servidor web. Así TensorFlow no compite por el GIL
+con las peticiones de E/S, y si DeepFace o TensorFlow tumban un proceso de
+inferencia el servidor web sigue en pie: la captura afectada termina en error y
+el proceso se vuelve a arrancar solo.
+
+Las fotos no se serializan ni se copian entre procesos. El proceso web reserva
+un anillo de CELEBRIA_SHM_SLOTS ranuras de memoria compartida
+(multiprocessing.shared_memory) de CELEBRIA_SHM_SLOT_MB MB cada una (16 por
+defecto; la foto puede ocupar como mucho la mitad y el resto queda para los
+recortes). Cada captura decodificada se escribe en una ranura libre; el proceso
+de inferencia la lee como un array de numpy sobre la misma memoria y deja los
+recortes de las caras detrás de la foto, en la misma ranura. Por las colas solo viajan mensajes
+pequeños: el número de ranura, la forma de la foto, dónde está cada recorte y
+los vectores de los embeddings. La búsqueda en el índice sigue en el proceso
+web, que es quien tiene el índice cargado (ver indices.py).
+
+Cada proceso de inferencia atiende una captura a la vez, con sus propias colas
+de peticiones y de resultados. Si una captura tarda más de
+CELEBRIA_INFERENCE_TIMEOUT segundos se termina su proceso y se arranca otro con
+colas nuevas, por si el anterior las dejó a medio usar. Los procesos se crean con "spawn" (no heredan el estado de TensorFlow del
+proceso web) la primera vez que se usan en cada worker de gunicorn.
+"""
+import atexit
+import itertools
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as TiempoAgotado
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import metricas
+
+PROCESOS = int(os.environ.get("CELEBRIA_INFERENCE_PROCESSES", "0"))
+RANURAS = int(os.environ.get("CELEBRIA_SHM_SLOTS", "0")) or 2 * max(1, PROCESOS)
+TAMANO_RANURA = int(float(os.environ.get("CELEBRIA_SHM_SLOT_MB", "16")) * 2**20)
+TIEMPO_MAXIMO = float(os.environ.get("CELEBRIA_INFERENCE_TIMEOUT", "60"))
+
+# Los recortes empiezan en múltiplos de 64 bytes dentro de la ranura
+ALINEACION = 64
+
+
+def _alinear(n):
+    return (n + ALINEACION - 1) // ALINEACION * ALINEACION
+
+
+def _abrir_ranura(nombre):
+    """
+    Abre una ranura creada por el proceso web. Solo el proceso web la borra.
+
+    :param nombre: Nombre del bloque de memoria compartida.
+    :return: SharedMemory.
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=nombre, track=False)
+    # Antes de Python 3.13 abrirla la registra en el resource tracker, pero los procesos creados con
+    # spawn comparten el del proceso web, que ya la tenía registrada: no se borra al salir el hijo
+    return shared_memory.SharedMemory(name=nombre)
+
+
+class ResultadoInferencia:
+    """
+    Caras y embeddings de una captura. Los recortes son vistas sobre la ranura de
+    memoria compartida: hay que usarlos dentro de `with` y no guardarlos después.
+    """
+
+    def __init__(self, pool, ranura, caras, vectores):
+        self._pool = pool
+        self._ranura = ranura
+        # Recortes RGB uint8 (vacío si no se detectó ninguna cara) y un vector por recorte, o uno para la foto entera
+        self.caras = caras
+        self.vectores = vectores
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.liberar()
+        return False
+
+    def liberar(self):
+        """Devuelve la ranura al anillo."""
+        if self._ranura is not None:
+            self.caras = []
+            self._pool._liberar_ranura(self._ranura)
+            self._ranura = None
+
+
+class PoolInferencia:
+    """Procesos de inferencia y anillo de ranuras de memoria compartida de un worker web."""
+
+    def __init__(self, procesos=PROCESOS, ranuras=RANURAS, tamano_ranura=TAMANO_RANURA,
+                 tiempo_maximo=TIEMPO_MAXIMO):
+        self.procesos = procesos
+        self.ranuras = max(ranuras, procesos)
+        self.tamano_ranura = tamano_ranura
+        self.tiempo_maximo = tiempo_maximo
+        self._pid = None
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def analizar(self, imagen, modelo):
+        """
+        Detecta las caras de una foto y calcula sus embeddings en un proceso de inferencia.
+
+        :param imagen: Foto BGR uint8 decodificada.
+        :param modelo: Modelo de embeddings.
+        :return: ResultadoInferencia (usar con `with` para liberar la ranura).
+        """
+        imagen = np.ascontiguousarray(imagen, dtype=np.uint8)
+        if imagen.nbytes > self.tamano_ranura // 2:
+            raise ValueError(f"Frame of {imagen.nbytes / 2**20:.1f} MB does not fit in a "
+                             f"{self.tamano_ranura / 2**20:.0f} MB shared memory slot")
+        self._arrancar()
+
+        try:
+            ranura = self._libres.get(timeout=self.tiempo_maximo)
+        except queue.Empty:
+            raise RuntimeError("No free shared memory slot for inference")
+        try:
+            destino = np.ndarray(imagen.shape, dtype=np.uint8, buffer=self._bloques[ranura].buf)
+            destino[...] = imagen
+            try:
+                numero = self._inactivos.get(timeout=self.tiempo_maximo)
+            except queue.Empty:
+                raise RuntimeError("No inference process available")
+            futuro = Future()
+            id_peticion = next(self._ids)
+            with self._lock:
+                self._asignados[numero] = (id_peticion, futuro)
+                proceso = self._procesos[numero]
+            self._peticiones[numero].put((id_peticion, ranura, imagen.shape, modelo))
+            try:
+                recortes, vectores = futuro.result(timeout=self.tiempo_maximo)
+            except TiempoAgotado:
+                # El proceso sigue escribiendo en la ranura: hay que pararlo antes de reutilizarla
+                self._reiniciar(numero, proceso, f"inference took more than {self.tiempo_maximo:.0f} s")
+                raise RuntimeError(f"Inference timed out after {self.tiempo_maximo:.0f} s")
+        except BaseException:
+            self._liberar_ranura(ranura)
+            raise
+
+        buffer = self._bloques[ranura].buf
+        caras = [np.ndarray(forma, dtype=np.uint8, buffer=buffer, offset=desplazamiento)
+                 for desplazamiento, forma in recortes]
+        return ResultadoInferencia(self, ranura, caras, vectores)
+
+    def _liberar_ranura(self, ranura):
+        self._libres.put(ranura)
+
+    def _arrancar(self):
+        # Los procesos, las colas y los hilos no sobreviven al fork de gunicorn: cada worker crea los suyos
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._contexto = multiprocessing.get_context("spawn")
+            self._bloques = [shared_memory.SharedMemory(create=True, size=self.tamano_ranura)
+                             for _ in range(self.ranuras)]
+            self._libres = queue.Queue()
+            for ranura in range(self.ranuras):
+                self._libres.put(ranura)
+            self._peticiones = [None] * self.procesos
+            self._resultados = [None] * self.procesos
+            self._procesos = [None] * self.procesos
+            self._asignados = {}
+            self._inactivos = queue.Queue()
+            for numero in range(self.procesos):
+                self._lanzar(numero, inactivo=True)
+            self._pid = os.getpid()
+            atexit.register(self._cerrar)
+            threading.Thread(target=self._vigilar, daemon=True, name="inferencia-vigilancia").start()
+            print(f"Started {self.procesos} inference processes with {self.ranuras} shared memory slots "
+                  f"of {self.tamano_ranura / 2**20:.0f} MB")
+
+    def _lanzar(self, numero, inactivo):
+        # Colas nuevas en cada arranque: un proceso terminado a la fuerza puede dejar a medias un mensaje
+        # o con el lock de escritura tomado la cola de resultados, y ninguna otra respuesta llegaría
+        self._peticiones[numero] = self._contexto.Queue()
+        self._resultados[numero] = resultados = self._contexto.Queue()
+        proceso = self._contexto.Process(
+            target=_proceso_inferencia, name=f"inferencia-{numero}", daemon=True,
+            args=(numero, [b.name for b in self._bloques], self.tamano_ranura,
+                  self._peticiones[numero], resultados))
+        proceso.start()
+        self._procesos[numero] = proceso
+        threading.Thread(target=self._recibir, args=(numero, resultados), daemon=True,
+                         name=f"inferencia-resultados-{numero}").start()
+        if inactivo:
+            self._inactivos.put(numero)
+
+    def _reiniciar(self, numero, proceso, motivo):
+        with self._lock:
+            # Otro hilo ya lo ha reiniciado: el proceso que hay ahora en el hueco está sano y puede tener una petición
+            if proceso is None or self._procesos[numero] is not proceso:
+                return
+            self._procesos[numero] = None
+            asignado = self._asignados.pop(numero, None)
+        print(f"Restarting inference process {numero} (pid {proceso.pid}): {motivo}")
+        metricas.incrementar("inference_process_restarts_total")
+        if proceso.is_alive():
+            proceso.terminate()
+        proceso.join(5)
+        if asignado is not None and not asignado[1].done():
+            asignado[1].set_exception(RuntimeError(f"Inference process failed: {motivo}"))
+        # Si no tenía petición asignada ya estaba en la cola de inactivos
+        self._lanzar(numero, inactivo=asignado is not None)
+
+    def _recibir(self, numero, resultados):
+        # Un hilo por proceso, hasta que el proceso se reinicia con otra cola de resultados
+        while self._resultados[numero] is resultados:
+            try:
+                _, id_peticion, correcto, datos = resultados.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError):
+                return
+            with self._lock:
+                asignado = self._asignados.get(numero)
+                if asignado is None or asignado[0] != id_peticion:
+                    # Respuesta de una petición ya abandonada (proceso reiniciado)
+                    continue
+                del self._asignados[numero]
+            self._inactivos.put(numero)
+            if correcto:
+                asignado[1].set_result(datos)
+            else:
+                asignado[1].set_exception(RuntimeError(datos))
+
+    def _vigilar(self):
+        while True:
+            time.sleep(0.5)
+            for numero, proceso in enumerate(list(self._procesos)):
+                if proceso is not None and not proceso.is_alive():
+                    self._reiniciar(numero, proceso, f"exited with code {proceso.exitcode}")
+
+    def _cerrar(self):
+        if self._pid != os.getpid():
+            return
+        for cola in self._peticiones:
+            cola.put(None)
+        for proceso in self._procesos:
+            if proceso is not None:
+                proceso.join(2)
+                if proceso.is_alive():
+                    proceso.terminate()
+        for bloque in self._bloques:
+            try:
+                bloque.close()
+            except BufferError:
+                # Aún hay recortes apuntando a la ranura; el sistema la libera al terminar el proceso
+                pass
+            bloque.unlink()
+
+
+def _proceso_inferencia(numero, nombres, tamano_ranura, peticiones, resultados):
+    """
+    Bucle de un proceso de inferencia: detecta caras y calcula embeddings de las fotos de las ranuras.
+
+    :param numero: Número del proceso en el pool.
+    :param nombres: Nombres de los bloques de memoria compartida del anillo.
+    :param tamano_ranura: Tamaño en bytes de cada ranura.
+    :param peticiones: Cola de (id, ranura, forma de la foto, modelo); None para terminar.
+    :param resultados: Cola de (número del proceso, id, correcto, (recortes, vectores) o mensaje de error).
+    """
+    directorio = os.path.dirname(os.path.abspath(__file__))
+    sys.path[:0] = [directorio, os.path.join(directorio, "imdb-wiki")]
+    from modelo_simulado import instalar_desde_entorno
+    instalar_desde_entorno(ocupar_cpu=True)
+
+    import cv2
+    from celebrity2 import extract_vector, get_embedding_backend
+    from detectores import detectar_caras
+
+    bloques = [_abrir_ranura(nombre) for nombre in nombres]
+    while True:
+        peticion = peticiones.get()
+        if peticion is None:
+            break
+        id_peticion, ranura, forma, modelo = peticion
+        try:
+            buffer = bloques[ranura].buf
+            imagen = np.ndarray(forma, dtype=np.uint8, buffer=buffer)
+            caras = detectar_caras(imagen)
+
+            # Los recortes se escriben en la misma ranura, detrás de la foto
+            recortes, imagenes = [], []
+            desplazamiento = _alinear(imagen.nbytes)
+            for cara in caras:
+                recorte = (cara['face'] * 255).astype(np.uint8)
+                if desplazamiento + recorte.nbytes > tamano_ranura:
+                    print(f"Shared memory slot full: skipping {len(caras) - len(recortes)} of {len(caras)} faces")
+                    break
+                np.ndarray(recorte.shape, dtype=np.uint8, buffer=buffer, offset=desplazamiento)[...] = recorte
+                recortes.append((desplazamiento, recorte.shape))
+                imagenes.append(cv2.cvtColor(recorte, cv2.COLOR_RGB2BGR))
+                desplazamiento = _alinear(desplazamiento + recorte.nbytes)
+            # Sin caras se calcula el embedding de la foto entera, como en el proceso web
+            representaciones = get_embedding_backend(modelo).represent_batch(imagenes or [imagen])
+            vectores = [np.asarray(extract_vector(r), dtype=np.float32) for r in representaciones]
+            resultados.put((numero, id_peticion, True, (recortes, vectores)))
+        except Exception as e:
+            resultados.put((numero, id_peticion, False, f"{type(e).__name__}: {e}"))
+        imagen = imagenes = None
+    for bloque in bloques:
+        try:
+            bloque.close()
+        except BufferError:
+            pass
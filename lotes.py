@@ -0,0 +1,158 @@
+"""
+Agrupación de las caras de capturas simultáneas en lotes de inferencia.
+
+Cuando varios photocalls envían capturas a la vez, cada petición calculaba el
+embedding de sus caras por separado y el modelo hacía muchas inferencias de
+una sola cara seguidas. El agrupador recibe las caras de todas las peticiones
+en una cola por modelo. Un hilo por modelo toma la primera cara que llega,
+espera como mucho CELEBRIA_BATCH_WINDOW_MS milisegundos (o hasta reunir
+CELEBRIA_BATCH_MAX caras) a que lleguen más, calcula los embeddings de todas en
+una sola llamada al backend de embeddings, busca todas en el índice con un
+solo producto de matrices y devuelve a cada petición su resultado.
+
+La ventana añade como mucho esos milisegundos de espera a una captura que
+llega sola, a cambio de no encadenar inferencias cuando llegan varias. Con
+CELEBRIA_BATCH_WINDOW_MS=0 (por defecto) no se agrupa nada. Tampoco se agrupa
+cuando la inferencia se hace en procesos aparte (inferencia.py).
+
+Si la captura de una cara se cancela mientras la cara espera en la cola (ver
+trabajos.py), su Future se cancela y la cara sale del lote sin calcular nada.
+
+Con CELEBRIA_METRICS=1, /metrics incluye el tamaño de cada lote
+(celebria_batch_size{batch="inference"}) y la espera de cada cara en la cola
+(etapa batch_wait).
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import metricas
+
+VENTANA_MS = float(os.environ.get("CELEBRIA_BATCH_WINDOW_MS", "0"))
+MAX_LOTE = int(os.environ.get("CELEBRIA_BATCH_MAX", "16"))
+
+
+class PeticionCara:
+    """Una cara pendiente de embedding y búsqueda, con el Future donde se deja su resultado."""
+
+    __slots__ = ("ruta", "genero", "version", "esfuerzo", "futuro", "llegada")
+
+    def __init__(self, ruta, genero, version, esfuerzo=1.0):
+        self.ruta = ruta
+        self.genero = genero
+        self.version = version
+        self.esfuerzo = esfuerzo
+        self.futuro = Future()
+        self.llegada = time.perf_counter()
+
+
+class AgrupadorLotes:
+    """Cola de caras por modelo y un hilo por modelo que las procesa en lotes."""
+
+    def __init__(self, embeber, extraer_vector, ventana_ms=VENTANA_MS, max_lote=MAX_LOTE, top_n=3):
+        """
+        :param embeber: Función (rutas, modelo) que devuelve la representación de cada imagen.
+        :param extraer_vector: Función que obtiene el vector de una representación.
+        :param ventana_ms: Milisegundos que se espera a más caras después de la primera.
+        :param max_lote: Número máximo de caras por lote.
+        :param top_n: Famosos devueltos por cara.
+        """
+        self._embeber = embeber
+        self._extraer_vector = extraer_vector
+        self.ventana = ventana_ms / 1000
+        self.max_lote = max(1, max_lote)
+        self.top_n = top_n
+        self._colas = {}
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def enviar(self, ruta, modelo, version, genero=None, esfuerzo=1.0):
+        """
+        Encola una cara para calcular su embedding y buscarla en el índice.
+
+        :param ruta: Ruta de la imagen de la cara.
+        :param modelo: Modelo de embeddings.
+        :param version: VersionIndice en la que se busca (ver indices.py).
+        :param genero: Filtro de género, o None.
+        :param esfuerzo: Fracción de las fases aproximadas de la búsqueda (ver calidad.py).
+        :return: Future con la lista de (etiqueta de la fila, similitud) de los top_n famosos. Cancelarlo
+                 antes de que entre en un lote evita calcular esa cara.
+        """
+        peticion = PeticionCara(ruta, genero, version, esfuerzo)
+        self._cola(modelo).put(peticion)
+        return peticion.futuro
+
+    def _cola(self, modelo):
+        with self._lock:
+            # Los hilos no sobreviven al fork de gunicorn: cada worker arranca los suyos
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._colas = {}
+            if modelo not in self._colas:
+                self._colas[modelo] = queue.Queue()
+                threading.Thread(target=self._procesar, args=(modelo, self._colas[modelo]), daemon=True,
+                                 name=f"lotes-{modelo}").start()
+            return self._colas[modelo]
+
+    def _procesar(self, modelo, cola):
+        while True:
+            lote = [cola.get()]
+            limite = lote[0].llegada + self.ventana
+            while len(lote) < self.max_lote:
+                espera = limite - time.perf_counter()
+                try:
+                    lote.append(cola.get(timeout=espera) if espera > 0 else cola.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._ejecutar(modelo, lote)
+            except Exception as e:
+                # Que un error inesperado no deje esperando a nadie ni pare el hilo
+                for peticion in lote:
+                    if not peticion.futuro.done():
+                        peticion.futuro.set_exception(e)
+
+    def _ejecutar(self, modelo, lote):
+        # Las caras de capturas canceladas mientras esperaban no se procesan
+        lote = [peticion for peticion in lote if peticion.futuro.set_running_or_notify_cancel()]
+        if not lote:
+            return
+        inicio = time.perf_counter()
+        for peticion in lote:
+            metricas.observar("batch_wait", inicio - peticion.llegada)
+        metricas.tamano_lote("inference", len(lote))
+        self._resolver(modelo, lote)
+
+    def _resolver(self, modelo, lote):
+        try:
+            with metricas.etapa("embedding"):
+                representaciones = self._embeber([p.ruta for p in lote], modelo)
+        except Exception as e:
+            if len(lote) == 1:
+                lote[0].futuro.set_exception(e)
+                return
+            # Una imagen defectuosa no debe hacer fallar las caras de otros visitantes: repetirlas una a una
+            print(f"Error in batched embedding of {len(lote)} faces, retrying one by one: {e}")
+            for peticion in lote:
+                self._resolver(modelo, [peticion])
+            return
+
+        # Las caras se buscan en la versión del índice de su captura (puede haber dos durante una recarga)
+        # y con el esfuerzo del nivel de calidad de su captura
+        por_version = {}
+        for peticion, representacion in zip(lote, representaciones):
+            por_version.setdefault((id(peticion.version), peticion.esfuerzo), []).append((peticion, representacion))
+        for grupo in por_version.values():
+            try:
+                with metricas.etapa("search"):
+                    resultados = grupo[0][0].version.indice.search_batch(
+                        [self._extraer_vector(r) for _, r in grupo], self.top_n, [p.genero for p, _ in grupo],
+                    grupo[0][0].esfuerzo)
+            except Exception as e:
+                for peticion, _ in grupo:
+                    peticion.futuro.set_exception(e)
+                continue
+            for (peticion, _), resultado in zip(grupo, resultados):
+                peticion.futuro.set_result(resultado)
@@ -0,0 +1,303 @@
+"""
+Métricas de latencia por etapa del pipeline y exportación en formato Prometheus.
+
+Las métricas se activan con la variable de entorno CELEBRIA_METRICS=1. Si están
+desactivadas, etapa() devuelve un contexto vacío compartido y el resto de
+funciones retornan sin hacer nada, así que el coste es prácticamente nulo.
+"""
+import os
+import time
+import threading
+from collections import deque
+from contextlib import nullcontext
+
+from flask import Response, g, request
+
+ACTIVADAS = os.environ.get("CELEBRIA_METRICS", "0") == "1"
+
+# Límites superiores de los buckets del histograma (en segundos)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Buckets de los histogramas de tamaño de lote (número de elementos)
+BUCKETS_LOTE = (1, 2, 4, 8, 16, 32, 64, 128)
+
+# Cuantiles publicados para cada etapa y tamaño de la ventana de muestras usada para calcularlos
+CUANTILES = (0.5, 0.95, 0.99)
+TAMANO_VENTANA = 2048
+
+_CONTEXTO_VACIO = nullcontext()
+
+_lock = threading.Lock()
+_histogramas = {}
+_lotes = {}
+_contadores = {}
+_medidores = {}
+
+
+class Histograma:
+    """
+    Histograma acumulado con buckets fijos y una ventana de las últimas
+    muestras para estimar p50/p95/p99.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.cuentas = [0] * (len(buckets) + 1)
+        self.suma = 0.0
+        self.total = 0
+        self.ventana = deque(maxlen=TAMANO_VENTANA)
+        self._lock = threading.Lock()
+
+    def observar(self, valor):
+        with self._lock:
+            for i, limite in enumerate(self.buckets):
+                if valor <= limite:
+                    self.cuentas[i] += 1
+                    break
+            else:
+                self.cuentas[-1] += 1
+            self.suma += valor
+            self.total += 1
+            self.ventana.append(valor)
+
+    def cuantil(self, q):
+        with self._lock:
+            muestras = sorted(self.ventana)
+        if not muestras:
+            return 0.0
+        return muestras[min(len(muestras) - 1, int(q * len(muestras)))]
+
+    def instantanea(self):
+        with self._lock:
+            return list(self.cuentas), self.suma, self.total
+
+
+class _Cronometro:
+    """Contexto que mide la duración de un bloque y la registra en el histograma de la etapa."""
+
+    __slots__ = ("nombre", "inicio")
+
+    def __init__(self, nombre):
+        self.nombre = nombre
+
+    def __enter__(self):
+        self.inicio = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observar(self.nombre, time.perf_counter() - self.inicio)
+        return False
+
+
+def _clave(nombre, etiquetas):
+    return nombre, tuple(sorted(etiquetas.items()))
+
+
+def etapa(nombre):
+    """
+    Mide la duración de una etapa del pipeline.
+
+    :param nombre: Nombre de la etapa (decode, detection, embedding, search...).
+    :return: Contexto que registra la duración al salir.
+    """
+    if not ACTIVADAS:
+        return _CONTEXTO_VACIO
+    return _Cronometro(nombre)
+
+
+def observar(nombre, segundos):
+    """
+    Registra una duración en el histograma de una etapa.
+
+    :param nombre: Nombre de la etapa.
+    :param segundos: Duración medida.
+    """
+    if not ACTIVADAS:
+        return
+    histograma = _histogramas.get(nombre)
+    if histograma is None:
+        with _lock:
+            histograma = _histogramas.setdefault(nombre, Histograma())
+    histograma.observar(segundos)
+
+
+def tamano_lote(nombre, elementos):
+    """
+    Registra el tamaño de un lote, por ejemplo las caras de una inferencia agrupada.
+
+    :param nombre: Nombre del lote (inference...).
+    :param elementos: Número de elementos del lote.
+    """
+    if not ACTIVADAS:
+        return
+    histograma = _lotes.get(nombre)
+    if histograma is None:
+        with _lock:
+            histograma = _lotes.setdefault(nombre, Histograma(BUCKETS_LOTE))
+    histograma.observar(elementos)
+
+
+def incrementar(nombre, valor=1, **etiquetas):
+    """
+    Incrementa un contador.
+
+    :param nombre: Nombre del contador (sin el prefijo celebria_).
+    :param valor: Cantidad a sumar.
+    :param etiquetas: Etiquetas Prometheus del contador.
+    """
+    if not ACTIVADAS:
+        return
+    clave = _clave(nombre, etiquetas)
+    with _lock:
+        _contadores[clave] = _contadores.get(clave, 0) + valor
+
+
+def ajustar(nombre, delta, **etiquetas):
+    """
+    Suma (o resta) una cantidad a un medidor, por ejemplo la profundidad de la cola.
+
+    :param nombre: Nombre del medidor (sin el prefijo celebria_).
+    :param delta: Cantidad a sumar; negativa para restar.
+    :param etiquetas: Etiquetas Prometheus del medidor.
+    """
+    if not ACTIVADAS:
+        return
+    clave = _clave(nombre, etiquetas)
+    with _lock:
+        _medidores[clave] = _medidores.get(clave, 0) + delta
+
+
+def fijar(nombre, valor, **etiquetas):
+    """
+    Fija el valor de un medidor.
+
+    :param nombre: Nombre del medidor (sin el prefijo celebria_).
+    :param valor: Nuevo valor.
+    :param etiquetas: Etiquetas Prometheus del medidor.
+    """
+    if not ACTIVADAS:
+        return
+    with _lock:
+        _medidores[_clave(nombre, etiquetas)] = valor
+
+
+def acierto_cache(cache, acierto):
+    """
+    Registra un acierto o fallo de una caché para calcular su tasa de aciertos.
+
+    :param cache: Nombre de la caché.
+    :param acierto: True si el dato estaba en caché.
+    """
+    incrementar("cache_requests_total", cache=cache, result="hit" if acierto else "miss")
+
+
+def _formatear_etiquetas(etiquetas):
+    if not etiquetas:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in etiquetas) + "}"
+
+
+def exportar_prometheus():
+    """
+    Genera el texto de todas las métricas en el formato de exposición de Prometheus.
+
+    :return: Texto listo para servir en /metrics.
+    """
+    lineas = []
+    with _lock:
+        histogramas = dict(_histogramas)
+        lotes = dict(_lotes)
+        contadores = dict(_contadores)
+        medidores = dict(_medidores)
+
+    lineas.append("# HELP celebria_stage_duration_seconds Duration of each pipeline stage.")
+    lineas.append("# TYPE celebria_stage_duration_seconds histogram")
+    for nombre, histograma in sorted(histogramas.items()):
+        cuentas, suma, total = histograma.instantanea()
+        acumulado = 0
+        for limite, cuenta in zip(histograma.buckets, cuentas):
+            acumulado += cuenta
+            lineas.append(f'celebria_stage_duration_seconds_bucket{{stage="{nombre}",le="{limite}"}} {acumulado}')
+        lineas.append(f'celebria_stage_duration_seconds_bucket{{stage="{nombre}",le="+Inf"}} {total}')
+        lineas.append(f'celebria_stage_duration_seconds_sum{{stage="{nombre}"}} {suma}')
+        lineas.append(f'celebria_stage_duration_seconds_count{{stage="{nombre}"}} {total}')
+
+    lineas.append("# HELP celebria_stage_latency_seconds Recent latency quantiles of each pipeline stage.")
+    lineas.append("# TYPE celebria_stage_latency_seconds summary")
+    for nombre, histograma in sorted(histogramas.items()):
+        _, suma, total = histograma.instantanea()
+        for q in CUANTILES:
+            lineas.append(f'celebria_stage_latency_seconds{{stage="{nombre}",quantile="{q}"}} {histograma.cuantil(q)}')
+        lineas.append(f'celebria_stage_latency_seconds_sum{{stage="{nombre}"}} {suma}')
+        lineas.append(f'celebria_stage_latency_seconds_count{{stage="{nombre}"}} {total}')
+
+    if lotes:
+        lineas.append("# HELP celebria_batch_size Number of items processed together in each batch.")
+        lineas.append("# TYPE celebria_batch_size histogram")
+    for nombre, histograma in sorted(lotes.items()):
+        cuentas, suma, total = histograma.instantanea()
+        acumulado = 0
+        for limite, cuenta in zip(histograma.buckets, cuentas):
+            acumulado += cuenta
+            lineas.append(f'celebria_batch_size_bucket{{batch="{nombre}",le="{limite}"}} {acumulado}')
+        lineas.append(f'celebria_batch_size_bucket{{batch="{nombre}",le="+Inf"}} {total}')
+        lineas.append(f'celebria_batch_size_sum{{batch="{nombre}"}} {suma}')
+        lineas.append(f'celebria_batch_size_count{{batch="{nombre}"}} {total}')
+
+    for nombre in sorted({clave[0] for clave in contadores}):
+        lineas.append(f"# TYPE celebria_{nombre} counter")
+        for (n, etiquetas), valor in sorted(contadores.items()):
+            if n == nombre:
+                lineas.append(f"celebria_{n}{_formatear_etiquetas(etiquetas)} {valor}")
+
+    # Tasa de aciertos por caché, derivada de cache_requests_total
+    aciertos = {}
+    for (n, etiquetas), valor in contadores.items():
+        if n == "cache_requests_total":
+            etiquetas = dict(etiquetas)
+            hit, total = aciertos.get(etiquetas["cache"], (0, 0))
+            aciertos[etiquetas["cache"]] = (hit + (valor if etiquetas["result"] == "hit" else 0), total + valor)
+    if aciertos:
+        lineas.append("# TYPE celebria_cache_hit_ratio gauge")
+        for cache, (hit, total) in sorted(aciertos.items()):
+            lineas.append(f'celebria_cache_hit_ratio{{cache="{cache}"}} {hit / total if total else 0.0}')
+
+    for nombre in sorted({clave[0] for clave in medidores}):
+        lineas.append(f"# TYPE celebria_{nombre} gauge")
+        for (n, etiquetas), valor in sorted(medidores.items()):
+            if n == nombre:
+                lineas.append(f"celebria_{n}{_formatear_etiquetas(etiquetas)} {valor}")
+
+    return "\n".join(lineas) + "\n"
+
+
+def instalar_metricas(app):
+    """
+    Registra en la aplicación Flask la medición de cada petición y el endpoint /metrics.
+
+    :param app: Aplicación Flask.
+    """
+    @app.route('/metrics')
+    def metrics():
+        """Expose the collected metrics in Prometheus format"""
+        if not ACTIVADAS:
+            texto = "# Metrics are disabled. Set CELEBRIA_METRICS=1 to enable them.\n"
+        else:
+            texto = exportar_prometheus()
+        return Response(texto, mimetype='text/plain; version=0.0.4')
+
+    if not ACTIVADAS:
+        return
+
+    @app.before_request
+    def _iniciar_medicion():
+        g.metricas_inicio = time.perf_counter()
+
+    @app.after_request
+    def _registrar_peticion(response):
+        inicio = g.pop('metricas_inicio', None)
+        endpoint = request.endpoint or "unknown"
+        if inicio is not None and endpoint != "metrics":
+            observar(f"http_{endpoint}", time.perf_counter() - inicio)
+        incrementar("http_requests_total", endpoint=endpoint, status=response.status_code)
+        return response
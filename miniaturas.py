@@ -0,0 +1,270 @@
+"""
+Variantes reducidas y en formatos modernos de las imágenes de resultados.
+
+Las rutas de face-db y personas aceptan `?w=<ancho>` y negocian el formato con
+la cabecera Accept: AVIF si el navegador lo acepta y OpenCV sabe codificarlo,
+si no WebP, y si no JPEG. El ancho pedido se redondea al siguiente de ANCHOS
+para que el número de variantes por imagen esté acotado, y nunca se amplía la
+imagen original.
+
+Las variantes generadas se guardan en dos cachés:
+- en memoria, un LRU de hasta CELEBRIA_THUMB_CACHE_MB megabytes (32 por defecto);
+- en disco, en CELEBRIA_THUMB_DIR (.miniaturas), hasta CELEBRIA_THUMB_DISK_MB
+  megabytes (256 por defecto), borrando primero las menos usadas.
+
+La clave incluye la fecha de modificación y el tamaño del original, así que
+cuando una captura nueva reescribe personas/foto1.jpg no se sirve la variante
+de la captura anterior.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+from flask import Response, request
+
+import metricas
+from estaticos import aplicar_cache_imagen, resolver_ruta, servir_imagen
+
+ANCHOS = (150, 300, 450, 600, 900)
+CALIDAD = {"avif": 60, "webp": 80, "jpeg": 82}
+MAX_MEMORIA = int(os.environ.get("CELEBRIA_THUMB_CACHE_MB", "32")) * 1024 * 1024
+MAX_DISCO = int(os.environ.get("CELEBRIA_THUMB_DISK_MB", "256")) * 1024 * 1024
+CARPETA_DISCO = os.environ.get("CELEBRIA_THUMB_DIR", ".miniaturas")
+
+_TIPOS = {"avif": "image/avif", "webp": "image/webp", "jpeg": "image/jpeg"}
+_PARAMETROS = {
+    "avif": lambda calidad: [cv2.IMWRITE_AVIF_QUALITY, calidad] if hasattr(cv2, "IMWRITE_AVIF_QUALITY") else [],
+    "webp": lambda calidad: [cv2.IMWRITE_WEBP_QUALITY, calidad],
+    "jpeg": lambda calidad: [cv2.IMWRITE_JPEG_QUALITY, calidad, cv2.IMWRITE_JPEG_OPTIMIZE, 1],
+}
+
+
+def _codificador_disponible(formato):
+    try:
+        ok, _ = cv2.imencode(f".{formato}", np.zeros((8, 8, 3), dtype=np.uint8))
+        return bool(ok)
+    except cv2.error:
+        return False
+
+
+# Formatos que esta instalación de OpenCV sabe codificar, por orden de preferencia
+FORMATOS = tuple(f for f in ("avif", "webp") if _codificador_disponible(f)) + ("jpeg",)
+
+
+class CacheLRU:
+    """Caché en memoria de variantes acotada por el total de bytes guardados."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._datos = OrderedDict()
+        self._lock = threading.Lock()
+
+    def obtener(self, clave):
+        with self._lock:
+            valor = self._datos.get(clave)
+            if valor is not None:
+                self._datos.move_to_end(clave)
+            return valor
+
+    def guardar(self, clave, valor):
+        if len(valor) > self.max_bytes:
+            return
+        with self._lock:
+            anterior = self._datos.pop(clave, None)
+            if anterior is not None:
+                self.bytes -= len(anterior)
+            self._datos[clave] = valor
+            self.bytes += len(valor)
+            while self.bytes > self.max_bytes:
+                _, expulsado = self._datos.popitem(last=False)
+                self.bytes -= len(expulsado)
+
+
+_memoria = CacheLRU(MAX_MEMORIA)
+_lock_disco = threading.Lock()
+_bytes_disco = None
+
+
+def ajustar_ancho(ancho):
+    """
+    Redondea el ancho pedido al siguiente ancho permitido.
+
+    :param ancho: Ancho pedido en píxeles, o None para el tamaño original.
+    :return: Uno de ANCHOS, o None.
+    """
+    if not ancho or ancho <= 0:
+        return None
+    for permitido in ANCHOS:
+        if ancho <= permitido:
+            return permitido
+    return ANCHOS[-1]
+
+
+def negociar_formato(aceptados):
+    """
+    Elige el mejor formato de imagen que acepta el navegador.
+
+    :param aceptados: `request.accept_mimetypes` de la petición.
+    :return: "avif", "webp" o "jpeg".
+    """
+    for formato in FORMATOS[:-1]:
+        # Solo se cuenta una aceptación explícita; */* no garantiza que el navegador decodifique AVIF/WebP
+        if any(tipo == _TIPOS[formato] and calidad > 0 for tipo, calidad in aceptados):
+            return formato
+    return "jpeg"
+
+
+def _clave(ruta, ancho, formato):
+    estado = os.stat(ruta)
+    texto = f"{os.path.abspath(ruta)}|{estado.st_mtime_ns}|{estado.st_size}|{ancho}|{formato}"
+    return hashlib.sha1(texto.encode()).hexdigest()
+
+
+def _ruta_disco(clave):
+    return os.path.join(CARPETA_DISCO, clave[:2], clave)
+
+
+def _leer_disco(clave):
+    ruta = _ruta_disco(clave)
+    try:
+        with open(ruta, 'rb') as f:
+            datos = f.read()
+    except OSError:
+        return None
+    # La fecha de modificación hace de "último uso" para la limpieza
+    os.utime(ruta)
+    return datos
+
+
+def _guardar_disco(clave, datos):
+    global _bytes_disco
+    ruta = _ruta_disco(clave)
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    temporal = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporal, 'wb') as f:
+        f.write(datos)
+    os.replace(temporal, ruta)
+    with _lock_disco:
+        if _bytes_disco is None:
+            _bytes_disco = sum(os.path.getsize(a) for a, _ in _archivos_disco())
+        else:
+            _bytes_disco += len(datos)
+        if _bytes_disco > MAX_DISCO:
+            _bytes_disco = _limpiar_disco(int(MAX_DISCO * 0.8))
+
+
+def _archivos_disco():
+    for raiz, _, archivos in os.walk(CARPETA_DISCO):
+        for archivo in archivos:
+            ruta = os.path.join(raiz, archivo)
+            try:
+                yield ruta, os.path.getmtime(ruta)
+            except OSError:
+                continue
+
+
+def _limpiar_disco(objetivo):
+    """Borra las variantes menos usadas hasta bajar de `objetivo` bytes y devuelve el total restante."""
+    archivos = sorted(_archivos_disco(), key=lambda item: item[1])
+    total = sum(os.path.getsize(ruta) for ruta, _ in archivos)
+    for ruta, _ in archivos:
+        if total <= objetivo:
+            break
+        try:
+            tamano = os.path.getsize(ruta)
+            os.remove(ruta)
+            total -= tamano
+        except OSError:
+            continue
+    return total
+
+
+def generar_miniatura(ruta, ancho, formato):
+    """
+    Reduce y recodifica una imagen.
+
+    :param ruta: Ruta de la imagen original.
+    :param ancho: Ancho de destino, o None para mantener el original.
+    :param formato: "avif", "webp" o "jpeg".
+    :return: Bytes de la imagen codificada.
+    """
+    img = cv2.imread(ruta)
+    if img is None:
+        raise ValueError(f"Could not read image {ruta}")
+    alto_original, ancho_original = img.shape[:2]
+    if ancho and ancho < ancho_original:
+        alto = max(1, round(alto_original * ancho / ancho_original))
+        img = cv2.resize(img, (ancho, alto), interpolation=cv2.INTER_AREA)
+    ok, buffer = cv2.imencode(f".{formato}", img, _PARAMETROS[formato](CALIDAD[formato]))
+    if not ok:
+        raise ValueError(f"Could not encode {ruta} as {formato}")
+    return buffer.tobytes()
+
+
+def obtener_miniatura(ruta, ancho, formato):
+    """
+    Devuelve una variante de la imagen desde la caché en memoria, la de disco o generándola.
+
+    :param ruta: Ruta de la imagen original.
+    :param ancho: Ancho ya ajustado con ajustar_ancho(), o None.
+    :param formato: "avif", "webp" o "jpeg".
+    :return: Tupla (bytes, tipo MIME, clave de la variante para usar como ETag).
+    """
+    clave = _clave(ruta, ancho, formato)
+    datos = _memoria.obtener(clave)
+    metricas.acierto_cache("thumbnails_memory", datos is not None)
+    if datos is None:
+        datos = _leer_disco(clave)
+        metricas.acierto_cache("thumbnails_disk", datos is not None)
+        if datos is None:
+            datos = generar_miniatura(ruta, ancho, formato)
+            _guardar_disco(clave, datos)
+        _memoria.guardar(clave, datos)
+    return datos, _TIPOS[formato], clave
+
+
+def variante_pedida(args, aceptados):
+    """
+    Decide qué variante pide una petición.
+
+    :param args: Parámetros de la URL (`request.args`).
+    :param aceptados: `request.accept_mimetypes` de la petición.
+    :return: Tupla (ancho, formato), o None si basta con el archivo original.
+    """
+    ancho = ajustar_ancho(args.get('w', type=int))
+    formato = negociar_formato(aceptados)
+    if ancho is None and formato == "jpeg":
+        return None
+    return ancho, formato
+
+
+def servir_imagen_adaptada(carpeta, filename):
+    """
+    Sirve una imagen de face-db o personas con el tamaño y formato que pide el navegador.
+
+    :param carpeta: 'face-db' o 'personas'.
+    :param filename: Ruta relativa de la imagen.
+    :return: Respuesta de Flask.
+    """
+    variante = variante_pedida(request.args, request.accept_mimetypes)
+    ruta = resolver_ruta(carpeta, filename)
+    datos = None
+    if variante is not None and ruta is not None:
+        try:
+            datos, tipo, clave = obtener_miniatura(ruta, *variante)
+        except ValueError:
+            # OpenCV no puede leer el archivo (dañado o a medio escribir): mejor el original que un 500
+            datos = None
+    if datos is None:
+        response = servir_imagen(carpeta, filename)
+    else:
+        response = Response(datos, mimetype=tipo)
+        response.set_etag(clave)
+        response.make_conditional(request)
+        aplicar_cache_imagen(response, carpeta)
+    response.vary.add("Accept")
+    return response
@@ -0,0 +1,193 @@
+"""
+Modelo de caras simulado para benchmarks y pruebas de carga sin TensorFlow.
+
+instalar_modelo_simulado() registra un módulo `deepface` falso en sys.modules
+antes de importar los backends. Los embeddings se calculan proyectando una
+versión reducida de la imagen con una matriz aleatoria fija, así que la misma
+imagen siempre produce el mismo vector y caras distintas producen vectores
+distintos, que es lo que necesitan las búsquedas para ser realistas.
+
+La detección devuelve una cara por cada cuadrado de la foto: una foto cuadrada
+tiene una cara y generar_grupo_sintetico() pone N caras una al lado de otra
+para simular fotos de grupo.
+
+VGG-Face usa la dimensión configurada en instalar_modelo_simulado(); el resto de
+modelos usan la de su versión real (Facenet 128, ArcFace 512...), para poder
+comparar modelos con `python benchmark.py models`.
+"""
+import os
+import sys
+import time
+import types
+
+import cv2
+import numpy as np
+import pandas as pd
+
+
+# Dimensión de los embeddings de cada modelo en DeepFace 0.0.79
+DIMENSIONES = {"Facenet": 128, "Facenet512": 512, "OpenFace": 128, "DeepFace": 4096,
+               "DeepID": 160, "ArcFace": 512, "SFace": 128}
+
+
+class DeepFaceSimulado:
+    """Sustituto de la clase DeepFace con la misma firma en los métodos que usa el proyecto."""
+
+    dim = 2622  # Dimensión de VGG-Face y de los modelos que no están en DIMENSIONES
+    latencia = 0.0  # Segundos de cómputo simulado por inferencia
+    ocupar_cpu = False  # Si es True, la latencia se consume en un bucle que retiene el GIL
+    _proyecciones = {}
+    _cache_find = {}
+
+    @classmethod
+    def _leer(cls, img_path):
+        if isinstance(img_path, np.ndarray):
+            return img_path
+        img = cv2.imread(img_path)
+        if img is None:
+            raise ValueError(f"Confirm that {img_path} exists")
+        return img
+
+    @classmethod
+    def _dimension(cls, model_name):
+        return DIMENSIONES.get(model_name, cls.dim)
+
+    @classmethod
+    def _vector(cls, img, dim=None):
+        dim = dim or cls.dim
+        if dim not in cls._proyecciones:
+            rng = np.random.default_rng(dim)
+            cls._proyecciones[dim] = rng.standard_normal((8 * 8 * 3, dim)).astype(np.float32)
+        reducida = cv2.resize(img, (8, 8), interpolation=cv2.INTER_AREA).astype(np.float32).ravel() / 255.0
+        if cls.latencia:
+            if cls.ocupar_cpu:
+                fin = time.perf_counter() + cls.latencia
+                while time.perf_counter() < fin:
+                    pass
+            else:
+                time.sleep(cls.latencia)
+        return (reducida - reducida.mean()) @ cls._proyecciones[dim]
+
+    @classmethod
+    def extract_faces(cls, img_path, target_size=(224, 224), enforce_detection=True, **kwargs):
+        img = cls._leer(img_path)
+        h, w = img.shape[:2]
+        # Una cara por cada cuadrado de la foto (las fotos de grupo son más anchas que altas)
+        n = max(1, round(w / h))
+        caras = []
+        for i in range(n):
+            x, fin = i * w // n, (i + 1) * w // n
+            cara = cv2.resize(img[:, x:fin], target_size)[:, :, ::-1].astype(np.float32) / 255.0
+            caras.append({"face": cara, "facial_area": {"x": x, "y": 0, "w": fin - x, "h": h}, "confidence": 1.0})
+        return caras
+
+    @classmethod
+    def represent(cls, img_path, model_name="VGG-Face", enforce_detection=True, **kwargs):
+        img = cls._leer(img_path)
+        h, w = img.shape[:2]
+        return [{
+            "embedding": cls._vector(img, cls._dimension(model_name)).tolist(),
+            "facial_area": {"x": 0, "y": 0, "w": w, "h": h},
+            "face_confidence": 1.0,
+        }]
+
+    @classmethod
+    def find(cls, img_path, db_path, model_name="VGG-Face", enforce_detection=True, **kwargs):
+        dim = cls._dimension(model_name)
+        consulta = cls._vector(cls._leer(img_path), dim)
+        identidades, vectores = [], []
+        for archivo in sorted(os.listdir(db_path)):
+            if not archivo.lower().endswith(('.jpg', '.jpeg', '.png')):
+                continue
+            ruta = os.path.join(db_path, archivo)
+            clave = (ruta, os.path.getmtime(ruta), dim)
+            if clave not in cls._cache_find:
+                cls._cache_find[clave] = cls._vector(cls._leer(ruta), dim)
+            identidades.append(ruta)
+            vectores.append(cls._cache_find[clave])
+        if not vectores:
+            return []
+        matriz = np.stack(vectores)
+        similitud = matriz @ consulta / (np.linalg.norm(matriz, axis=1) * np.linalg.norm(consulta) + 1e-12)
+        return [pd.DataFrame({"identity": identidades, "distance": 1 - similitud})]
+
+    @staticmethod
+    def build_model(model_name):
+        return None
+
+
+def instalar_modelo_simulado(dim=2622, latencia=0.0, ocupar_cpu=False):
+    """
+    Registra el modelo simulado como módulo `deepface` para que los backends lo importen.
+
+    :param dim: Dimensión de los embeddings simulados.
+    :param latencia: Segundos de cómputo simulado por inferencia.
+    :param ocupar_cpu: Consumir la latencia ocupando la CPU en lugar de dormir.
+    :return: La clase DeepFaceSimulado configurada.
+    """
+    DeepFaceSimulado.dim = dim
+    DeepFaceSimulado.latencia = latencia
+    DeepFaceSimulado.ocupar_cpu = ocupar_cpu
+    modulo = types.ModuleType("deepface")
+    modulo.DeepFace = DeepFaceSimulado
+    sys.modules["deepface"] = modulo
+    return DeepFaceSimulado
+
+
+def instalar_desde_entorno(ocupar_cpu=True):
+    """
+    Instala el modelo simulado si CELEBRIA_SIMULATED_MODEL=1, con la dimensión de
+    CELEBRIA_SIMULATED_DIM (2622) y la latencia de CELEBRIA_SIMULATED_LATENCY (0 s).
+
+    Lo usan los puntos de entrada (wsgi.py, asgi.py) y los procesos de inferencia
+    (inferencia.py), que no comparten sys.modules con quien los arranca.
+
+    :param ocupar_cpu: Consumir la latencia ocupando la CPU en lugar de dormir.
+    :return: True si se ha instalado.
+    """
+    if os.environ.get("CELEBRIA_SIMULATED_MODEL", "0") != "1":
+        return False
+    instalar_modelo_simulado(dim=int(os.environ.get("CELEBRIA_SIMULATED_DIM", "2622")),
+                             latencia=float(os.environ.get("CELEBRIA_SIMULATED_LATENCY", "0")),
+                             ocupar_cpu=ocupar_cpu)
+    return True
+
+
+def generar_cara_sintetica(semilla, lado=256):
+    """
+    Dibuja una cara sintética (óvalo, ojos y boca) con colores y proporciones aleatorias.
+
+    :param semilla: Semilla para que la misma cara se pueda regenerar.
+    :param lado: Tamaño en píxeles de la imagen cuadrada.
+    :return: Imagen BGR como array de NumPy.
+    """
+    rng = np.random.default_rng(semilla)
+    fondo = tuple(int(c) for c in rng.integers(0, 256, 3))
+    piel = tuple(int(c) for c in rng.integers(60, 256, 3))
+    img = np.full((lado, lado, 3), fondo, dtype=np.uint8)
+
+    centro = (lado // 2, lado // 2)
+    ejes = (int(lado * rng.uniform(0.25, 0.35)), int(lado * rng.uniform(0.32, 0.42)))
+    cv2.ellipse(img, centro, ejes, 0, 0, 360, piel, -1)
+
+    ojo_y = centro[1] - ejes[1] // 4
+    separacion = int(ejes[0] * rng.uniform(0.35, 0.55))
+    radio = max(2, lado // 30)
+    for dx in (-separacion, separacion):
+        cv2.circle(img, (centro[0] + dx, ojo_y), radio, (30, 30, 30), -1)
+
+    boca_y = centro[1] + ejes[1] // 2
+    cv2.ellipse(img, (centro[0], boca_y), (int(ejes[0] * 0.4), radio * 2), 0, 0, 180, (40, 40, 160), 2)
+    return img
+
+
+def generar_grupo_sintetico(semilla, caras, lado=256):
+    """
+    Dibuja una foto de grupo con varias caras sintéticas una al lado de otra.
+
+    :param semilla: Semilla de la primera cara; las demás usan las siguientes.
+    :param caras: Número de caras.
+    :param lado: Alto de la imagen y ancho de cada cara.
+    :return: Imagen BGR como array de NumPy.
+    """
+    return np.hstack([generar_cara_sintetica(semilla * 100 + i, lado) for i in range(caras)])
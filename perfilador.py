@@ -0,0 +1,268 @@
+"""
+Perfilado opcional de peticiones en producción.
+
+Con CELEBRIA_PROFILING=1 se puede perfilar una petición concreta enviando la
+cabecera `X-Profile: 1`, o una fracción aleatoria del tráfico con
+CELEBRIA_PROFILE_SAMPLE (por ejemplo 0.05 para el 5 %). Los últimos
+CELEBRIA_PROFILE_KEEP perfiles se guardan en un buffer circular y se descargan
+desde /admin/profiles sin reiniciar el servidor.
+
+Hay dos perfiladores (CELEBRIA_PROFILER):
+- "sampling" (por defecto): un hilo toma muestras de la pila del hilo de la
+  petición cada CELEBRIA_PROFILE_INTERVAL segundos. Coste muy bajo; se
+  descarga en formato speedscope.
+- "cprofile": cProfile determinista; más preciso pero más caro. Se descarga en
+  formato pstats (`python -m pstats perfil.pstats` o snakeviz).
+
+La cabecera X-Profile y los endpoints de administración exigen
+`X-Admin-Token` con el valor de CELEBRIA_ADMIN_TOKEN. Si no está definido, solo
+se aceptan desde la propia máquina (127.0.0.1 o ::1): los kioscos y los
+visitantes comparten la red del evento con el servidor.
+"""
+import cProfile
+import hmac
+import itertools
+import json
+import marshal
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+
+from flask import Response, abort, g, jsonify, request
+
+HABILITADO = os.environ.get("CELEBRIA_PROFILING", "0") == "1"
+MUESTREO = float(os.environ.get("CELEBRIA_PROFILE_SAMPLE", "0"))
+MAX_PERFILES = int(os.environ.get("CELEBRIA_PROFILE_KEEP", "20"))
+TIPO_PERFILADOR = os.environ.get("CELEBRIA_PROFILER", "sampling")
+INTERVALO_MUESTREO = float(os.environ.get("CELEBRIA_PROFILE_INTERVAL", "0.005"))
+TOKEN_ADMIN = os.environ.get("CELEBRIA_ADMIN_TOKEN")
+DIRECCIONES_LOCALES = ("127.0.0.1", "::1")
+
+_perfiles = deque(maxlen=MAX_PERFILES)
+_lock = threading.Lock()
+_ids = itertools.count(1)
+
+
+class PerfilCProfile:
+    """Perfil determinista con cProfile del hilo que lo inicia."""
+
+    tipo = "cprofile"
+
+    def __init__(self):
+        self._perfil = cProfile.Profile()
+
+    def iniciar(self):
+        # Solo puede haber un perfilador determinista activo a la vez (ValueError si ya lo hay)
+        self._perfil.enable()
+
+    def detener(self):
+        self._perfil.disable()
+        estadisticas = pstats.Stats(self._perfil)
+        funciones = sorted(estadisticas.stats.items(), key=lambda item: item[1][3], reverse=True)
+        resumen = [
+            {"function": pstats.func_std_string(func), "calls": datos[1],
+             "tottime_s": round(datos[2], 6), "cumtime_s": round(datos[3], 6)}
+            for func, datos in funciones[:15]
+        ]
+        return {"pstats": marshal.dumps(estadisticas.stats)}, resumen
+
+
+class PerfilMuestreo:
+    """Perfil por muestreo de la pila de un hilo desde un hilo auxiliar."""
+
+    tipo = "sampling"
+
+    def __init__(self, intervalo=INTERVALO_MUESTREO, hilo=None):
+        self.intervalo = intervalo
+        self.hilo_objetivo = hilo or threading.get_ident()
+        self.muestras = Counter()
+        self._parar = threading.Event()
+        self._hilo = None
+
+    def _muestrear(self):
+        while not self._parar.wait(self.intervalo):
+            frame = sys._current_frames().get(self.hilo_objetivo)
+            pila = []
+            while frame is not None:
+                codigo = frame.f_code
+                pila.append((codigo.co_name, codigo.co_filename, codigo.co_firstlineno))
+                frame = frame.f_back
+            if pila:
+                self.muestras[tuple(reversed(pila))] += 1
+
+    def iniciar(self):
+        self._hilo = threading.Thread(target=self._muestrear, daemon=True)
+        self._hilo.start()
+
+    def detener(self):
+        self._parar.set()
+        self._hilo.join()
+        propias = Counter()
+        for pila, cuenta in self.muestras.items():
+            propias[pila[-1]] += cuenta
+        resumen = [
+            {"function": f"{archivo}:{linea}({nombre})", "samples": cuenta,
+             "self_time_s": round(cuenta * self.intervalo, 6)}
+            for (nombre, archivo, linea), cuenta in propias.most_common(15)
+        ]
+        return {"stacks": dict(self.muestras), "interval": self.intervalo}, resumen
+
+
+def crear_perfil(hilo=None):
+    """
+    Crea un perfil del tipo configurado en CELEBRIA_PROFILER.
+
+    :param hilo: Identificador del hilo a muestrear (por defecto, el actual).
+    :return: Perfil sin iniciar.
+    """
+    if TIPO_PERFILADOR == "cprofile":
+        return PerfilCProfile()
+    return PerfilMuestreo(hilo=hilo)
+
+
+def iniciar_perfil(hilo=None):
+    """
+    Crea e inicia un perfil, o devuelve None si no se puede (otro cProfile activo).
+
+    :param hilo: Identificador del hilo a muestrear (por defecto, el actual).
+    :return: Perfil en marcha o None.
+    """
+    perfil = crear_perfil(hilo)
+    try:
+        perfil.iniciar()
+    except ValueError:
+        return None
+    perfil.inicio = time.time()
+    perfil.inicio_reloj = time.perf_counter()
+    return perfil
+
+
+def guardar_perfil(perfil, descripcion):
+    """
+    Detiene un perfil y lo guarda en el buffer circular.
+
+    :param perfil: Perfil devuelto por iniciar_perfil().
+    :param descripcion: Diccionario con método, ruta y endpoint perfilados.
+    :return: Identificador asignado al perfil.
+    """
+    duracion = time.perf_counter() - perfil.inicio_reloj
+    datos, resumen = perfil.detener()
+    registro = dict(descripcion)
+    registro.update({
+        "id": next(_ids),
+        "profiler": perfil.tipo,
+        "started": perfil.inicio,
+        "duration_s": round(duracion, 6),
+        "top": resumen,
+        "data": datos,
+    })
+    with _lock:
+        _perfiles.append(registro)
+    return registro["id"]
+
+
+def _buscar_perfil(id_perfil):
+    with _lock:
+        for registro in _perfiles:
+            if registro["id"] == id_perfil:
+                return registro
+    return None
+
+
+def _token_valido():
+    # Sin token configurado no se abre a la red: solo a quien esté en la propia máquina
+    if not TOKEN_ADMIN:
+        return request.remote_addr in DIRECCIONES_LOCALES
+    return hmac.compare_digest(request.headers.get("X-Admin-Token", ""), TOKEN_ADMIN)
+
+
+def exportar_speedscope(registro):
+    """
+    Convierte un perfil por muestreo al formato de archivo de speedscope.
+
+    :param registro: Perfil guardado en el buffer.
+    :return: Diccionario serializable a JSON.
+    """
+    marcos, indices = [], {}
+    muestras, pesos = [], []
+    for pila, cuenta in registro["data"]["stacks"].items():
+        fila = []
+        for marco in pila:
+            if marco not in indices:
+                indices[marco] = len(marcos)
+                marcos.append({"name": marco[0], "file": marco[1], "line": marco[2]})
+            fila.append(indices[marco])
+        muestras.append(fila)
+        pesos.append(cuenta * registro["data"]["interval"])
+    nombre = f"{registro['method']} {registro['path']} #{registro['id']}"
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "shared": {"frames": marcos},
+        "profiles": [{
+            "type": "sampled", "name": nombre, "unit": "seconds",
+            "startValue": 0, "endValue": sum(pesos),
+            "samples": muestras, "weights": pesos,
+        }],
+        "name": nombre,
+        "exporter": "celebria-perfilador",
+    }
+
+
+def instalar_perfilador(app):
+    """
+    Registra en la aplicación Flask los hooks de perfilado y los endpoints /admin/profiles.
+
+    :param app: Aplicación Flask.
+    """
+    if not HABILITADO:
+        return
+
+    @app.before_request
+    def _iniciar_perfil_peticion():
+        if request.path.startswith('/admin/'):
+            return
+        solicitado = request.headers.get("X-Profile") == "1" and _token_valido()
+        if solicitado or (MUESTREO > 0 and random.random() < MUESTREO):
+            g.perfil = iniciar_perfil()
+
+    @app.teardown_request
+    def _guardar_perfil_peticion(exc):
+        perfil = g.pop('perfil', None)
+        if perfil is not None:
+            guardar_perfil(perfil, {"method": request.method, "path": request.path,
+                                    "endpoint": request.endpoint})
+
+    @app.route('/admin/profiles')
+    def list_profiles():
+        """List the profiles kept in the ring buffer"""
+        if not _token_valido():
+            abort(403)
+        with _lock:
+            registros = [{k: v for k, v in r.items() if k != "data"} for r in _perfiles]
+        return jsonify({"profiles": list(reversed(registros))})
+
+    @app.route('/admin/profiles/<int:profile_id>.pstats')
+    def download_pstats(profile_id):
+        """Download a cProfile profile in pstats format"""
+        if not _token_valido():
+            abort(403)
+        registro = _buscar_perfil(profile_id)
+        if registro is None or "pstats" not in registro["data"]:
+            abort(404)
+        return Response(registro["data"]["pstats"], mimetype='application/octet-stream',
+                        headers={"Content-Disposition": f"attachment; filename=profile-{profile_id}.pstats"})
+
+    @app.route('/admin/profiles/<int:profile_id>.speedscope.json')
+    def download_speedscope(profile_id):
+        """Download a sampling profile in speedscope format"""
+        if not _token_valido():
+            abort(403)
+        registro = _buscar_perfil(profile_id)
+        if registro is None or "stacks" not in registro["data"]:
+            abort(404)
+        return Response(json.dumps(exportar_speedscope(registro)), mimetype='application/json',
+                        headers={"Content-Disposition": f"attachment; filename=profile-{profile_id}.speedscope.json"})
@@ -0,0 +1,178 @@
+"""
+Reparto justo del trabajo de inferencia entre photocalls y tamaños de grupo.
+
+Sin planificador, cada captura ocupa la CPU en el orden en que llega: una foto
+de grupo con 10 caras encadena 10 embeddings y búsquedas, y las capturas de una
+sola cara que llegan detrás esperan a todas. Un photocall con mucho tráfico
+puede además dejar sin turno a los demás.
+
+El planificador reparte turnos de unidades de trabajo: la detección de una
+captura y el embedding y la búsqueda de cada una de sus caras. Como mucho
+CELEBRIA_SCHEDULER_SLOTS unidades se ejecutan a la vez en cada proceso; las
+demás esperan y se atienden por orden de llegada justa (start-time fair
+queuing) entre orígenes:
+
+- El origen es el photocall (el navegador del kiosco envía un id propio con la
+  foto) o, si no lo envía, el trabajo.
+- Cada origen lleva la cuenta de las unidades que ha consumido. Una unidad nueva
+  se pone en la cola detrás de las anteriores de su origen, pero nunca antes del
+  punto por el que va la cola. Así una foto de grupo cuesta tantos turnos como
+  caras tiene y una captura de una sola cara que llega después se cuela entre
+  sus caras en lugar de esperar a todas, y un origen que ha estado parado no
+  acumula turnos para después.
+- Un origen no puede tener más de CELEBRIA_SCHEDULER_SOURCE_CAP unidades a la
+  vez (la mitad de las plazas por defecto), aunque sus unidades sean las
+  siguientes de la cola.
+
+Con CELEBRIA_SCHEDULER_SLOTS=0 (por defecto) no se limita nada en la variante
+WSGI: cada hilo de gunicorn procesa su captura en cuanto puede, como antes. La
+variante ASGI usa CELEBRIA_INFERENCE_WORKERS plazas (ver asgi.py). Con
+CELEBRIA_METRICS=1, /metrics incluye la espera de cada unidad (etapa
+scheduler_wait) y las unidades que esperan turno (celebria_scheduler_waiting).
+"""
+import heapq
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import metricas
+
+PLAZAS = int(os.environ.get("CELEBRIA_SCHEDULER_SLOTS", "0"))
+MAX_POR_ORIGEN = int(os.environ.get("CELEBRIA_SCHEDULER_SOURCE_CAP", "0"))
+# Segundos entre llamadas a al_esperar mientras una unidad espera turno
+INTERVALO_ESPERA = 0.25
+# Orígenes recordados antes de olvidar los que ya no tienen unidades por delante
+MAX_ORIGENES = 256
+
+
+class _Espera:
+    """Una unidad en la cola, con el evento que se activa al darle turno."""
+
+    __slots__ = ("origen", "concedida", "retirada", "evento")
+
+    def __init__(self, origen):
+        self.origen = origen
+        self.concedida = False
+        self.retirada = False
+        self.evento = threading.Event()
+
+
+class Planificador:
+    """Plazas de trabajo de inferencia de este proceso y cola justa de las unidades que esperan."""
+
+    def __init__(self, plazas=PLAZAS, max_por_origen=MAX_POR_ORIGEN):
+        """
+        :param plazas: Unidades que se ejecutan a la vez (0 para no limitar).
+        :param max_por_origen: Unidades a la vez de un mismo origen (0 para la mitad de las plazas).
+        """
+        self.plazas = plazas
+        self.max_por_origen = max_por_origen
+        self._virtual = 0.0
+        self._fin = {}
+        self._en_curso = {}
+        self._ocupadas = 0
+        self._cola = []
+        self._secuencia = itertools.count()
+        self._lock = threading.Lock()
+
+    def configurar(self, plazas, max_por_origen=None):
+        """
+        Cambia el número de plazas (asgi.py lo iguala a sus hilos de inferencia).
+
+        :param plazas: Unidades que se ejecutan a la vez (0 para no limitar).
+        :param max_por_origen: Unidades a la vez de un mismo origen, o None para no cambiarlo.
+        """
+        with self._lock:
+            self.plazas = plazas
+            if max_por_origen is not None:
+                self.max_por_origen = max_por_origen
+            self._despachar()
+
+    @contextmanager
+    def turno(self, origen, coste=1.0, al_esperar=None):
+        """
+        Espera turno para una unidad de trabajo y lo devuelve al terminar.
+
+        :param origen: Photocall o trabajo que pide el turno.
+        :param coste: Coste estimado de la unidad (1 por cara).
+        :param al_esperar: Función que se llama cada INTERVALO_ESPERA segundos mientras se espera; si lanza
+                           una excepción, la unidad sale de la cola y la excepción se propaga.
+        :return: Context manager que se ejecuta con el turno concedido.
+        """
+        if self.plazas <= 0:
+            yield
+            return
+        espera = self._pedir(origen, coste)
+        if not espera.concedida:
+            inicio = time.perf_counter()
+            metricas.ajustar("scheduler_waiting", 1)
+            try:
+                while not espera.evento.wait(INTERVALO_ESPERA):
+                    if al_esperar is not None:
+                        al_esperar()
+            except BaseException:
+                self._retirar(espera)
+                raise
+            finally:
+                metricas.ajustar("scheduler_waiting", -1)
+            metricas.observar("scheduler_wait", time.perf_counter() - inicio)
+        try:
+            yield
+        finally:
+            self._liberar(origen)
+
+    def _limite_origen(self):
+        return self.max_por_origen if self.max_por_origen > 0 else max(1, self.plazas // 2)
+
+    def _pedir(self, origen, coste):
+        espera = _Espera(origen)
+        with self._lock:
+            # Detrás de las unidades anteriores del origen, pero no antes del punto por el que va la cola
+            inicio = max(self._virtual, self._fin.get(origen, 0.0))
+            self._fin[origen] = inicio + coste
+            heapq.heappush(self._cola, (inicio, next(self._secuencia), espera))
+            self._despachar()
+        return espera
+
+    def _retirar(self, espera):
+        with self._lock:
+            if not espera.concedida:
+                # Se queda en el montículo y _despachar la descarta al llegar a ella
+                espera.retirada = True
+                return
+        # El turno llegó mientras se cancelaba: devolverlo
+        self._liberar(espera.origen)
+
+    def _liberar(self, origen):
+        with self._lock:
+            self._ocupadas -= 1
+            self._en_curso[origen] -= 1
+            if not self._en_curso[origen]:
+                del self._en_curso[origen]
+            if len(self._fin) > MAX_ORIGENES:
+                self._fin = {o: f for o, f in self._fin.items() if f > self._virtual or o in self._en_curso}
+            self._despachar()
+
+    def _despachar(self):
+        # Con el lock tomado: conceder plazas libres a las primeras unidades cuyo origen no está en su límite
+        limite = self._limite_origen()
+        apartadas = []
+        while self._cola and self._ocupadas < self.plazas:
+            inicio, secuencia, espera = heapq.heappop(self._cola)
+            if espera.retirada:
+                continue
+            if self._en_curso.get(espera.origen, 0) >= limite:
+                apartadas.append((inicio, secuencia, espera))
+                continue
+            self._virtual = max(self._virtual, inicio)
+            self._ocupadas += 1
+            self._en_curso[espera.origen] = self._en_curso.get(espera.origen, 0) + 1
+            espera.concedida = True
+            espera.evento.set()
+        for entrada in apartadas:
+            heapq.heappush(self._cola, entrada)
+
+
+planificador = Planificador()
@@ -2,7 +2,6 @@ import cv2
 import numpy as np
 import os
 import json
-from deepface import DeepFace
 
 # Constants for paths
 FOLDER_PATH = "imagenes"  
@@ -158,6 +157,8 @@ def main():
 
             print(f"⚙ Calculating embedding for: {cropped_filename}...")
             try:
+                # Imported on first use so that importing this module does not load TensorFlow
+                from deepface import DeepFace
                 embedding = DeepFace.represent(
                     img_path=cropped_path, model_name="Facenet", enforce_detection=False
                 )[0]["embedding"]
@@ -0,0 +1,310 @@
+"""
+Prueba de carga que reproduce el flujo completo de un visitante del photocall.
+
+Cada visitante simulado recorre la misma secuencia que el navegador:
+/clear_data -> /process_image -> /process_status (repetido) -> /resultado ->
+/get_results -> imágenes de /personas y /face-db. Todos los visitantes se
+ejecutan a la vez sobre asyncio y al final se informa del rendimiento, de los
+percentiles de latencia por endpoint y de las tasas de error y de corrupción
+(resultados que pertenecen a otro visitante).
+
+Cada visitante hace de un photocall distinto (envía su propio id de kiosco).
+Con --group_every K, uno de cada K visitantes envía una foto de grupo de
+--group_faces caras, y su latencia se informa aparte en "/process_image (group)"
+para ver si las capturas de una cara siguen saliendo rápido (planificador.py).
+
+Ejemplos:
+    python prueba_carga.py --local imdb --visitors 20
+    python prueba_carga.py --url http://localhost:5000 --visitors 10 --rounds 3
+    python prueba_carga.py --local imdb --visitors 12 --group_every 4 --group_faces 8
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+import cv2
+import numpy as np
+
+from modelo_simulado import generar_cara_sintetica, generar_grupo_sintetico, instalar_modelo_simulado
+
+# Diferencia media máxima (0-255) entre la foto enviada y la devuelta para considerarlas la misma
+UMBRAL_MISMA_FOTO = 25.0
+
+
+class ClienteHTTP:
+    """
+    Cliente HTTP/1.0 mínimo sobre asyncio con su propio almacén de cookies,
+    de forma que cada visitante simulado tenga su propia sesión.
+    """
+
+    def __init__(self, host, puerto, estadisticas):
+        self.host = host
+        self.puerto = puerto
+        self.cookies = {}
+        self.estadisticas = estadisticas
+
+    async def peticion(self, metodo, ruta, cuerpo=None, endpoint=None):
+        """
+        Envía una petición y registra su latencia.
+
+        :param metodo: Método HTTP.
+        :param ruta: Ruta (con query string si hace falta).
+        :param cuerpo: Objeto serializable a JSON para el cuerpo, o None.
+        :param endpoint: Nombre con el que se agrupa la latencia en el informe.
+        :return: Tupla (código de estado, cuerpo en bytes).
+        """
+        datos = json.dumps(cuerpo).encode() if cuerpo is not None else b""
+        cabeceras = [f"{metodo} {ruta} HTTP/1.0", f"Host: {self.host}:{self.puerto}"]
+        if self.cookies:
+            cabeceras.append("Cookie: " + "; ".join(f"{k}={v}" for k, v in self.cookies.items()))
+        if cuerpo is not None:
+            cabeceras.append("Content-Type: application/json")
+        cabeceras.append(f"Content-Length: {len(datos)}")
+
+        inicio = time.perf_counter()
+        try:
+            lector, escritor = await asyncio.open_connection(self.host, self.puerto)
+            escritor.write(("\r\n".join(cabeceras) + "\r\n\r\n").encode() + datos)
+            await escritor.drain()
+            respuesta = await lector.read()
+            escritor.close()
+        except OSError:
+            self.estadisticas.registrar(endpoint or ruta, time.perf_counter() - inicio, 0)
+            raise
+
+        cabecera, _, contenido = respuesta.partition(b"\r\n\r\n")
+        lineas = cabecera.decode("latin-1").split("\r\n")
+        estado = int(lineas[0].split()[1])
+        for linea in lineas[1:]:
+            nombre, _, valor = linea.partition(":")
+            if nombre.lower() == "set-cookie":
+                clave, _, resto = valor.strip().partition("=")
+                self.cookies[clave] = resto.split(";")[0]
+
+        self.estadisticas.registrar(endpoint or ruta, time.perf_counter() - inicio, estado)
+        return estado, contenido
+
+
+class Estadisticas:
+    """Acumula latencias por endpoint y contadores de errores del conjunto de visitantes."""
+
+    def __init__(self):
+        self.latencias = defaultdict(list)
+        self.errores_http = defaultdict(int)
+        self.visitantes_ok = 0
+        self.visitantes_error = 0
+        self.corrupciones = 0
+        self.motivos_error = defaultdict(int)
+        # Nivel de calidad (calidad.py) con el que se sirvió cada cara
+        self.niveles = defaultdict(int)
+
+    def registrar(self, endpoint, duracion, estado):
+        self.latencias[endpoint].append(duracion)
+        if estado == 0 or estado >= 400:
+            self.errores_http[endpoint] += 1
+
+    def fallo(self, motivo):
+        self.visitantes_error += 1
+        self.motivos_error[motivo] += 1
+
+    def informe(self, duracion_total):
+        peticiones = sum(len(v) for v in self.latencias.values())
+        visitantes = self.visitantes_ok + self.visitantes_error
+        endpoints = {}
+        for endpoint, tiempos in sorted(self.latencias.items()):
+            ms = np.array(tiempos) * 1000
+            endpoints[endpoint] = {
+                "count": len(tiempos),
+                "errors": self.errores_http.get(endpoint, 0),
+                "p50_ms": round(float(np.percentile(ms, 50)), 2),
+                "p95_ms": round(float(np.percentile(ms, 95)), 2),
+                "p99_ms": round(float(np.percentile(ms, 99)), 2),
+            }
+        return {
+            "duration_s": round(duracion_total, 3),
+            "visitors": visitantes,
+            "visitors_per_s": round(visitantes / duracion_total, 3) if duracion_total else 0.0,
+            "requests": peticiones,
+            "requests_per_s": round(peticiones / duracion_total, 3) if duracion_total else 0.0,
+            "error_rate": round(self.visitantes_error / visitantes, 4) if visitantes else 0.0,
+            "corruption_rate": round(self.corrupciones / visitantes, 4) if visitantes else 0.0,
+            "error_reasons": dict(self.motivos_error),
+            "qos_tiers": dict(self.niveles),
+            "endpoints": endpoints,
+        }
+
+
+def _misma_foto(enviada, recibida_bytes):
+    """
+    Comprueba si una imagen devuelta por el servidor corresponde a la foto enviada.
+
+    :param enviada: Imagen BGR enviada por el visitante.
+    :param recibida_bytes: Bytes de la imagen servida.
+    :return: True si ambas imágenes son la misma foto (salvo recompresión JPEG).
+    """
+    recibida = cv2.imdecode(np.frombuffer(recibida_bytes, np.uint8), cv2.IMREAD_COLOR)
+    if recibida is None:
+        return False
+    a = cv2.resize(enviada, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    b = cv2.resize(recibida, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    return float(np.abs(a - b).mean()) < UMBRAL_MISMA_FOTO
+
+
+async def visitante(numero, ronda, host, puerto, estadisticas, args):
+    """
+    Simula a un visitante recorriendo el flujo completo de la aplicación.
+
+    :param numero: Número del visitante (determina su foto).
+    :param ronda: Ronda actual, para que cada repetición use una foto distinta.
+    :param host: Host del servidor.
+    :param puerto: Puerto del servidor.
+    :param estadisticas: Acumulador compartido de resultados.
+    :param args: Argumentos de línea de comandos.
+    """
+    cliente = ClienteHTTP(host, puerto, estadisticas)
+    grupo = args.group_every > 0 and numero % args.group_every == 0
+    foto = generar_grupo_sintetico(numero * 1000 + ronda, args.group_faces, 480) if grupo else \
+        generar_cara_sintetica(numero * 1000 + ronda, 480)
+    data_url = "data:image/jpeg;base64," + base64.b64encode(cv2.imencode('.jpg', foto)[1].tobytes()).decode()
+
+    try:
+        await cliente.peticion("POST", "/clear_data", endpoint="/clear_data")
+
+        # Como index.js: se envía la foto y se consulta el estado sin esperar la respuesta
+        envio = asyncio.create_task(cliente.peticion(
+            "POST", "/process_image", {"image": data_url, "gender": None, "kiosk": f"kiosco-{numero}"},
+            endpoint="/process_image (group)" if grupo else "/process_image"))
+
+        limite = time.monotonic() + args.timeout
+        estado_final = None
+        while time.monotonic() < limite:
+            await asyncio.sleep(args.poll_interval)
+            _, contenido = await cliente.peticion("GET", "/process_status", endpoint="/process_status")
+            estado_final = json.loads(contenido).get("status")
+            if estado_final in ("complete", "error", "cancelled"):
+                break
+        await envio
+
+        if estado_final != "complete":
+            estadisticas.fallo(f"status_{estado_final or 'timeout'}")
+            return
+
+        await cliente.peticion("GET", "/resultado", endpoint="/resultado")
+        _, contenido = await cliente.peticion("GET", "/get_results", endpoint="/get_results")
+        resultados = json.loads(contenido).get("results", [])
+        if not resultados:
+            estadisticas.fallo("no_results")
+            return
+
+        # La foto original devuelta debe ser la de este visitante
+        corrupto = False
+        for resultado in resultados:
+            estadisticas.niveles[resultado.get("qos_tier", "unknown")] += 1
+            estado, imagen = await cliente.peticion("GET", "/" + resultado["persona"], endpoint="/personas")
+            if estado != 200 or not _misma_foto(foto, imagen):
+                corrupto = True
+            await cliente.peticion("GET", "/" + resultado["cara_detectada"], endpoint="/personas")
+            for match in resultado.get("matches", []):
+                await cliente.peticion("GET", "/" + match["image_data"], endpoint="/face-db")
+
+        if corrupto:
+            estadisticas.corrupciones += 1
+            estadisticas.fallo("wrong_visitor")
+        else:
+            estadisticas.visitantes_ok += 1
+
+    except (OSError, ValueError, KeyError) as e:
+        estadisticas.fallo(type(e).__name__)
+
+
+async def ejecutar(host, puerto, args):
+    """
+    Lanza todos los visitantes concurrentes y espera a que terminen.
+
+    :return: Informe con rendimiento, latencias y tasas de error.
+    """
+    estadisticas = Estadisticas()
+
+    async def recorrido(numero):
+        await asyncio.sleep(args.ramp * numero / max(1, args.visitors))
+        for ronda in range(args.rounds):
+            await visitante(numero, ronda, host, puerto, estadisticas, args)
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*(recorrido(i) for i in range(args.visitors)))
+    return estadisticas.informe(time.perf_counter() - inicio)
+
+
+def arrancar_servidor_local(backend, filas, dim, latencia):
+    """
+    Arranca un backend con el modelo simulado en un hilo, sobre un directorio temporal.
+
+    :param backend: Backend a probar ("app" o "imdb").
+    :param filas: Tamaño de la base sintética de famosos.
+    :param dim: Dimensión de los embeddings simulados.
+    :param latencia: Segundos de inferencia simulada por llamada al modelo.
+    :return: Tupla (host, puerto).
+    """
+    from werkzeug.serving import make_server
+    from benchmark import generar_embeddings, generar_dataframe, escribir_imagenes_sinteticas
+    from backends import cargar_backend
+
+    instalar_modelo_simulado(dim=dim, latencia=latencia)
+    os.chdir(tempfile.mkdtemp(prefix="celebria-carga-"))
+    if backend == "imdb":
+        matriz, identidades = generar_embeddings(filas, dim)
+        df = generar_dataframe(matriz, identidades)
+        df.to_pickle("representations.pkl")
+        escribir_imagenes_sinteticas(df, "imdb_data_set")
+
+    servidor = make_server("127.0.0.1", 0, cargar_backend(backend).app, threaded=True)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return "127.0.0.1", servidor.server_port
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay the full booth flow with N concurrent visitors")
+    parser.add_argument("--url", type=str, help="Base URL of a running backend (e.g. http://localhost:5000)")
+    parser.add_argument("--local", choices=["app", "imdb"],
+                        help="Start this backend in-process with a stubbed model instead of using --url")
+    parser.add_argument("--visitors", type=int, default=10, help="Concurrent visitors (default: 10)")
+    parser.add_argument("--rounds", type=int, default=1, help="Captures per visitor (default: 1)")
+    parser.add_argument("--ramp", type=float, default=0.0, help="Seconds over which visitors start (default: 0)")
+    parser.add_argument("--poll_interval", type=float, default=1.0,
+                        help="Seconds between /process_status polls, as in carga.js (default: 1.0)")
+    parser.add_argument("--timeout", type=float, default=120.0,
+                        help="Seconds before a visitor gives up, as MAX_WAIT_TIME in carga.js (default: 120)")
+    parser.add_argument("--group_every", type=int, default=0,
+                        help="Every Kth visitor sends a group photo (default: 0, none)")
+    parser.add_argument("--group_faces", type=int, default=8, help="Faces in each group photo (default: 8)")
+    parser.add_argument("--rows", type=int, default=2000, help="Synthetic database size with --local (default: 2000)")
+    parser.add_argument("--dim", type=int, default=2622, help="Stubbed embedding dimension with --local (default: 2622)")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="Simulated inference seconds per model call with --local (default: 0.05)")
+    parser.add_argument("--output", type=str, help="Optional path of a JSON report")
+    args = parser.parse_args()
+
+    # El modo local cambia de directorio de trabajo, así que la ruta del informe se resuelve antes
+    salida = os.path.abspath(args.output) if args.output else None
+
+    if args.local:
+        host, puerto = arrancar_servidor_local(args.local, args.rows, args.dim, args.latency)
+    elif args.url:
+        destino = urlsplit(args.url)
+        host, puerto = destino.hostname, destino.port or 80
+    else:
+        parser.error("Use --url to target a running backend or --local to start one")
+
+    informe = asyncio.run(ejecutar(host, puerto, args))
+    print(json.dumps(informe, indent=2))
+    if salida:
+        with open(salida, "w") as f:
+            json.dump(informe, f, indent=4)
+        print(f"Report saved to {salida}")
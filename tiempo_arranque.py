@@ -0,0 +1,146 @@
+"""
+Presupuesto de tiempo de arranque de los puntos de entrada.
+
+    python tiempo_arranque.py              # comprueba todos los puntos de entrada
+    python tiempo_arranque.py --top 15     # muestra los 15 módulos que más tardan en cada uno
+    python tiempo_arranque.py --json arranque.json
+
+Cada punto de entrada se ejecuta en un proceso nuevo con `python -X importtime`,
+que escribe en stderr el tiempo acumulado de importación de cada módulo. Un
+punto de entrada falla si:
+- el tiempo total de importación supera su presupuesto (PRESUPUESTOS_MS;
+  CELEBRIA_IMPORT_BUDGET_SCALE los multiplica en máquinas lentas), o
+- importa al arrancar alguna dependencia pesada de PROHIBIDOS (TensorFlow,
+  DeepFace, scikit-learn, matplotlib...), que debe cargarse en su primer uso.
+
+Termina con código 1 si algún punto de entrada falla, para usarlo en CI o antes
+de desplegar.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+
+# Nombre -> (argumentos de python, presupuesto en milisegundos)
+PRESUPUESTOS_MS = {
+    "celebrity2 --help": ([os.path.join(DIRECTORIO, "imdb-wiki", "celebrity2.py"), "--help"], 500),
+    "backend imdb": (["-c", "from backends import cargar_backend; cargar_backend('imdb')"], 1500),
+    "backend app": (["-c", "from backends import cargar_backend; cargar_backend('app')"], 1500),
+    "asgi": (["-c", "import asgi"], 2000),
+    "detectores": (["-c", "import detectores"], 800),
+}
+
+# Paquetes que ningún punto de entrada debe importar al arrancar
+PROHIBIDOS = ("tensorflow", "keras", "tf_keras", "deepface", "sklearn", "matplotlib", "torch",
+              "onnxruntime", "retinaface", "mtcnn", "tf2onnx")
+
+
+def analizar_importtime(salida):
+    """
+    Interpreta la salida de `python -X importtime`.
+
+    :param salida: Texto de stderr del proceso.
+    :return: Lista de tuplas (módulo, nivel de anidamiento, tiempo propio en µs, tiempo acumulado en µs).
+    """
+    modulos = []
+    for linea in salida.splitlines():
+        if not linea.startswith("import time:") or "imported package" in linea:
+            continue
+        try:
+            propio, acumulado, nombre = linea[len("import time:"):].split("|", 2)
+            propio, acumulado = int(propio), int(acumulado)
+        except ValueError:
+            continue
+        # Cada nivel de anidamiento añade dos espacios delante del nombre
+        nivel = (len(nombre) - len(nombre.lstrip(" ")) - 1) // 2
+        modulos.append((nombre.strip(), nivel, propio, acumulado))
+    return modulos
+
+
+def medir(nombre, argumentos, presupuesto_ms, top=10):
+    """
+    Mide un punto de entrada en un proceso nuevo y lo compara con su presupuesto.
+
+    :param nombre: Nombre del punto de entrada.
+    :param argumentos: Argumentos para el intérprete de Python.
+    :param presupuesto_ms: Tiempo máximo de importación en milisegundos.
+    :param top: Número de módulos de primer nivel más lentos a incluir en el informe.
+    :return: Diccionario con el resultado.
+    """
+    entorno = dict(os.environ)
+    entorno["PYTHONPATH"] = os.pathsep.join(filter(None, [DIRECTORIO, os.path.join(DIRECTORIO, "imdb-wiki"),
+                                                          entorno.get("PYTHONPATH")]))
+    # Los backends crean carpetas y buscan el índice en el directorio actual: se ejecutan en uno vacío
+    with tempfile.TemporaryDirectory(prefix="celebria-arranque-") as tmp:
+        inicio = time.perf_counter()
+        proceso = subprocess.run([sys.executable, "-X", "importtime", *argumentos], cwd=tmp, env=entorno,
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        pared = time.perf_counter() - inicio
+
+    modulos = analizar_importtime(proceso.stderr)
+    total_ms = sum(acumulado for _, nivel, _, acumulado in modulos if nivel == 0) / 1000
+    prohibidos = sorted({m for m, _, _, _ in modulos if m.split(".")[0] in PROHIBIDOS})
+    lentos = sorted((m for m in modulos if m[1] == 0), key=lambda m: m[3], reverse=True)[:top]
+
+    resultado = {
+        "entry_point": nombre,
+        "import_ms": round(total_ms, 1),
+        "budget_ms": round(presupuesto_ms, 1),
+        "wall_ms": round(pared * 1000, 1),
+        "modules": len(modulos),
+        "forbidden_imports": prohibidos,
+        "slowest": [{"module": m, "cumulative_ms": round(acumulado / 1000, 1)} for m, _, _, acumulado in lentos],
+        "exit_code": proceso.returncode,
+    }
+    errores = []
+    if proceso.returncode != 0:
+        errores.append(f"exited with code {proceso.returncode}: {proceso.stderr.strip().splitlines()[-1]}")
+    if total_ms > presupuesto_ms:
+        errores.append(f"imports took {total_ms:.0f} ms (budget {presupuesto_ms:.0f} ms)")
+    if prohibidos:
+        errores.append(f"heavy modules imported at startup: {', '.join(prohibidos)}")
+    resultado["errors"] = errores
+    resultado["passed"] = not errores
+    return resultado
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the import-time budget of the entry points")
+    parser.add_argument("entry_points", nargs="*",
+                        help=f"Entry points to check (default: all of {', '.join(PRESUPUESTOS_MS)})")
+    parser.add_argument("--top", type=int, default=10,
+                        help="Number of slowest top-level imports to show (default: 10)")
+    parser.add_argument("--json", type=str,
+                        help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    escala = float(os.environ.get("CELEBRIA_IMPORT_BUDGET_SCALE", "1"))
+    nombres = args.entry_points or list(PRESUPUESTOS_MS)
+    desconocidos = [n for n in nombres if n not in PRESUPUESTOS_MS]
+    if desconocidos:
+        parser.error(f"Unknown entry points: {', '.join(desconocidos)}")
+
+    resultados = []
+    for nombre in nombres:
+        argumentos, presupuesto = PRESUPUESTOS_MS[nombre]
+        resultado = medir(nombre, argumentos, presupuesto * escala, args.top)
+        resultados.append(resultado)
+        estado = "OK  " if resultado["passed"] else "FAIL"
+        print(f"{estado} {nombre}: {resultado['import_ms']:.0f} ms of imports "
+              f"(budget {resultado['budget_ms']:.0f} ms, {resultado['wall_ms']:.0f} ms wall)")
+        for lento in resultado["slowest"]:
+            print(f"       {lento['cumulative_ms']:>8.1f} ms  {lento['module']}")
+        for error in resultado["errors"]:
+            print(f"     ! {error}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(resultados, f, indent=4)
+        print(f"Results saved to {args.json}")
+
+    sys.exit(0 if all(r["passed"] for r in resultados) else 1)
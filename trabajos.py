@@ -0,0 +1,490 @@
+"""
+Estado de cada captura (trabajo) del fotomatón.
+
+Cada navegador tiene un trabajo, identificado por la cookie `celebria_trabajo`,
+con su propia carpeta personas/<id>/ para la foto, los recortes de las caras y
+el estado. Así dos visitantes simultáneos no se pisan los resultados.
+
+Un trabajo pasa por estos estados:
+
+    esperando -> detectando -> buscando -> completo
+                     |             |
+                     +-------------+-----> error
+                     |             |
+                     +-------------+-----> cancelado
+
+y cualquier estado puede volver a "detectando" cuando llega una captura nueva.
+El estado y los resultados viven en memoria, por lo que /process_status y
+/get_results no tienen que listar ni leer archivos. Cada cambio de estado se
+escribe también en personas/<id>/estado.json: si gunicorn tiene varios workers
+y el sondeo llega a otro, este solo necesita un stat() para ver que el estado
+cambió.
+
+Cada cara guarda además la lista ordenada de los CELEBRIA_RANKED_RESULTS
+famosos más parecidos (50 por defecto) que devolvió su única búsqueda. Los
+resultados solo llevan los 3 primeros; el resto se pide por páginas a
+/more_results/<n> con un cursor, sin volver a calcular el embedding ni a
+recorrer el índice. La lista se escribe en personas/<id>/candidatos.json y los
+demás workers solo la leen si alguien les pide una página.
+
+Una captura en curso se cancela si el visitante la abandona: carga.js llama a
+/cancel_processing al agotar su espera o al salir de la página, volver a la
+portada limpia el trabajo (/clear_data) y, si carga.js deja de consultar
+/process_status durante CELEBRIA_ABANDON_S segundos (30 por defecto, 0 para no
+comprobarlo), se da por abandonada. El pipeline llama a comprobar_cancelacion()
+entre etapas y entre caras; esta lanza CapturaCancelada y el worker queda libre
+sin terminar el resto. Como varios workers pueden atender al mismo navegador,
+la cancelación y el último sondeo son archivos en la carpeta del trabajo.
+
+Limpiar un trabajo es O(1): se quita del registro y su carpeta se renombra; un
+hilo en segundo plano la borra después, junto con los trabajos abandonados
+durante más de CELEBRIA_JOB_TTL segundos (30 minutos por defecto).
+"""
+import json
+import os
+import queue
+import re
+import secrets
+import shutil
+import threading
+import time
+
+from flask import g, request
+
+import metricas
+
+COOKIE = "celebria_trabajo"
+CARPETA = "personas"
+TTL = float(os.environ.get("CELEBRIA_JOB_TTL", str(30 * 60)))
+INTERVALO_BARRIDO = 60.0
+MAX_CANDIDATOS = int(os.environ.get("CELEBRIA_RANKED_RESULTS", "50"))
+MAX_PAGINA = 12
+ABANDONO = float(os.environ.get("CELEBRIA_ABANDON_S", "30"))
+# Segundos entre comprobaciones de cancelación mientras una captura espera a otro hilo
+INTERVALO_CANCELACION = 0.25
+
+# Estado interno -> (status que espera carga.js, mensaje por defecto)
+ESTADOS = {
+    "esperando": ("waiting", "Esperando imagen..."),
+    "detectando": ("processing", "Detectando rostros en la imagen..."),
+    "buscando": ("processing", "Buscando coincidencias con famosos..."),
+    "completo": ("complete", "¡Coincidencias encontradas! Redirigiendo..."),
+    "error": ("error", "Error en el procesamiento"),
+    "cancelado": ("cancelled", "Procesamiento cancelado"),
+}
+
+TRANSICIONES = {
+    "esperando": {"detectando", "error"},
+    "detectando": {"detectando", "buscando", "error", "cancelado"},
+    "buscando": {"detectando", "completo", "error", "cancelado"},
+    "completo": {"detectando", "error"},
+    "error": {"detectando", "error"},
+    "cancelado": {"detectando", "error"},
+}
+
+_ID_VALIDO = re.compile(r"^[0-9a-f]{16}$")
+
+
+class CapturaCancelada(Exception):
+    """La captura se canceló mientras se procesaba; el resto del pipeline no debe ejecutarse."""
+
+    def __init__(self, motivo, etapa, caras_pendientes=0):
+        """
+        :param motivo: "client" (lo pidió el navegador), "cleared" (se limpió el trabajo) o "abandoned".
+        :param etapa: Etapa del pipeline que ya no se ejecuta.
+        :param caras_pendientes: Caras que se quedan sin embedding ni búsqueda.
+        """
+        super().__init__(f"Capture cancelled ({motivo}) before {etapa}")
+        self.motivo = motivo
+        self.etapa = etapa
+        self.caras_pendientes = caras_pendientes
+
+
+class Trabajo:
+    """Una captura en curso o terminada, con su carpeta y sus resultados."""
+
+    def __init__(self, id_trabajo, carpeta=CARPETA):
+        self.id = id_trabajo
+        self.directorio = f"{carpeta}/{id_trabajo}"
+        self.estado = "esperando"
+        self.mensaje = None
+        self.resultados = []
+        self.candidatos = []
+        self.captura = None
+        self.actualizado = time.time()
+        self.descartado = False
+        self._version = None
+        self._lock = threading.Lock()
+
+    def ruta(self, nombre):
+        """
+        Ruta de un archivo dentro de la carpeta del trabajo, tal como la pide el navegador.
+
+        :param nombre: Nombre del archivo.
+        :return: Ruta relativa con barras '/'.
+        """
+        return f"{self.directorio}/{nombre}"
+
+    def cambiar_estado(self, estado, mensaje=None, resultados=None, candidatos=None):
+        """
+        Pasa el trabajo a otro estado y lo guarda en estado.json.
+
+        :param estado: Uno de ESTADOS.
+        :param mensaje: Mensaje para la pantalla de carga (por defecto, el del estado).
+        :param resultados: Resultados de cada cara al pasar a "completo".
+        :param candidatos: Lista ordenada de famosos de cada cara (se guardan los MAX_CANDIDATOS primeros).
+        :raises ValueError: Si la transición no está permitida.
+        """
+        with self._lock:
+            # El visitante limpió el trabajo mientras se procesaba: el resultado ya no interesa
+            if self.descartado:
+                return
+            if estado not in TRANSICIONES[self.estado]:
+                raise ValueError(f"Invalid job transition {self.estado} -> {estado}")
+            if estado == "detectando":
+                self.resultados = []
+                self.candidatos = []
+                self.captura = None
+            if resultados is not None:
+                self.resultados = resultados
+            if candidatos is not None:
+                self.candidatos = [lista[:MAX_CANDIDATOS] for lista in candidatos]
+                # Los cursores de una captura no valen para la siguiente
+                self.captura = secrets.token_hex(4)
+                self._guardar_candidatos()
+            self.estado = estado
+            self.mensaje = mensaje
+            self.actualizado = time.time()
+            self._guardar()
+
+    def nueva_captura(self):
+        """
+        Marca la llegada de una captura nueva: las cancelaciones y sondeos anteriores ya no cuentan.
+        """
+        for ruta in (self._ruta_cancelacion(), self._ruta_sondeo()):
+            try:
+                os.remove(ruta)
+            except OSError:
+                pass
+
+    def cancelar(self):
+        """
+        Pide que se cancele la captura en curso, la procese este worker u otro.
+
+        :return: False si el trabajo ya había terminado y no hay nada que cancelar.
+        """
+        if self.descartado or self.estado in ("completo", "error", "cancelado"):
+            return False
+        try:
+            with open(self._ruta_cancelacion(), "w"):
+                pass
+        except OSError:
+            return False
+        return True
+
+    def latido(self):
+        """
+        Anota que el navegador sigue esperando el resultado (lo llama cada sondeo de /process_status).
+        """
+        ruta = self._ruta_sondeo()
+        try:
+            os.utime(ruta)
+        except FileNotFoundError:
+            try:
+                with open(ruta, "w"):
+                    pass
+            except OSError:
+                pass
+        except OSError:
+            pass
+
+    def motivo_cancelacion(self):
+        """
+        :return: Por qué ya no hay que seguir procesando la captura ("client", "cleared" o "abandoned"),
+                 o None si hay que seguir.
+        """
+        if self.descartado:
+            return "cleared"
+        if os.path.exists(self._ruta_cancelacion()):
+            return "client"
+        try:
+            sondeo = os.stat(self._ruta_sondeo()).st_mtime
+        except OSError:
+            # Sin carpeta, otro worker limpió el trabajo; sin sondeo, el cliente no consulta el estado
+            if not os.path.isdir(self.directorio):
+                # Que cambiar_estado no vuelva a crear la carpeta
+                self.descartado = True
+                return "cleared"
+            return None
+        if ABANDONO > 0 and time.time() - sondeo > ABANDONO:
+            return "abandoned"
+        return None
+
+    def comprobar_cancelacion(self, etapa, caras_pendientes=0):
+        """
+        Punto de cancelación del pipeline: lanza CapturaCancelada si ya no hay que seguir.
+
+        :param etapa: Etapa que se va a ejecutar.
+        :param caras_pendientes: Caras que quedan por buscar.
+        :raises CapturaCancelada: Si la captura se canceló.
+        """
+        motivo = self.motivo_cancelacion()
+        if motivo is None:
+            return
+        metricas.incrementar("captures_cancelled_total", reason=motivo, stage=etapa)
+        if caras_pendientes:
+            metricas.incrementar("cancelled_faces_total", caras_pendientes, stage=etapa)
+        raise CapturaCancelada(motivo, etapa, caras_pendientes)
+
+    def estado_publico(self):
+        """
+        :return: Diccionario con status y message para /process_status.
+        """
+        status, mensaje = ESTADOS[self.estado]
+        return {"status": status, "message": self.mensaje or mensaje}
+
+    def pagina_candidatos(self, n, cursor=None, limite=3):
+        """
+        Devuelve una página de la lista ordenada de famosos de una cara.
+
+        :param n: Número de la cara detectada, empezando en 1.
+        :param cursor: Cursor devuelto por la página anterior, o None para seguir tras los resultados ya mostrados.
+        :param limite: Famosos por página (como mucho MAX_PAGINA).
+        :return: Diccionario con los candidatos, next_cursor (None en la última página) y total, o None si
+                 no hay lista para esa cara.
+        :raises ValueError: Si el cursor no es válido o es de otra captura.
+        """
+        with self._lock:
+            if self.candidatos is None:
+                self._leer_candidatos()
+            candidatos, captura = self.candidatos, self.captura
+        if n < 1 or n > len(candidatos):
+            return None
+        lista = candidatos[n - 1]
+        if cursor is None:
+            inicio = min(len(self.resultados[n - 1].get("matches", [])), len(lista)) \
+                if n <= len(self.resultados) else 0
+        else:
+            prefijo, _, posicion = str(cursor).partition(".")
+            if prefijo != captura or not posicion.isdigit():
+                raise ValueError("Invalid or expired cursor")
+            inicio = int(posicion)
+        fin = min(inicio + max(1, min(limite, MAX_PAGINA)), len(lista))
+        return {
+            "candidatos": lista[inicio:fin],
+            "next_cursor": f"{captura}.{fin}" if fin < len(lista) else None,
+            "total": len(lista),
+        }
+
+    def _ruta_estado(self):
+        return os.path.join(self.directorio, "estado.json")
+
+    def _ruta_candidatos(self):
+        return os.path.join(self.directorio, "candidatos.json")
+
+    def _ruta_cancelacion(self):
+        return os.path.join(self.directorio, "cancelar")
+
+    def _ruta_sondeo(self):
+        return os.path.join(self.directorio, "sondeo")
+
+    def _guardar(self):
+        os.makedirs(self.directorio, exist_ok=True)
+        ruta = self._ruta_estado()
+        temporal = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporal, "w") as f:
+            json.dump({"estado": self.estado, "mensaje": self.mensaje, "resultados": self.resultados,
+                       "captura": self.captura, "actualizado": self.actualizado}, f)
+        os.replace(temporal, ruta)
+        self._version = os.stat(ruta).st_mtime_ns
+
+    def _guardar_candidatos(self):
+        # Se escribe antes que estado.json: quien vea el estado nuevo ya encuentra su lista
+        os.makedirs(self.directorio, exist_ok=True)
+        ruta = self._ruta_candidatos()
+        temporal = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporal, "w") as f:
+            json.dump({"captura": self.captura, "candidatos": self.candidatos}, f)
+        os.replace(temporal, ruta)
+
+    def _leer_candidatos(self):
+        try:
+            with open(self._ruta_candidatos()) as f:
+                datos = json.load(f)
+        except (OSError, ValueError):
+            datos = {}
+        # Una lista de otra captura (o ninguna) no sirve para el estado actual
+        self.candidatos = datos.get("candidatos", []) if self.captura and datos.get("captura") == self.captura \
+            else []
+
+    def refrescar(self):
+        """
+        Recarga el estado si otro proceso lo ha cambiado.
+
+        :return: False si el trabajo ya no existe en disco (otro worker lo limpió).
+        """
+        try:
+            version = os.stat(self._ruta_estado()).st_mtime_ns
+        except OSError:
+            return False
+        if version != self._version:
+            try:
+                with open(self._ruta_estado()) as f:
+                    datos = json.load(f)
+            except (OSError, ValueError):
+                # Se está reemplazando en este momento; vale el estado en memoria
+                return True
+            with self._lock:
+                self.estado = datos["estado"]
+                self.mensaje = datos["mensaje"]
+                self.resultados = datos["resultados"]
+                self.actualizado = datos["actualizado"]
+                if datos.get("captura") != self.captura:
+                    # Otro worker terminó la captura: su lista se lee al pedir la primera página
+                    self.captura = datos.get("captura")
+                    self.candidatos = None
+                self._version = version
+        return True
+
+
+class RegistroTrabajos:
+    """Trabajos de este proceso, indexados por id, y limpieza en segundo plano."""
+
+    def __init__(self, carpeta=CARPETA, ttl=TTL):
+        self.carpeta = carpeta
+        self.ttl = ttl
+        self._trabajos = {}
+        self._lock = threading.Lock()
+        self._pendientes = queue.Queue()
+        self._pid_limpiador = None
+
+    def obtener(self, id_trabajo):
+        """
+        Busca un trabajo en memoria o, si lo creó otro worker, en su estado.json.
+
+        :param id_trabajo: Id de la cookie.
+        :return: Trabajo, o None si no existe.
+        """
+        if not id_trabajo or not _ID_VALIDO.match(id_trabajo):
+            return None
+        with self._lock:
+            trabajo = self._trabajos.get(id_trabajo)
+        if trabajo is None:
+            trabajo = Trabajo(id_trabajo, self.carpeta)
+        if not trabajo.refrescar():
+            with self._lock:
+                self._trabajos.pop(id_trabajo, None)
+            return None
+        with self._lock:
+            return self._trabajos.setdefault(id_trabajo, trabajo)
+
+    def crear(self):
+        """
+        Crea un trabajo vacío en estado "esperando" con un id nuevo.
+
+        :return: Trabajo creado.
+        """
+        self._asegurar_limpiador()
+        trabajo = Trabajo(secrets.token_hex(8), self.carpeta)
+        trabajo._guardar()
+        with self._lock:
+            self._trabajos[trabajo.id] = trabajo
+        return trabajo
+
+    def obtener_o_crear(self, id_trabajo):
+        """
+        :param id_trabajo: Id de la cookie, o None.
+        :return: El trabajo existente o uno nuevo.
+        """
+        return self.obtener(id_trabajo) or self.crear()
+
+    def descartar(self, trabajo):
+        """
+        Quita un trabajo del registro y deja el borrado de su carpeta al hilo de limpieza.
+
+        :param trabajo: Trabajo a descartar.
+        """
+        self._asegurar_limpiador()
+        trabajo.descartado = True
+        with self._lock:
+            self._trabajos.pop(trabajo.id, None)
+        # Renombrar es inmediato: los demás workers dejan de ver el trabajo en su siguiente stat()
+        destino = os.path.join(self.carpeta, f".borrar-{trabajo.id}")
+        try:
+            os.rename(trabajo.directorio, destino)
+        except OSError:
+            return
+        self._pendientes.put(destino)
+
+    def reemplazar(self, trabajo):
+        """
+        Descarta un trabajo y crea otro para el mismo navegador.
+
+        :param trabajo: Trabajo actual.
+        :return: Trabajo nuevo.
+        """
+        self.descartar(trabajo)
+        return self.crear()
+
+    def _asegurar_limpiador(self):
+        # Los hilos no sobreviven al fork de gunicorn: cada worker arranca el suyo
+        if self._pid_limpiador != os.getpid():
+            self._pid_limpiador = os.getpid()
+            threading.Thread(target=self._limpiar, daemon=True, name="limpieza-trabajos").start()
+
+    def _limpiar(self):
+        while True:
+            try:
+                directorio = self._pendientes.get(timeout=INTERVALO_BARRIDO)
+            except queue.Empty:
+                self._barrer_abandonados()
+                continue
+            shutil.rmtree(directorio, ignore_errors=True)
+
+    def _barrer_abandonados(self):
+        limite = time.time() - self.ttl
+        try:
+            entradas = list(os.scandir(self.carpeta))
+        except OSError:
+            return
+        for entrada in entradas:
+            try:
+                # Cada cambio de estado reemplaza estado.json y actualiza la fecha de la carpeta
+                if entrada.stat().st_mtime >= limite:
+                    continue
+                if entrada.is_dir():
+                    with self._lock:
+                        self._trabajos.pop(entrada.name, None)
+                    shutil.rmtree(entrada.path, ignore_errors=True)
+                else:
+                    os.remove(entrada.path)
+            except OSError:
+                continue
+
+
+registro = RegistroTrabajos()
+
+
+def trabajo_actual():
+    """
+    Devuelve el trabajo del navegador que hace la petición, creándolo si no tiene.
+
+    :return: Trabajo.
+    """
+    if 'trabajo' not in g:
+        g.trabajo = registro.obtener_o_crear(request.cookies.get(COOKIE))
+    return g.trabajo
+
+
+def instalar_trabajos(app):
+    """
+    Registra en la aplicación Flask el envío de la cookie del trabajo.
+
+    :param app: Aplicación Flask.
+    """
+    @app.after_request
+    def _enviar_cookie_trabajo(response):
+        trabajo = g.get('trabajo')
+        if trabajo is not None and request.cookies.get(COOKIE) != trabajo.id:
+            response.set_cookie(COOKIE, trabajo.id, httponly=True, samesite='Lax')
+        return response
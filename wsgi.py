@@ -0,0 +1,94 @@
+"""
+Punto de entrada WSGI para producción.
+
+    gunicorn -c gunicorn.conf.py wsgi:app     # producción
+    python wsgi.py                            # igual que la línea anterior
+    python wsgi.py --dev                      # servidor de desarrollo de Flask con debug
+
+CELEBRIA_BACKEND selecciona el backend ("imdb" por defecto, o "app"). Con
+preload_app=True (gunicorn.conf.py) este módulo se importa una sola vez en el
+proceso maestro: el índice de famosos y el modelo se cargan antes del fork y
+los workers los comparten copy-on-write en lugar de cargarlos cada uno.
+
+Variables de entorno:
+- CELEBRIA_MODEL: modelo de embeddings ("VGG-Face" por defecto, o "Facenet",
+  "Facenet512", "ArcFace"... con su índice representations_<modelo>.pkl).
+- CELEBRIA_PRELOAD_MODEL=0: no cargar el modelo antes del fork (cada worker lo
+  carga en su primera petición). Útil si la versión de TensorFlow instalada se
+  bloquea al heredar el runtime a través de fork().
+- CELEBRIA_EMBEDDING_BACKEND=onnx: calcular los embeddings con ONNX Runtime
+  (imdb-wiki/embedding_backends.py, modelo en CELEBRIA_ONNX_MODEL). La sesión
+  de ONNX Runtime tiene sus propios hilos, que no sobreviven al fork, así que
+  cada worker la crea y la calienta al arrancar (post_worker_init en
+  gunicorn.conf.py).
+- CELEBRIA_INFERENCE_PROCESSES: procesos de inferencia de cada worker
+  (inferencia.py). Detectan las caras y calculan los embeddings fuera del
+  worker web; el modelo se carga en ellos y no antes del fork.
+- CELEBRIA_INDEX_WATCH: segundos entre comprobaciones del archivo del índice
+  de famosos (indices.py). Cada worker recarga el índice cuando cambia; el
+  endpoint /admin/index/reload solo recarga el worker que lo atiende.
+- CELEBRIA_SIMULATED_MODEL=1: usar modelo_simulado.py en lugar de DeepFace,
+  para medir el servidor sin TensorFlow (CELEBRIA_SIMULATED_DIM y
+  CELEBRIA_SIMULATED_LATENCY lo configuran).
+"""
+import gc
+import os
+import sys
+
+BACKEND = os.environ.get("CELEBRIA_BACKEND", "imdb")
+MODELO = os.environ.get("CELEBRIA_MODEL", "VGG-Face")
+
+if os.environ.get("CELEBRIA_SIMULATED_MODEL", "0") == "1":
+    from modelo_simulado import instalar_desde_entorno
+    instalar_desde_entorno(ocupar_cpu=True)
+
+from backends import cargar_backend
+
+
+def precargar_modelo():
+    """
+    Construye el modelo de embeddings en el proceso actual para que los workers lo hereden.
+    """
+    if os.environ.get("CELEBRIA_PRELOAD_MODEL", "1") != "1":
+        return
+    if os.environ.get("CELEBRIA_EMBEDDING_BACKEND", "deepface") == "onnx":
+        return
+    # Con procesos de inferencia el modelo se carga en ellos, no en los workers web
+    if int(os.environ.get("CELEBRIA_INFERENCE_PROCESSES", "0")) > 0:
+        return
+    from deepface import DeepFace
+    # El backend imdb precarga también el modelo ligero del nivel "degraded" (CELEBRIA_QOS_MODEL, calidad.py)
+    for modelo in getattr(backend, "MODELOS_PRECARGA", [MODELO]):
+        DeepFace.build_model(modelo)
+        print(f"Preloaded {modelo} model before forking workers")
+
+
+def calentar_worker():
+    """
+    Crea y calienta las sesiones de ONNX Runtime en el proceso actual, después del fork.
+    """
+    if os.environ.get("CELEBRIA_EMBEDDING_BACKEND", "deepface") != "onnx":
+        return
+    calentar = getattr(backend, "calentar_modelos", None)
+    if calentar is not None:
+        calentar()
+
+
+# Importar el backend carga también el índice de famosos (a nivel de módulo)
+backend = cargar_backend(BACKEND)
+app = backend.app
+precargar_modelo()
+
+# Mover los objetos ya cargados a la generación permanente del GC para que las
+# recolecciones de los workers no toquen (y copien) sus páginas de memoria
+gc.freeze()
+
+
+if __name__ == "__main__":
+    if "--dev" in sys.argv:
+        calentar_worker()
+        app.run(debug=True, use_reloader=False)
+    else:
+        os.execvp(sys.executable, [sys.executable, "-m", "gunicorn", "-c",
+                                   os.path.join(os.path.dirname(os.path.abspath(__file__)), "gunicorn.conf.py"),
+                                   "wsgi:app"])